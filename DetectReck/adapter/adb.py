@@ -1,8 +1,13 @@
 # This is the interface for adb
 import subprocess
 import logging
+import os
 import re
 from .adapter import Adapter
+from .adb_shell_pool import ShellSessionPool, ShellCommandNotSentException, ShellCommandLostException, \
+    SHELL_CMD_TIMEOUT
+from .adb_client import AdbClient, AdbClientException
+from .monkey_injector import MonkeyInjectorException
 import time
 try:
     from shlex import quote # Python 3
@@ -46,6 +51,10 @@ class ADB(Adapter):
         self.device = device
 
         self.cmd_prefix = ['adb', "-s", device.serial]
+        # Long-lived `adb shell` sessions serving the shell commands
+        self.shell_pool = ShellSessionPool(self.cmd_prefix)
+        # Client of the adb server, used instead of `adb` processes for forward and file transfers
+        self.client = AdbClient(device.serial)
 
     def run_cmd(self, extra_args):
         """
@@ -72,10 +81,11 @@ class ADB(Adapter):
         self.logger.debug(r)
         return r
 
-    def shell(self, extra_args):
+    def shell(self, extra_args, timeout=SHELL_CMD_TIMEOUT):
         """
-        run an `adb shell` command
+        run an `adb shell` command in a persistent shell session
         @param extra_args:
+        @param timeout: max time to wait for the command (seconds)
         @return: output of adb shell command
         """
         if isinstance(extra_args, str) or isinstance(extra_args, str):
@@ -85,16 +95,35 @@ class ADB(Adapter):
             self.logger.warning(msg)
             raise ADBException(msg)
 
-        shell_extra_args = ['shell'] + [quote(arg) for arg in extra_args]
-
-        return self.run_cmd(shell_extra_args)
+        command = " ".join([quote(arg) for arg in extra_args])
+        self.logger.debug('shell command:')
+        self.logger.debug(command)
+        try:
+            exit_code, r = self.shell_pool.execute(command, timeout)
+        except ShellCommandNotSentException as e:
+            # Fall back to a one-off adb process, the command did not reach the device
+            self.logger.warning("shell session failed, running `adb shell` instead: %s" % e)
+            return self.run_cmd(['shell'] + [quote(arg) for arg in extra_args])
+        except ShellCommandLostException as e:
+            # The command may have run on the device, it is not run again
+            raise ADBException("shell command failed: %s" % e)
+        r = r.strip()
+        if exit_code != 0:
+            # Same as running `adb shell` via subprocess.check_output
+            raise subprocess.CalledProcessError(exit_code, self.cmd_prefix + ['shell', command], r)
+        self.logger.debug('return:')
+        self.logger.debug(r)
+        return r
 
     def check_connectivity(self):
         """
         check if adb is connected
         :return: True for connected
         """
-        r = self.run_cmd("get-state")
+        try:
+            r = self.client.get_state()
+        except AdbClientException:
+            r = self.run_cmd("get-state")
         return r.startswith("device")
 
     def connect(self):
@@ -107,8 +136,56 @@ class ADB(Adapter):
         """
         disconnect adb
         """
+        self.logger.debug("shell session pool: %s" % self.shell_pool.get_stats())
+        self.shell_pool.close()
+        self.client.close()
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
+    def forward(self, local, remote):
+        """
+        forward a host socket to a device socket
+        @param local: e.g. "tcp:7336"
+        @param remote: e.g. "localabstract:minicap"
+        """
+        try:
+            self.client.forward(local, remote)
+        except AdbClientException as e:
+            self.logger.warning("adb server client failed, running `adb forward` instead: %s" % e)
+            self.run_cmd(["forward", local, remote])
+
+    def remove_forward(self, local):
+        """
+        remove a forward set by forward()
+        @param local: e.g. "tcp:7336"
+        """
+        try:
+            self.client.remove_forward(local)
+        except AdbClientException as e:
+            self.logger.warning("adb server client failed, running `adb forward --remove` instead: %s" % e)
+            self.run_cmd(["forward", "--remove", local])
+
+    def pull(self, remote_file, local_file):
+        """
+        copy a file from the device
+        """
+        try:
+            self.client.pull(remote_file, local_file)
+        except AdbClientException as e:
+            self.logger.warning("adb server client failed, running `adb pull` instead: %s" % e)
+            self.run_cmd(["pull", remote_file, local_file])
+
+    def push(self, local_file, remote_dir):
+        """
+        copy a file or directory to the device
+        """
+        if os.path.isfile(local_file):
+            try:
+                self.client.push(local_file, remote_dir)
+                return
+            except AdbClientException as e:
+                self.logger.warning("adb server client failed, running `adb push` instead: %s" % e)
+        self.run_cmd(["push", local_file, remote_dir])
+
     def get_property(self, property_name):
         """
         get the value of property
@@ -281,7 +358,7 @@ class ADB(Adapter):
         return package_to_path
 
     def get_display_density(self):
-        display_info = self.get_display_info()
+        display_info = self.device.get_display_info()
         if 'density' in display_info:
             return display_info['density']
         else:
@@ -292,16 +369,17 @@ class ADB(Adapter):
         if orientation_orig != orientation_dest:
             if orientation_dest == 1:
                 _x = x
-                x = self.get_display_info()['width'] - y
+                x = self.device.get_display_info()['width'] - y
                 y = _x
             elif orientation_dest == 3:
                 _x = x
                 x = y
-                y = self.get_display_info()['height'] - _x
+                y = self.device.get_display_info()['height'] - _x
         return x, y
 
     def get_orientation(self):
-        display_info = self.get_display_info()
+        # served from the device property cache, which is invalidated on rotation
+        display_info = self.device.get_display_info()
         if 'orientation' in display_info:
             return display_info['orientation']
         else:
@@ -314,17 +392,40 @@ class ADB(Adapter):
         self.shell("input keyevent MENU")
         self.shell("input keyevent BACK")
 
+    def __get_injector(self):
+        """
+        get the monkey injection channel of the device, if it is connected
+        """
+        injector = getattr(self.device, "monkey_injector", None)
+        if injector is not None and injector.connected:
+            return injector
+        return None
+
     def press(self, key_code):
         """
         Press a key
         """
+        injector = self.__get_injector()
+        if injector is not None:
+            try:
+                injector.press(key_code)
+                return
+            except MonkeyInjectorException as e:
+                self.logger.warning("monkey injection failed, using `input` instead: %s" % e)
         self.shell("input keyevent %s" % key_code)
 
     def touch(self, x, y, orientation=-1, event_type=DOWN_AND_UP):
         if orientation == -1:
             orientation = self.get_orientation()
-        self.shell("input tap %d %d" %
-                   self.__transform_point_by_orientation((x, y), orientation, self.get_orientation()))
+        (x, y) = self.__transform_point_by_orientation((x, y), orientation, self.get_orientation())
+        injector = self.__get_injector()
+        if injector is not None:
+            try:
+                injector.tap(x, y)
+                return
+            except MonkeyInjectorException as e:
+                self.logger.warning("monkey injection failed, using `input` instead: %s" % e)
+        self.shell("input tap %d %d" % (x, y))
 
     def long_touch(self, x, y, duration=2000, orientation=-1):
         """
@@ -347,7 +448,15 @@ class ADB(Adapter):
         (x0, y0) = self.__transform_point_by_orientation((x0, y0), orientation, self.get_orientation())
         (x1, y1) = self.__transform_point_by_orientation((x1, y1), orientation, self.get_orientation())
 
-        version = self.get_sdk_version()
+        injector = self.__get_injector()
+        if injector is not None:
+            try:
+                injector.drag((x0, y0), (x1, y1), duration)
+                return
+            except MonkeyInjectorException as e:
+                self.logger.warning("monkey injection failed, using `input` instead: %s" % e)
+
+        version = self.device.get_sdk_version()
         if version <= 15:
             self.logger.error("drag: API <= 15 not supported (version=%d)" % version)
         elif version <= 17:
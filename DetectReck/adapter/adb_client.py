@@ -0,0 +1,592 @@
+# Client of the local adb server, speaking its smart-socket and sync protocols directly instead of running `adb`.
+# See SERVICES.TXT, SYNC.TXT and OVERVIEW.TXT in the adb sources:
+#   - a request is a 4-digit hex length followed by the payload, answered by "OKAY" or "FAIL" + hex length + message
+#   - "host:transport:<serial>" switches the connection to the device, which then serves one device service,
+#     e.g. "shell:<command>" (raw output until the connection closes), "exec:<command>" (binary output) or "sync:"
+#   - a sync connection serves file requests ("STAT", "RECV", "SEND") until "QUIT", so it is kept open and reused
+import logging
+import os
+import socket
+import stat
+import struct
+import threading
+import time
+
+ADB_SERVER_HOST = "127.0.0.1"
+ADB_SERVER_PORT = 5037
+ADB_SOCKET_TIMEOUT = 60
+# Max size of a DATA chunk of the sync protocol
+SYNC_DATA_MAX = 64 * 1024
+
+
+class AdbClientException(Exception):
+    """
+    Exception in the communication with the adb server
+    """
+    pass
+
+
+class AdbClient(object):
+    """
+    talks to the adb server on behalf of one device
+    """
+
+    def __init__(self, serial=None, host=ADB_SERVER_HOST, port=ADB_SERVER_PORT, timeout=ADB_SOCKET_TIMEOUT):
+        """
+        :param serial: serial number of the device, the only connected device if None
+        :param host: host of the adb server
+        :param port: port of the adb server
+        :param timeout: socket timeout (seconds)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.serial = serial
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        # The sync connection is reused by all file transfers
+        self.sync_lock = threading.Lock()
+        self.__sync_sock = None
+        self.request_count = 0
+
+    # smart-socket protocol
+
+    def __connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+        except socket.error as e:
+            raise AdbClientException("Failed to connect to adb server at %s:%d: %s" % (self.host, self.port, e))
+        return sock
+
+    @staticmethod
+    def __recv_exactly(sock, length):
+        buf = bytearray(length)
+        view = memoryview(buf)
+        received = 0
+        while received < length:
+            n = sock.recv_into(view[received:], length - received)
+            if n == 0:
+                raise AdbClientException("connection closed by adb server")
+            received += n
+        return bytes(buf)
+
+    @staticmethod
+    def __recv_all(sock):
+        chunks = []
+        while True:
+            chunk = sock.recv(SYNC_DATA_MAX)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def __read_hex_data(self, sock):
+        length = int(self.__recv_exactly(sock, 4), 16)
+        return self.__recv_exactly(sock, length)
+
+    def __read_status(self, sock):
+        status = self.__recv_exactly(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            raise AdbClientException(self.__read_hex_data(sock).decode('utf-8', errors='replace'))
+        raise AdbClientException("unexpected response from adb server: %s" % status)
+
+    def __send_request(self, sock, request):
+        payload = request.encode('utf-8')
+        sock.sendall(b"%04x" % len(payload) + payload)
+        self.request_count += 1
+        self.__read_status(sock)
+
+    def host_request(self, request, has_data=False):
+        """
+        send a host service request, e.g. "host:version"
+        :param request: request string
+        :param has_data: whether the response carries hex-length-prefixed data
+        :return: the response data as str, or None
+        """
+        sock = self.__connect()
+        try:
+            self.__send_request(sock, request)
+            if has_data:
+                return self.__read_hex_data(sock).decode('utf-8', errors='replace')
+            return None
+        finally:
+            sock.close()
+
+    def __host_serial_prefix(self):
+        return "host-serial:%s:" % self.serial if self.serial else "host:"
+
+    def __open_transport(self):
+        sock = self.__connect()
+        try:
+            if self.serial:
+                self.__send_request(sock, "host:transport:%s" % self.serial)
+            else:
+                self.__send_request(sock, "host:transport-any")
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    # host services
+
+    def get_version(self):
+        """
+        :return: version of the adb server protocol, e.g. 41
+        """
+        return int(self.host_request("host:version", has_data=True), 16)
+
+    def get_state(self):
+        """
+        :return: state of the device, e.g. "device", "offline" or "bootloader"
+        """
+        return self.host_request(self.__host_serial_prefix() + "get-state", has_data=True)
+
+    def forward(self, local, remote):
+        """
+        forward a host socket to a device socket, same as `adb forward <local> <remote>`
+        :param local: e.g. "tcp:7336"
+        :param remote: e.g. "localabstract:minicap"
+        """
+        sock = self.__connect()
+        try:
+            self.__send_request(sock, self.__host_serial_prefix() + "forward:%s;%s" % (local, remote))
+            # Recent servers confirm the forward with a second status once it is set up
+            try:
+                self.__read_status(sock)
+            except AdbClientException as e:
+                if "connection closed" not in str(e):
+                    raise
+        finally:
+            sock.close()
+
+    def remove_forward(self, local):
+        """
+        same as `adb forward --remove <local>`
+        :param local: e.g. "tcp:7336"
+        """
+        self.host_request(self.__host_serial_prefix() + "killforward:%s" % local)
+
+    def list_forward(self):
+        """
+        :return: list of (serial, local, remote)
+        """
+        forwards = []
+        for line in self.host_request("host:list-forward", has_data=True).splitlines():
+            elems = line.split()
+            if len(elems) == 3 and (self.serial is None or elems[0] == self.serial):
+                forwards.append(tuple(elems))
+        return forwards
+
+    # device services
+
+    def shell(self, command):
+        """
+        run a shell command on the device
+        :param command: command line
+        :return: output of the command (stdout and stderr) as str
+        """
+        sock = self.__open_transport()
+        try:
+            self.__send_request(sock, "shell:%s" % command)
+            output = self.__recv_all(sock)
+        finally:
+            sock.close()
+        return output.decode('utf-8', errors='replace').replace("\r\n", "\n")
+
+    def exec_out(self, command):
+        """
+        run a command on the device without a terminal, same as `adb exec-out`
+        :param command: command line
+        :return: the binary output of the command, unaltered
+        """
+        sock = self.__open_transport()
+        try:
+            self.__send_request(sock, "exec:%s" % command)
+            return self.__recv_all(sock)
+        finally:
+            sock.close()
+
+    def open_shell_stream(self, command):
+        """
+        start a long-running shell command, e.g. logcat
+        :return: the socket delivering the output of the command, to be closed by the caller
+        """
+        sock = self.__open_transport()
+        try:
+            self.__send_request(sock, "shell:%s" % command)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    # sync protocol
+
+    def __get_sync_sock(self):
+        if self.__sync_sock is None:
+            sock = self.__open_transport()
+            try:
+                self.__send_request(sock, "sync:")
+            except Exception:
+                sock.close()
+                raise
+            self.__sync_sock = sock
+        return self.__sync_sock
+
+    def __close_sync_sock(self):
+        if self.__sync_sock is not None:
+            try:
+                self.__sync_sock.sendall(b"QUIT" + struct.pack("<I", 0))
+            except socket.error:
+                pass
+            self.__sync_sock.close()
+            self.__sync_sock = None
+
+    def __sync_request(self, sock, sync_id, data):
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        sock.sendall(sync_id + struct.pack("<I", len(data)) + data)
+
+    def __sync_call(self, func, *args):
+        """
+        run a sync operation on the shared sync connection, reconnecting once if the connection is broken
+        """
+        with self.sync_lock:
+            for attempt in range(2):
+                try:
+                    return func(self.__get_sync_sock(), *args)
+                except (socket.error, AdbClientException) as e:
+                    self.__close_sync_sock()
+                    # A FAIL response is an error of the request itself, not of the connection
+                    if attempt == 1 or not isinstance(e, socket.error) and "connection closed" not in str(e):
+                        raise
+
+    def __stat(self, sock, remote_path):
+        self.__sync_request(sock, b"STAT", remote_path)
+        response = self.__recv_exactly(sock, 16)
+        if response[:4] != b"STAT":
+            raise AdbClientException("unexpected STAT response: %s" % response[:4])
+        mode, size, mtime = struct.unpack("<III", response[4:])
+        return mode, size, mtime
+
+    def __recv(self, sock, remote_path, f):
+        self.__sync_request(sock, b"RECV", remote_path)
+        size = 0
+        while True:
+            header = self.__recv_exactly(sock, 8)
+            sync_id, length = header[:4], struct.unpack("<I", header[4:])[0]
+            if sync_id == b"DATA":
+                f.write(self.__recv_exactly(sock, length))
+                size += length
+            elif sync_id == b"DONE":
+                return size
+            elif sync_id == b"FAIL":
+                raise AdbClientException("failed to pull %s: %s" %
+                                         (remote_path, self.__recv_exactly(sock, length).decode('utf-8', 'replace')))
+            else:
+                raise AdbClientException("unexpected RECV response: %s" % sync_id)
+
+    def __send(self, sock, f, remote_path, mode, mtime):
+        self.__sync_request(sock, b"SEND", "%s,%d" % (remote_path, mode))
+        size = 0
+        while True:
+            chunk = f.read(SYNC_DATA_MAX)
+            if not chunk:
+                break
+            self.__sync_request(sock, b"DATA", chunk)
+            size += len(chunk)
+        sock.sendall(b"DONE" + struct.pack("<I", mtime))
+        header = self.__recv_exactly(sock, 8)
+        sync_id, length = header[:4], struct.unpack("<I", header[4:])[0]
+        if sync_id == b"FAIL":
+            raise AdbClientException("failed to push %s: %s" %
+                                     (remote_path, self.__recv_exactly(sock, length).decode('utf-8', 'replace')))
+        if sync_id != b"OKAY":
+            raise AdbClientException("unexpected SEND response: %s" % sync_id)
+        return size
+
+    def stat(self, remote_path):
+        """
+        :return: (mode, size, mtime) of a file on the device, mode is 0 if the file does not exist
+        """
+        return self.__sync_call(self.__stat, remote_path)
+
+    def pull(self, remote_path, local_path):
+        """
+        copy a file from the device, same as `adb pull`
+        :return: size of the file
+        """
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path, os.path.basename(remote_path))
+        with open(local_path, "wb") as f:
+            return self.__sync_call(self.__recv_file, remote_path, f)
+
+    def __recv_file(self, sock, remote_path, f):
+        # The file is rewritten from the start if the transfer is retried
+        f.seek(0)
+        f.truncate()
+        return self.__recv(sock, remote_path, f)
+
+    def pull_data(self, remote_path):
+        """
+        read a file of the device into memory
+        :return: content of the file as bytes
+        """
+        import io
+        buf = io.BytesIO()
+        self.__sync_call(self.__recv_file, remote_path, buf)
+        return buf.getvalue()
+
+    def push(self, local_path, remote_path, mode=0o644):
+        """
+        copy a file to the device, same as `adb push`.
+        If remote_path is an existing directory, the file is copied into it.
+        :return: size of the file
+        """
+        remote_mode = self.stat(remote_path)[0]
+        if stat.S_ISDIR(remote_mode):
+            remote_path = remote_path.rstrip("/") + "/" + os.path.basename(local_path)
+        mtime = int(os.path.getmtime(local_path))
+        with open(local_path, "rb") as f:
+            return self.__sync_call(self.__send_file, f, remote_path, stat.S_IFREG | mode, mtime)
+
+    def __send_file(self, sock, f, remote_path, mode, mtime):
+        f.seek(0)
+        return self.__send(sock, f, remote_path, mode, mtime)
+
+    def close(self):
+        with self.sync_lock:
+            self.__close_sync_sock()
+
+
+def benchmark(serial=None, count=20):
+    """
+    Compare `adb` processes with the adb server client for get-state, shell and pull
+    :param serial: device serial, the only connected device if None
+    :param count: number of runs
+    """
+    import subprocess
+    import tempfile
+    cmd_prefix = ["adb"] if serial is None else ["adb", "-s", serial]
+    client = AdbClient(serial)
+    local_path = os.path.join(tempfile.mkdtemp(), "build.prop")
+
+    cases = [
+        ("get-state", lambda: subprocess.check_output(cmd_prefix + ["get-state"]), client.get_state),
+        ("shell", lambda: subprocess.check_output(cmd_prefix + ["shell", "echo", "1"]), lambda: client.shell("echo 1")),
+        ("pull", lambda: subprocess.check_output(cmd_prefix + ["pull", "/system/build.prop", local_path]),
+         lambda: client.pull("/system/build.prop", local_path))
+    ]
+    for name, run_process, run_client in cases:
+        start = time.time()
+        for _ in range(count):
+            run_process()
+        process_time = time.time() - start
+        start = time.time()
+        for _ in range(count):
+            run_client()
+        client_time = time.time() - start
+        print("%-10s adb process: %.1f ms, adb client: %.1f ms" %
+              (name, process_time * 1000 / count, client_time * 1000 / count))
+    client.close()
+
+
+class StandInAdbServer(object):
+    """
+    a minimal local adb server serving an in-memory device, to check the protocol handling of AdbClient without
+    a device: host services, forwards, shell, exec and the sync STAT/RECV/SEND requests
+    """
+
+    def __init__(self, files=None):
+        """
+        :param files: dict of remote path -> content (bytes) of the stand-in device
+        """
+        self.files = dict(files or {})
+        self.forwards = []
+        self.requests = []
+        self.sync_connection_count = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((ADB_SERVER_HOST, 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.closed = False
+        accept_thread = threading.Thread(target=self.__accept)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def __accept(self):
+        while not self.closed:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            handle_thread = threading.Thread(target=self.__handle, args=(conn,))
+            handle_thread.daemon = True
+            handle_thread.start()
+
+    @staticmethod
+    def __recv_exactly(conn, length):
+        data = b""
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def __read_request(self, conn):
+        request = self.__recv_exactly(conn, int(self.__recv_exactly(conn, 4), 16)).decode('utf-8')
+        self.requests.append(request)
+        return request
+
+    @staticmethod
+    def __fail(conn, message):
+        message = message.encode('utf-8')
+        conn.sendall(b"FAIL%04x" % len(message) + message)
+
+    @staticmethod
+    def __okay_data(conn, data):
+        data = data.encode('utf-8')
+        conn.sendall(b"OKAY%04x" % len(data) + data)
+
+    def __handle(self, conn):
+        try:
+            request = self.__read_request(conn)
+            if request == "host:version":
+                self.__okay_data(conn, "%04x" % 41)
+            elif request.endswith(":get-state"):
+                self.__okay_data(conn, "device")
+            elif ":forward:" in request:
+                self.forwards.append(request.split(":forward:", 1)[1])
+                # Recent servers send a second OKAY once the forward is set up
+                conn.sendall(b"OKAYOKAY")
+            elif ":killforward:" in request:
+                conn.sendall(b"OKAY")
+            elif request.startswith("host:transport"):
+                conn.sendall(b"OKAY")
+                self.__handle_device_service(conn, self.__read_request(conn))
+            else:
+                self.__fail(conn, "unknown host service")
+        except EOFError:
+            pass
+        finally:
+            conn.close()
+
+    def __handle_device_service(self, conn, request):
+        if request.startswith("shell:"):
+            # A terminal turns line feeds into CRLF
+            conn.sendall(b"OKAY" + ("%s\r\n" % request[len("shell:"):]).encode('utf-8'))
+        elif request.startswith("exec:"):
+            conn.sendall(b"OKAY" + bytes(range(256)))
+        elif request == "sync:":
+            conn.sendall(b"OKAY")
+            self.sync_connection_count += 1
+            self.__handle_sync(conn)
+        else:
+            self.__fail(conn, "unknown device service")
+
+    def __handle_sync(self, conn):
+        while True:
+            header = self.__recv_exactly(conn, 8)
+            sync_id, length = header[:4], struct.unpack("<I", header[4:])[0]
+            data = self.__recv_exactly(conn, length)
+            if sync_id == b"QUIT":
+                return
+            if sync_id == b"STAT":
+                path = data.decode('utf-8')
+                if path.rstrip("/") in [os.path.dirname(file_path) for file_path in self.files]:
+                    mode = stat.S_IFDIR | 0o755
+                else:
+                    mode = stat.S_IFREG | 0o644 if path in self.files else 0
+                conn.sendall(b"STAT" + struct.pack("<III", mode, len(self.files.get(path, b"")), 0))
+            elif sync_id == b"RECV":
+                path = data.decode('utf-8')
+                if path not in self.files:
+                    message = b"No such file or directory"
+                    conn.sendall(b"FAIL" + struct.pack("<I", len(message)) + message)
+                    continue
+                content = self.files[path]
+                for i in range(0, len(content), SYNC_DATA_MAX):
+                    chunk = content[i:i + SYNC_DATA_MAX]
+                    conn.sendall(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+                conn.sendall(b"DONE" + struct.pack("<I", 0))
+            elif sync_id == b"SEND":
+                path = data.decode('utf-8').rsplit(",", 1)[0]
+                content = b""
+                while True:
+                    header = self.__recv_exactly(conn, 8)
+                    sync_id, length = header[:4], struct.unpack("<I", header[4:])[0]
+                    if sync_id == b"DONE":
+                        break
+                    if sync_id != b"DATA" or length > SYNC_DATA_MAX:
+                        self.__fail(conn, "invalid DATA chunk")
+                        return
+                    content += self.__recv_exactly(conn, length)
+                self.files[path] = content
+                conn.sendall(b"OKAY" + struct.pack("<I", 0))
+            else:
+                message = b"unknown sync request"
+                conn.sendall(b"FAIL" + struct.pack("<I", len(message)) + message)
+                return
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+def self_test():
+    """
+    Check AdbClient against StandInAdbServer: status and hex-length framing, FAIL messages, the double OKAY of
+    forward, CRLF handling of shell, binary exec output and sync transfers of several DATA chunks over one reused
+    sync connection
+    """
+    import tempfile
+    content = os.urandom(SYNC_DATA_MAX * 2 + 123)
+    server = StandInAdbServer({"/sdcard/big.bin": content})
+    client = AdbClient("stand-in", port=server.port, timeout=5)
+    try:
+        assert client.get_version() == 41
+        assert client.get_state() == "device"
+        try:
+            client.host_request("host:unknown")
+            raise AssertionError("FAIL not raised")
+        except AdbClientException as e:
+            assert str(e) == "unknown host service", e
+        client.forward("tcp:7336", "localabstract:minicap")
+        assert server.forwards == ["tcp:7336;localabstract:minicap"]
+        client.remove_forward("tcp:7336")
+        assert client.shell("echo 1") == "echo 1\n"
+        assert client.exec_out("screencap") == bytes(range(256))
+
+        assert client.stat("/sdcard/big.bin") == (stat.S_IFREG | 0o644, len(content), 0)
+        assert client.stat("/sdcard/missing")[0] == 0
+        assert client.pull_data("/sdcard/big.bin") == content
+        try:
+            client.pull_data("/sdcard/missing")
+            raise AssertionError("FAIL not raised")
+        except AdbClientException as e:
+            assert "No such file" in str(e), e
+        local_dir = tempfile.mkdtemp()
+        local_path = os.path.join(local_dir, "upload.bin")
+        with open(local_path, "wb") as f:
+            f.write(content[::-1])
+        assert client.push(local_path, "/sdcard/") == len(content)
+        assert server.files["/sdcard/upload.bin"] == content[::-1]
+        assert client.pull("/sdcard/upload.bin", local_dir) == len(content)
+        with open(local_path, "rb") as f:
+            assert f.read() == content[::-1]
+        # A FAIL of the sync protocol resets the connection, otherwise it is reused
+        assert server.sync_connection_count == 2, server.sync_connection_count
+    finally:
+        client.close()
+        server.close()
+    print("AdbClient self test passed (%d requests)" % len(server.requests))
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "--self-test":
+        self_test()
+    else:
+        benchmark(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,227 @@
+# Pool of long-lived `adb shell` sessions.
+# Every command is written to the stdin of an interactive shell and followed by a unique sentinel line carrying
+# the exit code, so a command costs one round trip instead of spawning an `adb` process.
+import logging
+import queue
+import subprocess
+import threading
+import time
+import uuid
+
+# Max number of concurrent shell sessions per device, enough for the concurrent steps of a state capture
+SHELL_POOL_SIZE = 3
+# Default timeout of one shell command (seconds)
+SHELL_CMD_TIMEOUT = 60
+SENTINEL_PREFIX = "__DROIDBOT_SHELL_DONE_"
+
+
+class ShellSessionException(Exception):
+    """
+    Exception in an adb shell session, the session should not be used anymore
+    """
+    pass
+
+
+class ShellCommandNotSentException(ShellSessionException):
+    """
+    The command was not sent to the device, it can safely be run another way
+    """
+    pass
+
+
+class ShellCommandLostException(ShellSessionException):
+    """
+    The command was sent but its result was lost (timeout, session exited), it may have run on the device
+    """
+    pass
+
+
+class ShellSession(object):
+    """
+    a long-lived `adb shell` process executing commands one by one
+    """
+
+    def __init__(self, cmd_prefix):
+        """
+        :param cmd_prefix: adb command prefix, e.g. ['adb', '-s', serial]
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.process = subprocess.Popen(cmd_prefix + ["shell"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        # stdout is read by a thread, so that a command can time out without blocking on the pipe
+        self.__lines = queue.Queue()
+        self.reader_thread = threading.Thread(target=self.__read_stdout)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+        self.command_count = 0
+
+    def __read_stdout(self):
+        for line in iter(self.process.stdout.readline, b""):
+            self.__lines.put(line)
+        # None marks the end of the process output
+        self.__lines.put(None)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def execute(self, command, timeout=SHELL_CMD_TIMEOUT):
+        """
+        run a command in this session
+        :param command: shell command line
+        :param timeout: max time to wait for the command to finish (seconds)
+        :return: (exit code, output)
+        """
+        if not self.is_alive():
+            raise ShellCommandNotSentException("shell session exited with %s" % self.process.returncode)
+        sentinel = SENTINEL_PREFIX + uuid.uuid4().hex
+        # Commands get no stdin, otherwise they would read the following commands
+        script = "{ %s\n} </dev/null\necho \"\n%s $?\"\n" % (command, sentinel)
+        try:
+            self.process.stdin.write(script.encode('utf-8'))
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise ShellCommandNotSentException("failed to write to shell session: %s" % e)
+
+        deadline = time.monotonic() + timeout
+        output = []
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ShellCommandLostException("command timed out after %ds: %s" % (timeout, command))
+            try:
+                line = self.__lines.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if line is None:
+                raise ShellCommandLostException("shell session exited while running: %s" % command)
+            line = line.decode('utf-8', errors='replace').rstrip("\r\n")
+            if line.startswith(sentinel):
+                exit_code = int(line[len(sentinel):].strip() or 0)
+                break
+            output.append(line)
+        self.command_count += 1
+        # The sentinel is preceded by an extra line break
+        if output and output[-1] == "":
+            output.pop()
+        return exit_code, "\n".join(output)
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self.process.stdin.write(b"exit\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=1)
+            except Exception:
+                self.process.kill()
+
+
+class ShellSessionPool(object):
+    """
+    a bounded pool of `adb shell` sessions of one device, sessions are created on demand and respawned if broken
+    """
+
+    def __init__(self, cmd_prefix, size=SHELL_POOL_SIZE):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cmd_prefix = cmd_prefix
+        self.size = size
+        self.lock = threading.Lock()
+        self.__idle_sessions = queue.LifoQueue()
+        self.__session_count = 0
+        self.__semaphore = threading.BoundedSemaphore(size)
+        self.closed = False
+        self.command_count = 0
+        self.respawn_count = 0
+
+    def __acquire(self):
+        try:
+            session = self.__idle_sessions.get_nowait()
+            if session.is_alive():
+                return session
+            self.__discard(session)
+        except queue.Empty:
+            pass
+        session = ShellSession(self.cmd_prefix)
+        with self.lock:
+            self.__session_count += 1
+        return session
+
+    def __discard(self, session):
+        session.close()
+        with self.lock:
+            self.__session_count -= 1
+            self.respawn_count += 1
+
+    def execute(self, command, timeout=SHELL_CMD_TIMEOUT):
+        """
+        run a command in an idle session
+        :param command: shell command line
+        :param timeout: max time to wait for the command to finish (seconds)
+        :return: (exit code, output)
+        """
+        if self.closed:
+            raise ShellCommandNotSentException("shell session pool is closed")
+        with self.__semaphore:
+            try:
+                session = self.__acquire()
+            except OSError as e:
+                raise ShellCommandNotSentException("failed to start a shell session: %s" % e)
+            try:
+                result = session.execute(command, timeout)
+            except ShellSessionException:
+                # The session may be blocked or dead, a new one is spawned for the next command
+                self.__discard(session)
+                raise
+            self.__idle_sessions.put(session)
+            with self.lock:
+                self.command_count += 1
+            return result
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                session = self.__idle_sessions.get_nowait()
+            except queue.Empty:
+                break
+            session.close()
+
+    def get_stats(self):
+        return {
+            "sessions": self.__session_count,
+            "commands": self.command_count,
+            "respawns": self.respawn_count
+        }
+
+
+def benchmark(serial=None, command="getprop ro.build.version.sdk", count=50):
+    """
+    Compare the latency of a shell command run by spawning `adb` and through the session pool
+    :param serial: device serial, the default device if None
+    :param command: shell command to run
+    :param count: number of runs
+    """
+    cmd_prefix = ["adb"] if serial is None else ["adb", "-s", serial]
+
+    start = time.time()
+    for _ in range(count):
+        subprocess.check_output(cmd_prefix + ["shell", command])
+    spawn_time = time.time() - start
+
+    pool = ShellSessionPool(cmd_prefix)
+    # The first command includes the session start-up
+    pool.execute(command)
+    start = time.time()
+    for _ in range(count):
+        pool.execute(command)
+    pool_time = time.time() - start
+    pool.close()
+
+    print("command: %s" % command)
+    print("adb process per command: %.1f ms/command" % (spawn_time * 1000 / count))
+    print("shell session pool:      %.1f ms/command" % (pool_time * 1000 / count))
+
+
+if __name__ == "__main__":
+    import sys
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -1,5 +1,12 @@
-# The hash algorithm is copied from:
+# The hash algorithm is adapted from:
 # https://github.com/hjaurum/DHash/blob/master/dHash.py
+# A dhash of size n is the n*n bits telling whether each pixel of the image, resized to (n+1)*n in grayscale, is
+# brighter than its right neighbour, packed into an int.
+
+# Default dhash size, giving 256-bit hashes
+DHASH_SIZE = 16
+# Cell size (pixels of the resized screenshot) of the grid indexing the rectangles in find_views
+RECT_GRID_CELL_SIZE = 32
 
 
 def _intersect(rect1, rect2):
@@ -23,6 +30,53 @@ def _intersect(rect1, rect2):
     return x_intersect and y_intersect
 
 
+class _RectangleGrid(object):
+    """
+    a uniform grid indexing rectangles by the cells they cover, to find the intersecting ones without
+    comparing every pair
+    """
+
+    def __init__(self, cell_size=RECT_GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        # rectangles by insertion sequence, removed ones are deleted from here and skipped in the cells
+        self.rectangles = {}
+        self.sequence = 0
+
+    def __get_cells(self, rect):
+        x, y, w, h = rect[:4]
+        cell_size = self.cell_size
+        # _intersect treats a rectangle as the pixels [x, x+w) * [y, y+h)
+        for cell_x in range(x // cell_size, (x + max(w, 1) - 1) // cell_size + 1):
+            for cell_y in range(y // cell_size, (y + max(h, 1) - 1) // cell_size + 1):
+                yield cell_x, cell_y
+
+    def add(self, rect):
+        key = self.sequence
+        self.sequence += 1
+        self.rectangles[key] = rect
+        for cell in self.__get_cells(rect):
+            self.cells.setdefault(cell, []).append(key)
+
+    def remove(self, key):
+        del self.rectangles[key]
+
+    def get_intersecting(self, rect):
+        """
+        :return: list of (key, rectangle) intersecting rect, in insertion order
+        """
+        keys = set()
+        for cell in self.__get_cells(rect):
+            cell_keys = self.cells.get(cell)
+            if cell_keys:
+                keys.update(cell_keys)
+        return [(key, self.rectangles[key]) for key in sorted(keys)
+                if key in self.rectangles and _intersect(rect, self.rectangles[key])]
+
+    def get_rectangles(self):
+        return list(self.rectangles.values())
+
+
 def load_image_from_path(img_path):
     """
     Load an image from path
@@ -41,7 +95,8 @@ def load_image_from_buf(img_bytes):
     """
     import cv2
     import numpy
-    img_bytes = numpy.array(img_bytes)
+    # A view on the bytes, no copy
+    img_bytes = numpy.frombuffer(img_bytes, dtype=numpy.uint8)
     return cv2.imdecode(img_bytes, cv2.IMREAD_UNCHANGED)
 
 
@@ -71,7 +126,7 @@ def find_views(img):
     edges = blue_edges | green_edges | red_edges
     # find contour
     contours, hierarchy = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-    rectangle_list = []
+    rectangle_grid = _RectangleGrid()
     for index, cnt in enumerate(contours):
         contour_area = cv2.contourArea(cnt)
         # area constraint
@@ -84,20 +139,16 @@ def find_views(img):
         if len(approx) == 2:
             continue
         new_rectangle = (x, y, w, h, len(approx))
+        # Drop the intersecting rectangles with more corners, up to the first one with fewer corners
         should_append = True
-        remove_list = []
-        for index, rectangle in enumerate(rectangle_list):
-            if _intersect(new_rectangle, rectangle):
-                if new_rectangle[4] > rectangle[4]:
-                    should_append = False
-                    break
-                else:
-                    remove_list.append(index)
-        remove_list.reverse()
-        for index in remove_list:
-            del rectangle_list[index]
+        for key, rectangle in rectangle_grid.get_intersecting(new_rectangle):
+            if new_rectangle[4] > rectangle[4]:
+                should_append = False
+                break
+            rectangle_grid.remove(key)
         if should_append:
-            rectangle_list.append(new_rectangle)
+            rectangle_grid.add(new_rectangle)
+    rectangle_list = rectangle_grid.get_rectangles()
 
     result_rectangles = [
         (int(float(x)/x_scale), int(float(y)/y_scale), int(float(w)/x_scale), int(float(h)/y_scale))
@@ -114,75 +165,172 @@ def find_views(img):
     return result_rectangles
 
 
-def calculate_dhash(img):
+def calculate_dhash(img, hash_size=DHASH_SIZE, rgb=False):
     """
     Calculate the dhash value of an image.
     :param img: numpy.ndarray, representing an image in opencv
-    :return:
+    :param hash_size: the hash has hash_size*hash_size bits, 16 for 256 bits or 8 for 64 bits
+    :param rgb: whether the channels are in RGB(A) order, as in PIL, instead of BGR(A) as in opencv
+    :return: int, the dhash
+    """
+    import numpy
+    difference = _calculate_pixel_difference(img, hash_size, rgb)
+    return int.from_bytes(numpy.packbits(difference).tobytes(), "big")
+
+
+def dhash_to_hex(dhash, hash_size=DHASH_SIZE):
     """
-    difference = _calculate_pixel_difference(img)
-    # convert to hex
-    decimal_value = 0
-    hash_string = ""
-    for index, value in enumerate(difference):
-        if value:
-            decimal_value += value * (2 ** (index % 8))
-        if index % 8 == 7:  # every eight binary bit to one hex number
-            hash_string += str(hex(decimal_value)[2:-1].rjust(2, "0"))  # 0xf=>0x0f
-            decimal_value = 0
-    return hash_string
+    Format a dhash as a fixed-width hex string
+    """
+    return format(dhash, "0%dx" % (hash_size * hash_size // 4))
 
 
-def _calculate_pixel_difference(img):
+def _calculate_pixel_difference(img, hash_size=DHASH_SIZE, rgb=False):
     """
     Calculate difference between pixels
     :param img: numpy.ndarray, representing an image in opencv
+    :param rgb: whether the channels are in RGB(A) order instead of BGR(A)
+    :return: numpy.ndarray of hash_size*hash_size bools
     """
     import cv2
-    resize_width = 18
-    resize_height = 16
-    # 1. resize to 18*16
-    smaller_image = cv2.resize(img, (resize_width, resize_height))
+    # 1. calculate grayscale, the red and blue weights differ so the channel order matters
+    if img.ndim == 3:
+        if rgb:
+            img = cv2.cvtColor(img, cv2.COLOR_RGBA2GRAY if img.shape[2] == 4 else cv2.COLOR_RGB2GRAY)
+        else:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
 
-    # 2. calculate grayscale
-    grayscale_image = cv2.cvtColor(smaller_image, cv2.COLOR_BGR2GRAY)
+    # 2. resize to (hash_size+1)*hash_size
+    smaller_image = cv2.resize(img, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
 
     # 3. calculate difference between pixels
-    difference = []
-    for row in range(resize_height):
-        for col in range(resize_width - 1):
-            difference.append(grayscale_image[row][col] > grayscale_image[row][col + 1])
-    return difference
+    return (smaller_image[:, :-1] > smaller_image[:, 1:]).ravel()
+
+
+if hasattr(int, "bit_count"):
+    def popcount(value):
+        """
+        :return: int, number of set bits of a non-negative int
+        """
+        return value.bit_count()
+else:
+    # int.bit_count is new in Python 3.10
+    def popcount(value):
+        return bin(value).count("1")
 
 
 def img_hamming_distance(img1, img2):
     """
     Calculate the hamming distance between two images
-    :param img1: numpy.ndarray, representing an image in opencv
-    :param img2: numpy.ndarray, representing an image in opencv
+    :param img1: numpy.ndarray, representing an image in opencv, or its dhash
+    :param img2: numpy.ndarray, representing an image in opencv, or its dhash
     :return: int, the hamming distance between two images
     """
-    # A. use dHash value to calculate hamming distance
-    if isinstance(img1, str) and isinstance(img2, str):
-        return dhash_hamming_distance(img1, img2)
-
-    # B. use numpy.ndarray to calculate hamming distance
-    _hamming_distance = 0
-    image1_difference = _calculate_pixel_difference(img1)
-    image2_difference = _calculate_pixel_difference(img2)
-    for index, img1_pix in enumerate(image1_difference):
-        img2_pix = image2_difference[index]
-        if img1_pix != img2_pix:
-            _hamming_distance += 1
-    return _hamming_distance
+    if not isinstance(img1, (int, str)):
+        img1 = calculate_dhash(img1)
+    if not isinstance(img2, (int, str)):
+        img2 = calculate_dhash(img2)
+    return dhash_hamming_distance(img1, img2)
 
 
 def dhash_hamming_distance(dhash1, dhash2):
     """
     Calculate the hamming distance between two dhash values
-    :param dhash1: str, the dhash of an image returned by `calculate_dhash`
-    :param dhash2: str, the dhash of an image returned by `calculate_dhash`
+    :param dhash1: int, the dhash of an image returned by `calculate_dhash`, or its hex string
+    :param dhash2: int, the dhash of an image returned by `calculate_dhash`, or its hex string
     :return: int, the hamming distance between two dhash values
     """
-    difference = (int(dhash1, 16)) ^ (int(dhash2, 16))
-    return bin(difference).count("1")
+    if isinstance(dhash1, str):
+        dhash1 = int(dhash1, 16)
+    if isinstance(dhash2, str):
+        dhash2 = int(dhash2, 16)
+    return popcount(dhash1 ^ dhash2)
+
+
+def benchmark(img_paths, rounds=5):
+    """
+    Compare the former find_views and dhash (nested loop de-overlap, per-pixel difference) with the current ones
+    on stored screenshots, e.g. the screenshots of an output directory
+    :param img_paths: paths to screenshots
+    :param rounds: number of runs per screenshot
+    """
+    import time
+    import cv2
+
+    def legacy_find_views(img):
+        x_scale = y_scale = 0.3
+        img = cv2.resize(img, (0, 0), fx=x_scale, fy=y_scale)
+        area = len(img) * len(img[0])
+        blue, green, red = cv2.split(img)
+        edges = cv2.Canny(blue, 200, 250) | cv2.Canny(green, 200, 250) | cv2.Canny(red, 200, 250)
+        contours, hierarchy = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+        rectangle_list = []
+        for cnt in contours:
+            contour_area = cv2.contourArea(cnt)
+            if contour_area < area / 300 or contour_area > area / 4:
+                continue
+            x, y, w, h = cv2.boundingRect(cnt)
+            approx = cv2.approxPolyDP(cnt, 0.01 * cv2.arcLength(cnt, True), True)
+            if len(approx) == 2:
+                continue
+            new_rectangle = (x, y, w, h, len(approx))
+            should_append = True
+            remove_list = []
+            for index, rectangle in enumerate(rectangle_list):
+                if _intersect(new_rectangle, rectangle):
+                    if new_rectangle[4] > rectangle[4]:
+                        should_append = False
+                        break
+                    else:
+                        remove_list.append(index)
+            remove_list.reverse()
+            for index in remove_list:
+                del rectangle_list[index]
+            if should_append:
+                rectangle_list.append(new_rectangle)
+        return [(int(float(x) / x_scale), int(float(y) / y_scale), int(float(w) / x_scale), int(float(h) / y_scale))
+                for x, y, w, h, len_approx in rectangle_list]
+
+    def legacy_dhash(img):
+        grayscale_image = cv2.cvtColor(cv2.resize(img, (18, 16)), cv2.COLOR_BGR2GRAY)
+        difference = []
+        for row in range(16):
+            for col in range(17):
+                difference.append(grayscale_image[row][col] > grayscale_image[row][col + 1])
+        decimal_value = 0
+        hash_string = ""
+        for index, value in enumerate(difference):
+            if value:
+                decimal_value += value * (2 ** (index % 8))
+            if index % 8 == 7:
+                hash_string += str(hex(decimal_value)[2:-1].rjust(2, "0"))
+                decimal_value = 0
+        return hash_string
+
+    def run(find, dhash, img):
+        rectangles = find(img)
+        return rectangles, [dhash(img[y:y + h, x:x + w]) for x, y, w, h in rectangles]
+
+    for img_path in img_paths:
+        img = load_image_from_path(img_path)
+        if img is None:
+            print("%s: cannot be loaded" % img_path)
+            continue
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        start = time.time()
+        for _ in range(rounds):
+            legacy_rectangles, legacy_hashes = run(legacy_find_views, legacy_dhash, img)
+        legacy_time = (time.time() - start) / rounds
+        start = time.time()
+        for _ in range(rounds):
+            rectangles, hashes = run(find_views, calculate_dhash, img)
+        current_time = (time.time() - start) / rounds
+        assert rectangles == legacy_rectangles
+        print("%s: %d views, former %.1f ms, current %.1f ms" %
+              (img_path, len(rectangles), legacy_time * 1000, current_time * 1000))
+
+
+if __name__ == "__main__":
+    import sys
+    benchmark(sys.argv[1:])
@@ -1,9 +1,9 @@
 import logging
 import socket
-import subprocess
 import time
 import json
 import struct
+import threading
 import traceback
 from .adapter import Adapter
 
@@ -11,8 +11,14 @@ DROIDBOT_APP_REMOTE_ADDR = "tcp:7336"
 DROIDBOT_APP_PACKAGE = "io.github.ylimit.droidbotapp"
 DROIDBOT_APP_PACKET_HEAD_LEN = 6
 ACCESSIBILITY_SERVICE = DROIDBOT_APP_PACKAGE + "/io.github.privacystreams.accessibility.PSAccessibilityService"
-MAX_NUM_GET_VIEWS = 5
-GET_VIEW_WAIT_TIME = 1
+ACC_EVENT_PREFIX = b"AccEvent >>> "
+ROTATION_PREFIX = b"rotation >>> "
+# Initial size of the receive buffer, grown for larger messages
+RECV_BUF_SIZE = 1024 * 1024
+# Max time to wait for the first accessibility event (seconds)
+GET_VIEWS_TIMEOUT = 5
+# Max time to wait for an accessibility event newer than the requested one (seconds)
+GET_FRESH_VIEWS_TIMEOUT = 0.5
 
 
 class DroidBotAppConnException(Exception):
@@ -52,6 +58,17 @@ class DroidBotAppConn(Adapter):
 
         self.sock = None
         self.last_acc_event = None
+        # time.monotonic() of the last accessibility event
+        self.last_acc_event_time = None
+        # sequence number of the last accessibility event, increased by the listener thread
+        self.acc_event_seq = 0
+        self.acc_event_condition = threading.Condition()
+        self.view_list_lock = threading.Lock()
+        # reusable buffer the messages are received into
+        self.recv_buf = bytearray(RECV_BUF_SIZE)
+        # if set, every received message is saved to this directory, e.g. for benchmark()
+        self.message_dump_dir = None
+        self.message_count = 0
         self.enable_accessibility_hard = device.enable_accessibility_hard
         self.ignore_ad = device.ignore_ad
         if self.ignore_ad:
@@ -102,9 +119,7 @@ class DroidBotAppConn(Adapter):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             # forward host port to remote port
-            serial_cmd = "" if self.device is None else "-s " + self.device.serial
-            forward_cmd = "adb %s forward tcp:%d %s" % (serial_cmd, self.port, DROIDBOT_APP_REMOTE_ADDR)
-            subprocess.check_call(forward_cmd.split())
+            self.device.adb.forward("tcp:%d" % self.port, DROIDBOT_APP_REMOTE_ADDR)
             self.sock.connect((self.host, self.port))
             import threading
             listen_thread = threading.Thread(target=self.listen_messages)
@@ -114,21 +129,27 @@ class DroidBotAppConn(Adapter):
             traceback.print_exc()
             raise DroidBotAppConnException()
 
-    def sock_read(self, rest_len):
-        buf = None
-        while rest_len:
-            pkt = self.sock.recv(rest_len)
-            if not pkt:
+    def sock_read_into(self, length):
+        """
+        receive a given number of bytes into the reusable receive buffer
+        :return: memoryview of the received bytes, valid until the next read
+        """
+        if len(self.recv_buf) < length:
+            self.recv_buf = bytearray(max(length, len(self.recv_buf) * 2))
+        view = memoryview(self.recv_buf)[:length]
+        received = 0
+        while received < length:
+            n = self.sock.recv_into(view[received:], length - received)
+            if n == 0:
                 raise EOF()
-            if not buf:
-                buf = pkt
-            else:
-                buf += pkt
-            rest_len -= len(pkt)
-        return buf
+            received += n
+        return view
+
+    def sock_read(self, rest_len):
+        return bytes(self.sock_read_into(rest_len))
 
     def read_head(self):
-        header = self.sock_read(DROIDBOT_APP_PACKET_HEAD_LEN)
+        header = self.sock_read_into(DROIDBOT_APP_PACKET_HEAD_LEN)
         data = struct.unpack(">BBI", header)
         return data
 
@@ -138,39 +159,62 @@ class DroidBotAppConn(Adapter):
         try:
             while self.connected:
                 _, _, message_len = self.read_head()
-                message = self.sock_read(message_len)
-                if not isinstance(message, str):
-                    message = message.decode()
-                self.handle_message(message)
+                self.sock_read_into(message_len)
+                self.message_count += 1
+                if self.message_dump_dir is not None:
+                    self.__dump_message(message_len)
+                self.__handle_buffer(self.recv_buf, message_len)
             print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
         except Exception:
             if self.check_connectivity():
                 traceback.print_exc()
                 # clear self.last_acc_event
                 self.logger.warning("Restarting droidbot app")
-                self.last_acc_event = None
+                with self.acc_event_condition:
+                    self.last_acc_event = None
                 self.disconnect()
                 self.connect()
 
     def handle_message(self, message):
-        acc_event_idx = message.find("AccEvent >>> ")
+        if isinstance(message, str):
+            message = message.encode()
+        self.__handle_buffer(message, len(message))
+
+    def __handle_buffer(self, buf, length):
+        """
+        handle a message held in the first length bytes of buf, without copying it
+        """
+        acc_event_idx = buf.find(ACC_EVENT_PREFIX, 0, length)
         if acc_event_idx >= 0:
             if acc_event_idx > 0:
-                self.logger.warning("Invalid data before packet head: " + message[:acc_event_idx])
-            body = json.loads(message[acc_event_idx + len("AccEvent >>> "):])
-            self.last_acc_event = body
+                self.logger.warning("Invalid data before packet head: %s" % bytes(buf[:acc_event_idx]))
+            # Decoded to str straight from the buffer
+            body = json.loads(str(memoryview(buf)[acc_event_idx + len(ACC_EVENT_PREFIX):length], 'utf-8'))
+            with self.acc_event_condition:
+                self.last_acc_event = body
+                self.last_acc_event_time = time.monotonic()
+                self.acc_event_seq += 1
+                self.acc_event_condition.notify_all()
             return
 
-        rotation_idx = message.find("rotation >>> ")
+        rotation_idx = buf.find(ROTATION_PREFIX, 0, length)
         if rotation_idx >= 0:
             if rotation_idx > 0:
-                self.logger.warning("Invalid data before packet head: " + message[:rotation_idx])
+                self.logger.warning("Invalid data before packet head: %s" % bytes(buf[:rotation_idx]))
             self.device.handle_rotation()
             return
 
-        self.logger.warning("Unhandled message from droidbot app: " + message)
+        self.logger.warning("Unhandled message from droidbot app: %s" % bytes(buf[:min(length, 200)]))
         raise DroidBotAppConnException()
 
+    def __dump_message(self, length):
+        import os
+        if not os.path.exists(self.message_dump_dir):
+            os.makedirs(self.message_dump_dir)
+        message_path = os.path.join(self.message_dump_dir, "message_%d.bin" % self.message_count)
+        with open(message_path, "wb") as f:
+            f.write(memoryview(self.recv_buf)[:length])
+
     def check_connectivity(self):
         """
         check if droidbot app is connected
@@ -189,66 +233,130 @@ class DroidBotAppConn(Adapter):
             except Exception as e:
                 print(e)
         try:
-            forward_remove_cmd = "adb -s %s forward --remove tcp:%d" % (self.device.serial, self.port)
-            p = subprocess.Popen(forward_remove_cmd.split(), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-            out, err = p.communicate()
+            self.device.adb.remove_forward("tcp:%d" % self.port)
         except Exception as e:
             print(e)
         self.__can_wait = False
 
-    def __view_tree_to_list(self, view_tree, view_list):
+    def view_tree_to_list(self, view_tree):
+        """
+        flatten a view tree into a list in pre-order, in one pass and in place:
+        the nodes become the views, their children are replaced by the temp_ids of the children
+        :param view_tree: root node of an accessibility event, not used afterwards
+        :return: list of views
+        """
+        view_list = []
+        view_tree['parent'] = -1
+        stack = [view_tree]
+        while stack:
+            view = stack.pop()
+            view_id = len(view_list)
+            view['temp_id'] = view_id
+            x1, y1, x2, y2 = view['bounds']
+            view['size'] = "%d*%d" % (x2 - x1, y2 - y1)
+            view['bounds'] = [[x1, y1], [x2, y2]]
+            view_list.append(view)
+            if view['parent'] != -1:
+                view_list[view['parent']]['children'].append(view_id)
+
+            children = view['children']
+            view['children'] = []
+            # Pushed in reverse, so that the first child and its subtree are visited next
+            for child in reversed(children):
+                if self.ignore_ad and child['resource_id'] is not None:
+                    id_word_list = self.__id_convert(child['resource_id']).split('_')
+                    if "ad" in id_word_list or \
+                       "banner" in id_word_list:
+                        continue
+                child['parent'] = view_id
+                stack.append(child)
+        return view_list
+
+    def get_views(self, min_seq=None, timeout=GET_FRESH_VIEWS_TIMEOUT):
+        """
+        get the views of the latest accessibility event
+        :param min_seq: if set, wait for an event newer than this sequence number, e.g. acc_event_seq before an
+                        input event was sent
+        :param timeout: max time to wait for the newer event (seconds), the latest one is used after that
+        :return: a list of views
+        """
+        with self.acc_event_condition:
+            if not self.acc_event_condition.wait_for(lambda: self.last_acc_event, GET_VIEWS_TIMEOUT):
+                self.logger.warning("cannot get non-None last_acc_event")
+                return None
+            if min_seq is not None and \
+                    not self.acc_event_condition.wait_for(lambda: self.acc_event_seq > min_seq, timeout):
+                self.logger.debug("no accessibility event after #%d, using the latest one" % min_seq)
+            acc_event = self.last_acc_event
+
+        with self.view_list_lock:
+            if 'view_list' not in acc_event:
+                # The tree is turned into the view list in place, so it is not kept
+                view_tree = acc_event.pop('root_node', None)
+                if not view_tree:
+                    return None
+                acc_event['view_list'] = self.view_tree_to_list(view_tree)
+            return acc_event['view_list']
+
+
+def benchmark(message_paths, rounds=10):
+    """
+    Compare the former message handling (decode, find, json.loads, deepcopy, recursive flattening) with the
+    current one, on messages saved by setting DroidBotAppConn.message_dump_dir
+    :param message_paths: paths to saved messages
+    :param rounds: number of runs per message
+    """
+    import copy
+
+    def legacy_tree_to_list(view_tree, view_list):
         tree_id = len(view_list)
         view_tree['temp_id'] = tree_id
-
-        bounds = [[-1, -1], [-1, -1]]
-        bounds[0][0] = view_tree['bounds'][0]
-        bounds[0][1] = view_tree['bounds'][1]
-        bounds[1][0] = view_tree['bounds'][2]
-        bounds[1][1] = view_tree['bounds'][3]
-        width = bounds[1][0] - bounds[0][0]
-        height = bounds[1][1] - bounds[0][1]
-        view_tree['size'] = "%d*%d" % (width, height)
+        bounds = [[view_tree['bounds'][0], view_tree['bounds'][1]], [view_tree['bounds'][2], view_tree['bounds'][3]]]
+        view_tree['size'] = "%d*%d" % (bounds[1][0] - bounds[0][0], bounds[1][1] - bounds[0][1])
         view_tree['bounds'] = bounds
-
         view_list.append(view_tree)
         children_ids = []
         for child_tree in view_tree['children']:
-            if self.ignore_ad and child_tree['resource_id'] is not None:
-                id_word_list = self.__id_convert(child_tree['resource_id']).split('_')
-                if "ad" in id_word_list or \
-                   "banner" in id_word_list:
-                    continue
             child_tree['parent'] = tree_id
-            self.__view_tree_to_list(child_tree, view_list)
+            legacy_tree_to_list(child_tree, view_list)
             children_ids.append(child_tree['temp_id'])
         view_tree['children'] = children_ids
 
-    def get_views(self):
-        get_views_times = 0
-        while not self.last_acc_event:
-            self.logger.warning("last_acc_event is None, waiting")
-            get_views_times += 1
-            if get_views_times > MAX_NUM_GET_VIEWS:
-                self.logger.warning("cannot get non-None last_acc_event")
-                return None
-            time.sleep(GET_VIEW_WAIT_TIME)
-
-        if 'view_list' in self.last_acc_event:
-            return self.last_acc_event['view_list']
-
-        import copy
-        view_tree = copy.deepcopy(self.last_acc_event['root_node'])
-        # print view_tree
-        if not view_tree:
-            return None
+    def legacy_parse(data):
+        message = bytes(data).decode()
+        idx = message.find("AccEvent >>> ")
+        body = json.loads(message[idx + len("AccEvent >>> "):])
+        view_tree = copy.deepcopy(body['root_node'])
         view_tree['parent'] = -1
         view_list = []
-        self.__view_tree_to_list(view_tree, view_list)
-        self.last_acc_event['view_list'] = view_list
+        legacy_tree_to_list(view_tree, view_list)
         return view_list
 
+    conn = DroidBotAppConn.__new__(DroidBotAppConn)
+    conn.ignore_ad = False
+    for message_path in message_paths:
+        with open(message_path, "rb") as f:
+            data = bytearray(f.read())
+        start = time.time()
+        for _ in range(rounds):
+            legacy_views = legacy_parse(data)
+        legacy_time = (time.time() - start) / rounds
+        start = time.time()
+        for _ in range(rounds):
+            idx = data.find(ACC_EVENT_PREFIX)
+            body = json.loads(str(memoryview(data)[idx + len(ACC_EVENT_PREFIX):], 'utf-8'))
+            views = conn.view_tree_to_list(body['root_node'])
+        current_time = (time.time() - start) / rounds
+        assert len(views) == len(legacy_views)
+        print("%s: %d bytes, %d views, former %.1f ms, current %.1f ms" %
+              (message_path, len(data), len(views), legacy_time * 1000, current_time * 1000))
+
 
 if __name__ == "__main__":
-    droidbot_app_conn = DroidBotAppConn()
-    droidbot_app_conn.set_up()
-    droidbot_app_conn.connect()
+    import sys
+    if len(sys.argv) > 1:
+        benchmark(sys.argv[1:])
+    else:
+        droidbot_app_conn = DroidBotAppConn()
+        droidbot_app_conn.set_up()
+        droidbot_app_conn.connect()
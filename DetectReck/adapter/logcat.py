@@ -1,7 +1,17 @@
 import subprocess
 import logging
-import copy
+import socket
+import threading
+import collections
 from .adapter import Adapter
+from .adb_client import AdbClientException
+
+# Max number of lines kept for get_recent_lines, older lines are dropped
+LOGCAT_BUFFER_LINES = 10000
+# Max number of bytes read from logcat at once
+LOGCAT_READ_SIZE = 64 * 1024
+# Buffer size of the logcat output file
+LOGCAT_FILE_BUFFER_SIZE = 256 * 1024
 
 
 class Logcat(Adapter):
@@ -21,58 +31,157 @@ class Logcat(Adapter):
         self.device = device
         self.connected = False
         self.process = None
+        # socket of the logcat stream of the adb server, the `adb logcat` process is only a fallback
+        self.sock = None
+        self.listen_thread = None
         self.parsers = []
-        self.recent_lines = []
+        self.lock = threading.Lock()
+        self.recent_lines = collections.deque(maxlen=LOGCAT_BUFFER_LINES)
+        self.dropped_line_count = 0
+        self.line_count = 0
+        # subscribers indexed by tag and by pid, called with the parsed lines of that tag or pid
+        self.tag_subscribers = {}
+        self.pid_subscribers = {}
         if device.output_dir is None:
             self.out_file = None
         else:
             self.out_file = "%s/logcat.txt" % device.output_dir
 
     def connect(self):
-        self.device.adb.run_cmd("logcat -c")
-        self.process = subprocess.Popen(["adb", "-s", self.device.serial, "logcat", "-v", "threadtime", "*:I"],
-                                        stdin=subprocess.PIPE,
-                                        stderr=subprocess.PIPE,
-                                        stdout=subprocess.PIPE)
-        import threading
-        listen_thread = threading.Thread(target=self.handle_output)
-        listen_thread.start()
+        client = self.device.adb.client
+        try:
+            client.shell("logcat -c")
+            # The filterspec is quoted, the command line is run by the device shell
+            self.sock = client.open_shell_stream("logcat -v threadtime '*:I'")
+        except AdbClientException as e:
+            self.logger.warning("adb server client failed, running `adb logcat` instead: %s" % e)
+            self.device.adb.run_cmd("logcat -c")
+            self.process = subprocess.Popen(["adb", "-s", self.device.serial, "logcat", "-v", "threadtime", "*:I"],
+                                            stdin=subprocess.PIPE,
+                                            stderr=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+        self.connected = True
+        self.listen_thread = threading.Thread(target=self.handle_output)
+        self.listen_thread.start()
 
     def disconnect(self):
         self.connected = False
+        if self.sock is not None:
+            try:
+                # Wakes up the listener blocked in recv
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
         if self.process is not None:
             self.process.terminate()
+        if self.listen_thread is not None and self.listen_thread is not threading.current_thread():
+            # Let the listener write out its buffered lines
+            self.listen_thread.join(timeout=5)
 
     def check_connectivity(self):
         return self.connected
 
     def get_recent_lines(self):
-        lines = self.recent_lines
-        self.recent_lines = []
+        """
+        :return: the lines received since the last call, at most LOGCAT_BUFFER_LINES
+        """
+        with self.lock:
+            lines = list(self.recent_lines)
+            self.recent_lines.clear()
         return lines
 
-    def handle_output(self):
-        self.connected = True
+    def subscribe(self, callback, tag=None, pid=None):
+        """
+        call back on the lines of a tag and/or a pid, parsed by utils.parse_log
+        :param callback: function taking the parsed line (dict)
+        :param tag: logcat tag, e.g. "ActivityManager"
+        :param pid: process id (str or int)
+        """
+        with self.lock:
+            if tag is not None:
+                self.tag_subscribers.setdefault(tag, []).append(callback)
+            if pid is not None:
+                self.pid_subscribers.setdefault(str(pid), []).append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            for subscribers in (self.tag_subscribers, self.pid_subscribers):
+                for key in list(subscribers):
+                    if callback in subscribers[key]:
+                        subscribers[key].remove(callback)
+                    if not subscribers[key]:
+                        del subscribers[key]
 
+    def handle_output(self):
         f = None
         if self.out_file is not None:
-            f = open(self.out_file, 'w', encoding='utf-8')
+            f = open(self.out_file, 'w', encoding='utf-8', buffering=LOGCAT_FILE_BUFFER_SIZE)
 
+        if self.sock is not None:
+            read = self.sock.recv
+        else:
+            read = self.process.stdout.read1
+        pending = b""
         while self.connected:
-            if self.process is None:
+            # Read whatever is available, up to LOGCAT_READ_SIZE, instead of one line at a time
+            try:
+                chunk = read(LOGCAT_READ_SIZE)
+            except (socket.error, ValueError):
+                break
+            if not chunk:
+                break
+            pending += chunk
+            end = pending.rfind(b"\n")
+            if end < 0:
                 continue
-            line = self.process.stdout.readline()
-            if not isinstance(line, str):
-                line = line.decode()
-            self.recent_lines.append(line)
-            self.parse_line(line)
+            # The shell service runs logcat in a terminal, which ends lines with CRLF
+            lines = pending[:end + 1].replace(b"\r\n", b"\n").decode(errors='replace').splitlines(True)
+            pending = pending[end + 1:]
+            self.handle_lines(lines)
             if f is not None:
-                f.write(line)
+                f.writelines(lines)
         if f is not None:
             f.close()
+        if self.sock is not None:
+            self.sock.close()
+        self.connected = False
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
+    def handle_lines(self, lines):
+        with self.lock:
+            dropped = len(self.recent_lines) + len(lines) - LOGCAT_BUFFER_LINES
+            if dropped > 0:
+                self.dropped_line_count += dropped
+            self.recent_lines.extend(lines)
+            self.line_count += len(lines)
+            has_subscribers = bool(self.tag_subscribers or self.pid_subscribers)
+        for line in lines:
+            self.parse_line(line)
+        if has_subscribers:
+            self.dispatch_lines(lines)
+
+    def dispatch_lines(self, lines):
+        from DetectReck.utils import parse_log
+        with self.lock:
+            tag_subscribers = {tag: list(callbacks) for tag, callbacks in self.tag_subscribers.items()}
+            pid_subscribers = {pid: list(callbacks) for pid, callbacks in self.pid_subscribers.items()}
+        for line in lines:
+            log_dict = parse_log(line)
+            if log_dict is None:
+                continue
+            callbacks = tag_subscribers.get(log_dict['tag'], []) + pid_subscribers.get(log_dict['pid'], [])
+            for callback in callbacks:
+                try:
+                    callback(log_dict)
+                except Exception as e:
+                    self.logger.warning("logcat subscriber failed: %s" % e)
+
     def parse_line(self, logcat_line):
         for parser in self.parsers:
             parser.parse(logcat_line)
 
+    def get_stats(self):
+        return {
+            "lines": self.line_count,
+            "dropped": self.dropped_line_count
+        }
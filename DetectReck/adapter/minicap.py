@@ -1,13 +1,25 @@
 import logging
 import socket
+import struct
 import subprocess
+import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime
 from .adapter import Adapter
+from .screen_change import ScreenChangeDetector
 
 
 MINICAP_REMOTE_ADDR = "localabstract:minicap"
 ROTATION_CHECK_INTERVAL_S = 1 # Check rotation once per second
+MINICAP_BANNER_FORMAT = "<BBIIIIIBB"
+MINICAP_BANNER_LEN = struct.calcsize(MINICAP_BANNER_FORMAT)
+# Number of frame buffers, frames being read by get_views/take_screenshot are not overwritten
+MINICAP_FRAME_SLOTS = 4
+# Initial size of a frame buffer, grown when a larger frame arrives
+MINICAP_FRAME_SLOT_SIZE = 512 * 1024
+# Window over which the frame rate is computed (seconds)
+FPS_WINDOW_S = 1
 
 
 class MinicapException(Exception):
@@ -17,6 +29,97 @@ class MinicapException(Exception):
     pass
 
 
+class FrameSlot(object):
+    """
+    a reusable buffer holding one frame
+    """
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.length = 0
+        self.readers = 0
+
+    def ensure_size(self, size):
+        if len(self.buf) < size:
+            self.buf = bytearray(max(size, len(self.buf) * 2))
+            self.view = memoryview(self.buf)
+
+
+class FrameRing(object):
+    """
+    a ring of preallocated frame buffers written by the minicap thread and read without copying
+    """
+
+    def __init__(self, slot_count=MINICAP_FRAME_SLOTS, slot_size=MINICAP_FRAME_SLOT_SIZE):
+        self.lock = threading.Lock()
+        self.slots = [FrameSlot(slot_size) for _ in range(slot_count)]
+        self.latest = None
+        self.__next_index = 0
+        self.frame_count = 0
+        self.dropped_count = 0
+        self.fps = 0.0
+        self.__fps_window_start = time.monotonic()
+        self.__fps_window_frames = 0
+
+    def get_write_slot(self, size):
+        """
+        get a slot to receive the next frame into
+        :param size: frame length
+        :return: FrameSlot, or None if all slots are being read
+        """
+        with self.lock:
+            for i in range(len(self.slots)):
+                slot = self.slots[(self.__next_index + i) % len(self.slots)]
+                if slot.readers == 0 and slot is not self.latest:
+                    self.__next_index = (self.__next_index + i + 1) % len(self.slots)
+                    break
+            else:
+                self.dropped_count += 1
+                return None
+        # Not being read and not the latest frame, so no reader can get it while it is filled
+        slot.ensure_size(size)
+        return slot
+
+    def publish(self, slot, length):
+        now = time.monotonic()
+        with self.lock:
+            slot.length = length
+            self.latest = slot
+            self.frame_count += 1
+            self.__fps_window_frames += 1
+            if now - self.__fps_window_start >= FPS_WINDOW_S:
+                self.fps = self.__fps_window_frames / (now - self.__fps_window_start)
+                self.__fps_window_start = now
+                self.__fps_window_frames = 0
+
+    @contextmanager
+    def read_latest(self):
+        """
+        read the latest frame, which is not overwritten until the block exits
+        :return: memoryview of the frame, or None if no frame was received
+        """
+        with self.lock:
+            slot = self.latest
+            if slot is not None:
+                slot.readers += 1
+        if slot is None:
+            yield None
+            return
+        try:
+            yield slot.view[:slot.length]
+        finally:
+            with self.lock:
+                slot.readers -= 1
+
+    def get_stats(self):
+        return {
+            "frames": self.frame_count,
+            "dropped": self.dropped_count,
+            "fps": self.fps
+        }
+
+
 class Minicap(Adapter):
     """
     a connection with target device through minicap.
@@ -46,8 +149,13 @@ class Minicap(Adapter):
         self.height = -1
         self.orientation = -1
 
-        self.last_screen = None
+        # the latest frames received, read without copying
+        self.frame_ring = FrameRing()
+        # tells whether the screen changed since the last state capture
+        self.change_detector = ScreenChangeDetector()
         self.last_screen_time = None
+        # time.monotonic() of the last frame, minicap only sends a frame when the screen changes
+        self.last_frame_time = None
         self.last_views = []
         self.last_rotation_check_time = datetime.now()
 
@@ -84,9 +192,7 @@ class Minicap(Adapter):
 
     def tear_down(self):
         try:
-            delete_minicap_cmd = "adb -s %s shell rm -r %s" % (self.device.serial, self.remote_minicap_path)
-            p = subprocess.Popen(delete_minicap_cmd.split(), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-            out, err = p.communicate()
+            self.device.adb.client.shell("rm -r %s" % self.remote_minicap_path)
         except Exception:
             pass
 
@@ -108,14 +214,14 @@ class Minicap(Adapter):
         self.orientation = o
 
         size_opt = "%dx%d@%dx%d/%d" % (w, h, w, h, o)
-        grant_minicap_perm_cmd = "adb -s %s shell chmod -R a+x %s" % \
-                                 (device.serial, self.remote_minicap_path)
         start_minicap_cmd = "adb -s %s shell LD_LIBRARY_PATH=%s %s/minicap -P %s" % \
                             (device.serial, self.remote_minicap_path, self.remote_minicap_path, size_opt)
         self.logger.debug("starting minicap: " + start_minicap_cmd)
 
-        p = subprocess.Popen(grant_minicap_perm_cmd.split(), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        out, err = p.communicate()
+        try:
+            device.adb.client.shell("chmod -R a+x %s" % self.remote_minicap_path)
+        except Exception as e:
+            self.logger.warning("Failed to grant minicap permission: %s" % e)
 
         self.minicap_process = subprocess.Popen(start_minicap_cmd.split(),
                                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
@@ -125,8 +231,7 @@ class Minicap(Adapter):
 
         try:
             # forward host port to remote port
-            forward_cmd = "adb -s %s forward tcp:%d %s" % (device.serial, self.port, MINICAP_REMOTE_ADDR)
-            subprocess.check_call(forward_cmd.split())
+            device.adb.forward("tcp:%d" % self.port, MINICAP_REMOTE_ADDR)
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.connect((self.host, self.port))
             import threading
@@ -137,89 +242,91 @@ class Minicap(Adapter):
             self.logger.warning(e)
             raise MinicapException()
 
+    def __recv_into(self, view):
+        """
+        fill a memoryview from the socket
+        :return: False if the connection is closed
+        """
+        received = 0
+        length = len(view)
+        while received < length:
+            n = self.sock.recv_into(view[received:], length - received)
+            if n == 0:
+                return False
+            received += n
+        return True
+
     def listen_messages(self):
         self.logger.debug("start listening minicap images ...")
-        CHUNK_SIZE = 4096
-
-        readBannerBytes = 0
-        bannerLength = 2
-        readFrameBytes = 0
-        frameBodyLength = 0
-        frameBody = bytearray()
-        banner = {
-            "version": 0,
-            "length": 0,
-            "pid": 0,
-            "realWidth": 0,
-            "realHeight": 0,
-            "virtualWidth": 0,
-            "virtualHeight": 0,
-            "orientation": 0,
-            "quirks": 0,
-        }
-
         self.connected = True
-        while self.connected:
-            chunk = bytearray(self.sock.recv(CHUNK_SIZE))
-            if not chunk:
-                continue
-            chunk_len = len(chunk)
-            cursor = 0
-            while cursor < chunk_len and self.connected:
-                if readBannerBytes < bannerLength:
-                    if readBannerBytes == 0:
-                        banner['version'] = chunk[cursor]
-                    elif readBannerBytes == 1:
-                        banner['length'] = bannerLength = chunk[cursor]
-                    elif 2 <= readBannerBytes <= 5:
-                        banner['pid'] += (chunk[cursor] << ((readBannerBytes - 2) * 8))
-                    elif 6 <= readBannerBytes <= 9:
-                        banner['realWidth'] += (chunk[cursor] << ((readBannerBytes - 6) * 8))
-                    elif 10 <= readBannerBytes <= 13:
-                        banner['realHeight'] += (chunk[cursor] << ((readBannerBytes - 10) * 8))
-                    elif 14 <= readBannerBytes <= 17:
-                        banner['virtualWidth'] += (chunk[cursor] << ((readBannerBytes - 14) * 8))
-                    elif 18 <= readBannerBytes <= 21:
-                        banner['virtualHeight'] += (chunk[cursor] << ((readBannerBytes - 18) * 8))
-                    elif readBannerBytes == 22:
-                        banner['orientation'] += chunk[cursor] * 90
-                    elif readBannerBytes == 23:
-                        banner['quirks'] = chunk[cursor]
-
-                    cursor += 1
-                    readBannerBytes += 1
-                    if readBannerBytes == bannerLength:
-                        self.banner = banner
-                        self.logger.debug("minicap initialized: %s" % banner)
-
-                elif readFrameBytes < 4:
-                    frameBodyLength += (chunk[cursor] << (readFrameBytes * 8))
-                    cursor += 1
-                    readFrameBytes += 1
-                else:
-                    if chunk_len - cursor >= frameBodyLength:
-                        frameBody += chunk[cursor: cursor + frameBodyLength]
-                        self.handle_image(frameBody)
-                        cursor += frameBodyLength
-                        frameBodyLength = readFrameBytes = 0
-                        frameBody = bytearray()
-                    else:
-                        frameBody += chunk[cursor:]
-                        frameBodyLength -= chunk_len - cursor
-                        readFrameBytes += chunk_len - cursor
-                        cursor = chunk_len
+        try:
+            # Banner: version, length, pid, real width/height, virtual width/height, orientation, quirks
+            banner_head = bytearray(2)
+            if not self.__recv_into(memoryview(banner_head)):
+                return
+            banner_buf = bytearray(max(banner_head[1], MINICAP_BANNER_LEN))
+            banner_buf[:2] = banner_head
+            if not self.__recv_into(memoryview(banner_buf)[2:banner_head[1]]):
+                return
+            (version, length, pid, real_width, real_height, virtual_width, virtual_height, orientation, quirks) = \
+                struct.unpack_from(MINICAP_BANNER_FORMAT, banner_buf)
+            self.banner = {
+                "version": version,
+                "length": length,
+                "pid": pid,
+                "realWidth": real_width,
+                "realHeight": real_height,
+                "virtualWidth": virtual_width,
+                "virtualHeight": virtual_height,
+                "orientation": orientation * 90,
+                "quirks": quirks,
+            }
+            self.logger.debug("minicap initialized: %s" % self.banner)
+
+            frame_head = bytearray(4)
+            frame_head_view = memoryview(frame_head)
+            while self.connected:
+                if not self.__recv_into(frame_head_view):
+                    break
+                (frame_length,) = struct.unpack_from("<I", frame_head)
+                slot = self.frame_ring.get_write_slot(frame_length)
+                if slot is None:
+                    # Every slot is being read, the frame is read into a scratch buffer and dropped
+                    scratch = bytearray(frame_length)
+                    if not self.__recv_into(memoryview(scratch)):
+                        break
+                    continue
+                if not self.__recv_into(slot.view[:frame_length]):
+                    break
+                self.frame_ring.publish(slot, frame_length)
+                self.handle_image(slot.view[:frame_length])
+        except socket.error as e:
+            if self.connected:
+                self.logger.warning("minicap connection error: %s" % e)
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
     def handle_image(self, frameBody):
         # Sanity check for JPG header, only here for debugging purposes.
         if frameBody[0] != 0xFF or frameBody[1] != 0xD8:
             self.logger.warning("Frame body does not start with JPG header")
-        self.last_screen = frameBody
         self.last_screen_time = datetime.now()
+        self.last_frame_time = time.monotonic()
         self.last_views = None
+        self.change_detector.on_frame(frameBody)
         self.logger.debug("Received an image at %s" % self.last_screen_time)
         self.check_rotation()
 
+    @property
+    def last_screen(self):
+        """
+        a copy of the latest frame (JPEG bytes), or None
+        """
+        with self.frame_ring.read_latest() as frame:
+            return bytes(frame) if frame is not None else None
+
+    def get_stats(self):
+        return self.frame_ring.get_stats()
+
     def check_rotation(self):
         current_time = datetime.now()
         if (current_time - self.last_rotation_check_time).total_seconds() < ROTATION_CHECK_INTERVAL_S:
@@ -259,9 +366,7 @@ class Minicap(Adapter):
             except Exception as e:
                 print(e)
         try:
-            forward_remove_cmd = "adb -s %s forward --remove tcp:%d" % (self.device.serial, self.port)
-            p = subprocess.Popen(forward_remove_cmd.split(), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-            out, err = p.communicate()
+            self.device.adb.remove_forward("tcp:%d" % self.port)
         except Exception as e:
             print(e)
 
@@ -271,14 +376,16 @@ class Minicap(Adapter):
         opencv-python need to be installed for this function
         :return: a list of views
         """
-        if not self.last_screen:
-            self.logger.warning("last_screen is None")
-            return None
         if self.last_views:
             return self.last_views
 
         from . import cv
-        img = cv.load_image_from_buf(self.last_screen)
+        # The frame is decoded in place, its slot is not overwritten meanwhile
+        with self.frame_ring.read_latest() as frame:
+            if frame is None:
+                self.logger.warning("last_screen is None")
+                return None
+            img = cv.load_image_from_buf(frame)
         view_bounds = cv.find_views(img)
         root_view = {
             "class": "CVViewRoot",
@@ -294,7 +401,7 @@ class Minicap(Adapter):
                 "bounds": [[x,y], [x+w, y+h]],
                 "enabled": True,
                 "temp_id": temp_id,
-                "signature": cv.calculate_dhash(img[y:y+h, x:x+w]),
+                "signature": cv.dhash_to_hex(cv.calculate_dhash(img[y:y+h, x:x+w])),
                 "parent": 0,
                 "children": []
             }
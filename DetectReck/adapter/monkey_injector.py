@@ -0,0 +1,208 @@
+# Input injection through a long-lived `monkey --port` process on the device.
+# `input tap/swipe/keyevent` starts a new app_process VM for every event, while monkey keeps one running and
+# accepts commands over TCP, see MonkeySourceNetwork in the Android sources:
+#   tap x y / touch down|move|up x y / press <keycode> / sleep <ms> / wake / quit
+# Each command is answered by a line "OK" or "ERROR[:message]".
+# While monkey runs, ActivityManager.isUserAMonkey() returns true, which apps may use to change their behaviour
+# (e.g. skip ads or red packets), so the injector is only enabled on request, see monkey_injection of DroidBot.
+import logging
+import socket
+import threading
+import time
+from .adapter import Adapter
+
+MONKEY_REMOTE_PORT = 1080
+# Max time to wait for monkey to start listening (seconds)
+MONKEY_START_TIMEOUT = 10
+MONKEY_SOCKET_TIMEOUT = 30
+# Interval between the touch moves of a drag (ms)
+DRAG_STEP_INTERVAL = 20
+
+
+class MonkeyInjectorException(Exception):
+    """
+    Exception in the monkey injection channel
+    """
+    pass
+
+
+class MonkeyInjector(Adapter):
+    """
+    a connection with the monkey network interface on the device, injecting touches and key presses
+    """
+
+    def __init__(self, device=None):
+        """
+        initiate a monkey injection channel
+        :param device: instance of Device
+        :return:
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.host = "localhost"
+
+        if device is None:
+            from DetectReck.device import Device
+            device = Device()
+        self.device = device
+        self.port = self.device.get_random_port()
+
+        self.monkey_stream = None
+        self.sock = None
+        self.sock_file = None
+        self.lock = threading.Lock()
+        self.connected = False
+        self.command_count = 0
+        self.injection_count = 0
+        self.injection_time = 0
+
+    def connect(self):
+        try:
+            # The shell stream keeps monkey running until it is closed
+            self.monkey_stream = self.device.adb.client.open_shell_stream("monkey --port %d" % MONKEY_REMOTE_PORT)
+            self.device.adb.forward("tcp:%d" % self.port, "tcp:%d" % MONKEY_REMOTE_PORT)
+        except Exception as e:
+            self.logger.warning("Failed to start monkey: %s" % e)
+            self.disconnect()
+            return
+
+        # The forward accepts connections before monkey listens, so wait until monkey answers
+        deadline = time.time() + MONKEY_START_TIMEOUT
+        while time.time() < deadline:
+            try:
+                self.sock = socket.create_connection((self.host, self.port), MONKEY_SOCKET_TIMEOUT)
+                self.sock_file = self.sock.makefile("rb")
+                self.connected = True
+                self.__send_commands(["wake"])
+                print("[CONNECTION] %s is connected" % self.__class__.__name__)
+                return
+            except (socket.error, MonkeyInjectorException):
+                self.__close_sock()
+                time.sleep(0.5)
+        self.logger.warning("monkey did not start listening on port %d" % MONKEY_REMOTE_PORT)
+        self.disconnect()
+
+    def __close_sock(self):
+        self.connected = False
+        for closable in [self.sock_file, self.sock]:
+            if closable is not None:
+                try:
+                    closable.close()
+                except Exception:
+                    pass
+        self.sock_file = None
+        self.sock = None
+
+    def check_connectivity(self):
+        """
+        check if monkey is connected
+        :return: True for connected
+        """
+        return self.connected
+
+    def disconnect(self):
+        """
+        stop monkey and close the connection
+        """
+        if self.connected:
+            try:
+                self.__send_commands(["quit"])
+            except MonkeyInjectorException:
+                pass
+        self.__close_sock()
+        if self.monkey_stream is not None:
+            try:
+                self.monkey_stream.close()
+            except Exception as e:
+                print(e)
+            self.monkey_stream = None
+        try:
+            self.device.adb.remove_forward("tcp:%d" % self.port)
+        except Exception as e:
+            print(e)
+        if self.injection_count:
+            self.logger.debug("monkey injection: %d events, %.1f ms/event" %
+                              (self.injection_count, self.injection_time * 1000 / self.injection_count))
+
+    def __send_commands(self, commands):
+        """
+        send a batch of commands at once and read one response per command
+        """
+        with self.lock:
+            if not self.connected:
+                raise MonkeyInjectorException("monkey is not connected")
+            try:
+                self.sock.sendall(("\n".join(commands) + "\n").encode())
+                for command in commands:
+                    if command == "quit":
+                        continue
+                    response = self.sock_file.readline().decode(errors='replace').strip()
+                    if not response.startswith("OK"):
+                        raise MonkeyInjectorException("monkey failed to run `%s`: %s" % (command, response))
+            except socket.error as e:
+                self.__close_sock()
+                raise MonkeyInjectorException("monkey connection lost: %s" % e)
+            self.command_count += len(commands)
+
+    def __inject(self, commands):
+        start_time = time.time()
+        self.__send_commands(commands)
+        self.injection_count += 1
+        self.injection_time += time.time() - start_time
+
+    def tap(self, x, y):
+        self.__inject(["tap %d %d" % (x, y)])
+
+    def drag(self, start_xy, end_xy, duration):
+        """
+        touch down at start_xy, move to end_xy in duration ms and touch up
+        """
+        (x0, y0) = start_xy
+        (x1, y1) = end_xy
+        steps = max(int(duration / DRAG_STEP_INTERVAL), 1)
+        commands = ["touch down %d %d" % (x0, y0)]
+        for i in range(1, steps + 1):
+            commands.append("sleep %d" % DRAG_STEP_INTERVAL)
+            commands.append("touch move %d %d" % (x0 + (x1 - x0) * i / steps, y0 + (y1 - y0) * i / steps))
+        commands.append("touch up %d %d" % (x1, y1))
+        self.__inject(commands)
+
+    def press(self, key_code):
+        """
+        :param key_code: key code name (e.g. "BACK", "KEYCODE_HOME") or number
+        """
+        self.__inject(["press %s" % key_code])
+
+    def get_stats(self):
+        return {
+            "events": self.injection_count,
+            "commands": self.command_count,
+            "ms_per_event": self.injection_time * 1000 / self.injection_count if self.injection_count else 0
+        }
+
+
+def benchmark(device, count=20):
+    """
+    Compare the latency of `input keyevent` and the monkey channel, pressing KEYCODE_UNKNOWN which does nothing
+    :param device: a connected Device
+    :param count: number of key presses
+    """
+    start = time.time()
+    for _ in range(count):
+        device.adb.shell("input keyevent 0")
+    input_time = time.time() - start
+
+    injector = device.monkey_injector
+    if not injector.connected:
+        injector.connect()
+    start = time.time()
+    for _ in range(count):
+        injector.press(0)
+    monkey_time = time.time() - start
+
+    print("input keyevent: %.1f ms/event" % (input_time * 1000 / count))
+    print("monkey --port:  %.1f ms/event" % (monkey_time * 1000 / count))
+
+
+if __name__ == "__main__":
+    from DetectReck.device import Device
+    benchmark(Device())
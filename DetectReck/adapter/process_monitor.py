@@ -4,6 +4,9 @@ import time
 import subprocess
 from .adapter import Adapter
 
+# Interval between two updates of the process table (seconds)
+PROCESS_POLL_INTERVAL = 1
+
 
 class ProcessMonitor(Adapter):
     """
@@ -24,8 +27,13 @@ class ProcessMonitor(Adapter):
         self.pid2user = {}
         self.pid2ppid = {}
         self.pid2name = {}
+        self.name2pids = {}
         self.listeners = set()
         self.lock = threading.Lock()
+        # serializes the updates of the monitor thread and of pid_of
+        self.update_lock = threading.Lock()
+        self.ps_pid_filter = True
+        self.update_count = 0
 
     def add_state_listener(self, state_listener):
         """
@@ -62,44 +70,106 @@ class ProcessMonitor(Adapter):
 
     def maintain_process_mapping(self):
         """
-        maintain pid2user mapping, pid2ppid mapping and pid2name mapping by continuously calling ps command
+        maintain pid2user mapping, pid2ppid mapping and pid2name mapping by continuously polling the processes
         """
         while self.enabled:
-            if self.device is not None:
-                ps_cmd = ["adb", "-s", self.device.serial, "shell", "ps"]
-            else:
-                ps_cmd = ["adb", "shell", "ps"]
+            try:
+                self.update()
+            except Exception as e:
+                self.logger.warning("Failed to update the process table: %s" % e)
+            time.sleep(PROCESS_POLL_INTERVAL)
+        print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
+    def update(self):
+        """
+        update the process table from the pids listed in /proc: exited pids are evicted and only new pids are
+        looked up with ps, all through the persistent adb shell
+        """
+        with self.update_lock:
+            proc_out = self.device.adb.shell("ls /proc")
+            pids = set(name for name in proc_out.split() if name.isdigit())
+            with self.lock:
+                exited_pids = [pid for pid in self.pid2name if pid not in pids]
+                new_pids = [pid for pid in pids if pid not in self.pid2name]
+            processes = self.__get_processes(new_pids) if new_pids else []
+
+            with self.lock:
+                for pid in exited_pids:
+                    name = self.pid2name.pop(pid)
+                    self.pid2ppid.pop(pid, None)
+                    self.pid2user.pop(pid, None)
+                    name_pids = self.name2pids.get(name)
+                    if name_pids is not None:
+                        name_pids.discard(pid)
+                        if not name_pids:
+                            del self.name2pids[name]
+                for user, pid, ppid, name in processes:
+                    if pid in self.pid2name:
+                        continue
+                    self.pid2name[pid] = name
+                    self.pid2ppid[pid] = ppid
+                    self.pid2user[pid] = user
+                    self.name2pids.setdefault(name, set()).add(pid)
+                self.update_count += 1
+
+    def __get_processes(self, pids):
+        """
+        :return: list of (user, pid, ppid, name) of the given pids that are still running
+        """
+        if self.ps_pid_filter:
             try:
-                ps_out = subprocess.check_output(ps_cmd)
-                if not isinstance(ps_out, str):
-                    ps_out = ps_out.decode()
-            except subprocess.CalledProcessError:
+                ps_out = self.device.adb.shell(["ps", "-o", "USER,PID,PPID,NAME", "-p", ",".join(pids)])
+            except subprocess.CalledProcessError as e:
+                # ps exits with 1 when none of the pids is running any more
+                ps_out = e.output or ""
+            if not ps_out.strip():
+                return []
+            ps_out_head = ps_out.split("\n", 1)[0].split()
+            if ps_out_head != ["USER", "PID", "PPID", "NAME"]:
+                # ps of Android < 8.0 lists all processes and has no -o or -p
+                self.logger.info("ps does not filter by pid, using the full process list")
+                self.ps_pid_filter = False
+        if not self.ps_pid_filter:
+            ps_out = self.device.adb.shell("ps")
+
+        # parse ps_out to get the uid and name of the processes
+        ps_out_lines = ps_out.splitlines()
+        ps_out_head = ps_out_lines[0].split() if ps_out_lines else []
+        if len(ps_out_head) < 3 or ps_out_head[0] != "USER" or ps_out_head[1] != "PID" \
+                or ps_out_head[2] != "PPID" or ps_out_head[-1] != "NAME":
+            self.logger.warning("ps command output format error: %s" % ps_out_head)
+
+        pids = set(pids)
+        processes = []
+        for ps_out_line in ps_out_lines[1:]:
+            segs = ps_out_line.split()
+            if len(segs) < 4 or segs[1] not in pids:
                 continue
+            processes.append((segs[0], segs[1], segs[2], segs[-1]))
+        return processes
 
-            # parse ps_out to update self.pid2uid mapping and self.pid2name mapping
-            ps_out_lines = ps_out.splitlines()
-            ps_out_head = ps_out_lines[0].split()
-            if ps_out_head[0] != "USER" or ps_out_head[1] != "PID" \
-                    or ps_out_head[2] != "PPID" or ps_out_head[-1] != "NAME":
-                self.device.logger.warning("ps command output format error: %s" % ps_out_head)
-
-            for ps_out_line in ps_out_lines[1:]:
-                segs = ps_out_line.split()
-                if len(segs) < 4:
-                    continue
-                user = segs[0]
-                pid = segs[1]
-                ppid = segs[2]
-                name = segs[-1]
-                self.lock.acquire()
-                self.pid2name[pid] = name
-                self.pid2ppid[pid] = ppid
-                self.pid2user[pid] = user
-                self.lock.release()
-
-            time.sleep(1)
-        print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
+    def pid_of(self, package):
+        """
+        get the pid of an app: the process named after the package, otherwise the lowest pid of its other
+        processes (e.g. package:remote)
+        the process table is updated first, so that exited and restarted processes are not returned
+        :param package: package name
+        :return: pid (int), or None if the app is not running
+        """
+        # Only `ls /proc` and ps of the new pids, through the persistent shell
+        self.update()
+        return self.__lookup_pid(package)
+
+    def __lookup_pid(self, package):
+        with self.lock:
+            if package in self.name2pids:
+                # The newest process, as the last line of the former ps listing
+                return max(int(pid) for pid in self.name2pids[package])
+            possible_pids = [int(pid) for name, pids in self.name2pids.items()
+                             if name.startswith(package) for pid in pids]
+        if len(possible_pids) > 0:
+            return min(possible_pids)
+        return None
 
     def get_ppids_by_pid(self, pid):
         """
@@ -125,7 +195,9 @@ class ProcessMonitor(Adapter):
         names = []
         self.lock.acquire()
         for ppid in ppids:
-            names.append(self.pid2name[ppid])
+            # Skip the processes evicted since get_ppids_by_pid
+            if ppid in self.pid2name:
+                names.append(self.pid2name[ppid])
         self.lock.release()
 
         return names
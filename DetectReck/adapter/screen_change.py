@@ -0,0 +1,116 @@
+# Screen change detection on the minicap stream.
+# Every frame is decoded at 1/8 scale in grayscale and reduced to a 64-bit difference hash (dhash); two frames
+# whose hashes differ in more than a few bits show a different screen. This tells whether the screen changed since
+# the last state capture and when it last changed, without capturing a state.
+import logging
+import threading
+import time
+
+import numpy
+
+from .cv import popcount
+
+# Max number of differing dhash bits between two frames showing the same screen (JPEG noise, blinking cursors)
+SCREEN_CHANGE_THRESHOLD = 3
+# Time without screen change after which the screen is stable (seconds)
+SCREEN_STABLE_PERIOD = 0.5
+DHASH_SIZE = 8
+
+
+def frame_dhash(frame):
+    """
+    compute the 64-bit dhash of a JPEG frame
+    :param frame: JPEG bytes (bytes, bytearray or memoryview)
+    :return: int, or None if the frame cannot be decoded
+    """
+    import cv2
+    img = cv2.imdecode(numpy.frombuffer(frame, dtype=numpy.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if img is None:
+        return None
+    small = cv2.resize(img, (DHASH_SIZE + 1, DHASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(numpy.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(hash1, hash2):
+    return popcount(hash1 ^ hash2)
+
+
+class ScreenChangeDetector(object):
+    """
+    tracks screen changes from the frames of minicap
+    """
+
+    def __init__(self, threshold=SCREEN_CHANGE_THRESHOLD):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.threshold = threshold
+        self.condition = threading.Condition()
+        self.enabled = True
+        self.current_hash = None
+        # hash of the screen when the last state was captured
+        self.captured_hash = None
+        # time.monotonic() of the last frame showing a different screen than the previous one
+        self.last_change_time = None
+        self.change_count = 0
+        self.frame_count = 0
+
+    def on_frame(self, frame):
+        """
+        process a new frame, called by the minicap thread
+        :param frame: JPEG bytes or memoryview
+        """
+        if not self.enabled:
+            return
+        try:
+            frame_hash = frame_dhash(frame)
+        except ImportError:
+            self.logger.warning("opencv-python is not installed, screen change detection disabled")
+            self.enabled = False
+            return
+        if frame_hash is None:
+            return
+        with self.condition:
+            self.frame_count += 1
+            if self.current_hash is None or hamming_distance(frame_hash, self.current_hash) > self.threshold:
+                self.last_change_time = time.monotonic()
+                self.change_count += 1
+                self.condition.notify_all()
+            self.current_hash = frame_hash
+
+    def mark_captured(self):
+        """
+        remember the current screen as the one of the last captured state
+        """
+        with self.condition:
+            self.captured_hash = self.current_hash
+
+    def is_changed_since_capture(self):
+        """
+        :return: True if the screen changed since mark_captured, or if it cannot be told
+        """
+        with self.condition:
+            if not self.enabled or self.current_hash is None or self.captured_hash is None:
+                return True
+            return hamming_distance(self.current_hash, self.captured_hash) > self.threshold
+
+    def is_stable(self, period=SCREEN_STABLE_PERIOD):
+        """
+        :return: True if the screen did not change for the period
+        """
+        with self.condition:
+            return self.last_change_time is not None and time.monotonic() - self.last_change_time >= period
+
+    def wait_for_change(self, timeout):
+        """
+        wait until the screen changes
+        :return: True if the screen changed within the timeout
+        """
+        with self.condition:
+            change_count = self.change_count
+            return self.condition.wait_for(lambda: self.change_count != change_count, timeout)
+
+    def get_stats(self):
+        return {
+            "frames": self.frame_count,
+            "changes": self.change_count
+        }
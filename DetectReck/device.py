@@ -1,23 +1,37 @@
+import collections
 import logging
 import os
 import re
 import subprocess
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from .adapter.adb import ADB
 from .adapter.droidbot_app import DroidBotAppConn
 from .adapter.logcat import Logcat
 from .adapter.minicap import Minicap
+from .adapter.monkey_injector import MonkeyInjector
 from .adapter.process_monitor import ProcessMonitor
 from .adapter.telnet import TelnetConsole
 from .adapter.user_input_monitor import UserInputMonitor
 from .adapter.droidbot_ime import DroidBotIme
 from .app import App
 from .intent import Intent
+from .popup_bus import PopupEventBus
+from .screenshot import Screenshot, ScreenshotWriter
+from .screen_index import ScreenIndex, SCREEN_INDEX_FILE
+from .state_abstraction import StateAbstraction
+from .ui_idle import UIIdleWaiter
+from .adapter.adb_client import AdbClientException
 
 DEFAULT_NUM = '1234567890'
 DEFAULT_CONTENT = 'Hello world!'
+# Number of threads capturing the parts of a state (views, activities, screenshot, services) concurrently
+CAPTURE_WORKERS = 4
+# Max number of nav bar detection results kept, see get_nav_bar
+NAV_BAR_CACHE_SIZE = 256
+ACTIVITY_LINE_RE = re.compile('\\* Hist #\\d+: ActivityRecord{[^ ]+ [^ ]+ ([^ ]+) t(\\d+)}')
 
 
 class Device(object):
@@ -27,11 +41,13 @@ class Device(object):
 
     def __init__(self, device_serial=None, is_emulator=False, output_dir=None,
                  cv_mode=False, grant_perm=False, telnet_auth_token=None,
-                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False):
+                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False, monkey_injection=False):
         """
         initialize a device connection
         :param device_serial: serial number of target device
         :param is_emulator: boolean, type of device, True for emulator, False for real device
+        :param monkey_injection: inject touches and keys through `monkey --port` instead of `input`; while monkey
+                                 runs, ActivityManager.isUserAMonkey() returns true in the apps
         :return:
         """
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -69,8 +85,32 @@ class Device(object):
         self.ro_secure = None
         self.connected = True
         self.last_know_state = None
+        # number of device property lookups answered from cache / fetched via adb
+        self.property_cache_hits = 0
+        self.property_cache_misses = 0
         self.__used_ports = []
         self.pause_sending_event = False
+        # pop-up events reported by the hook module
+        self.popup_bus = PopupEventBus()
+        # only scripts read the background services of a state, so they are fetched on first access
+        self.lazy_service_names = True
+        # threads capturing the parts of a state concurrently, created on the first capture
+        self.capture_executor = None
+        # time spent in each step of the last state capture (seconds)
+        self.last_capture_timings = None
+        # sequence number of the last accessibility event before the last input event
+        self.last_event_acc_seq = None
+        # the last screenshot in memory, its file is written in the background
+        self.last_screenshot = None
+        self.screenshot_writer = ScreenshotWriter()
+        # waits for the UI to settle after events
+        self.ui_idle_waiter = UIIdleWaiter(self)
+        # screens seen in the app, kept across runs in the output directory
+        self.screen_index = ScreenIndex(os.path.join(output_dir, SCREEN_INDEX_FILE) if output_dir is not None else None)
+        # abstraction of the states of each activity, adapted to their churn
+        self.state_abstraction = StateAbstraction()
+        # nav bar detection results, least recently used first, see get_nav_bar
+        self.nav_bar_cache = collections.OrderedDict()
 
         # adapters
         self.adb = ADB(device=self)
@@ -81,6 +121,7 @@ class Device(object):
         self.user_input_monitor = UserInputMonitor(device=self)
         self.process_monitor = ProcessMonitor(device=self)
         self.droidbot_ime = DroidBotIme(device=self)
+        self.monkey_injector = MonkeyInjector(device=self)
 
         self.adapters = {
             self.adb: True,
@@ -90,7 +131,8 @@ class Device(object):
             self.logcat: True,
             self.user_input_monitor: True,
             self.process_monitor: True,
-            self.droidbot_ime: True
+            self.droidbot_ime: True,
+            self.monkey_injector: monkey_injection
         }
 
         # minicap currently not working on emulators
@@ -177,6 +219,16 @@ class Device(object):
                 continue
             adapter.disconnect()
 
+        if self.capture_executor is not None:
+            self.capture_executor.shutdown(wait=False)
+            self.capture_executor = None
+
+        self.screenshot_writer.flush()
+        try:
+            self.screen_index.save()
+        except Exception as e:
+            self.logger.warning("Failed to save the screen index: %s" % e)
+        self.logger.info("State abstraction: %s" % self.state_abstraction.get_stats())
         if self.output_dir is not None:
             temp_dir = os.path.join(self.output_dir, "temp")
             if os.path.exists(temp_dir):
@@ -214,6 +266,9 @@ class Device(object):
         """
         if self.model_number is None:
             self.model_number = self.adb.get_model_number()
+            self.property_cache_misses += 1
+        else:
+            self.property_cache_hits += 1
         return self.model_number
 
     def get_sdk_version(self):
@@ -222,6 +277,9 @@ class Device(object):
         """
         if self.sdk_version is None:
             self.sdk_version = self.adb.get_sdk_version()
+            self.property_cache_misses += 1
+        else:
+            self.property_cache_hits += 1
         return self.sdk_version
 
     def get_release_version(self):
@@ -242,16 +300,54 @@ class Device(object):
             self.ro_debuggable = self.adb.get_ro_debuggable()
         return self.ro_debuggable
 
-    def get_display_info(self, refresh=True):
+    def get_display_info(self, refresh=False):
         """
-        get device display information, including width, height, and density
+        get device display information, including width, height, orientation and density
+        the values are cached until a rotation is reported (see handle_rotation)
         :param refresh: if set to True, refresh the display info instead of using the old values
         :return: dict, display_info
         """
         if self.display_info is None or refresh:
             self.display_info = self.adb.get_display_info()
+            self.property_cache_misses += 1
+        else:
+            self.property_cache_hits += 1
         return self.display_info
 
+    def invalidate_display_info(self):
+        """
+        drop the cached display info, the next lookup will query the device again
+        """
+        self.display_info = None
+
+    def get_property_cache_stats(self):
+        """
+        get the counters of the device property cache
+        :return: dict, number of lookups served from cache (hits) and fetched via adb (misses)
+        """
+        return {"hits": self.property_cache_hits,
+                "misses": self.property_cache_misses}
+
+    def get_nav_bar(self, state):
+        """
+        detect the bottom navigation bar of a state, once per screen structure and display
+        the bounds of the views depend on the display, so its size and orientation are part of the cache key
+        :param state: DeviceState
+        :return: dict with the container view id ("container") and its tab view ids ("tabs"), or None
+        """
+        display_info = self.get_display_info()
+        cache_key = (state.foreground_activity, state.structure_str, display_info.get("width"),
+                     display_info.get("height"), display_info.get("orientation"))
+        if cache_key in self.nav_bar_cache:
+            self.nav_bar_cache.move_to_end(cache_key)
+            return self.nav_bar_cache[cache_key]
+        from .device_state import detect_nav_bar
+        nav_bar = detect_nav_bar(state.views, state.view_bounds, state.enabled_view_ids, self.get_height())
+        self.nav_bar_cache[cache_key] = nav_bar
+        if len(self.nav_bar_cache) > NAV_BAR_CACHE_SIZE:
+            self.nav_bar_cache.popitem(last=False)
+        return nav_bar
+
     def get_width(self, refresh=False):
         display_info = self.get_display_info(refresh=refresh)
         width = 0
@@ -269,7 +365,7 @@ class Device(object):
         if "height" in display_info:
             height = display_info["height"]
         elif not refresh:
-            height = self.get_width(refresh=True)
+            height = self.get_height(refresh=True)
         else:
             self.logger.warning("get_height: height not in display_info")
         return height
@@ -481,6 +577,10 @@ class Device(object):
         :param event: the event to be sent
         :return:
         """
+        if self.droidbot_app.connected:
+            # Views captured after this event should come from a newer accessibility event
+            self.last_event_acc_seq = self.droidbot_app.acc_event_seq
+        self.ui_idle_waiter.ui_changed = None
         event.send(self)
 
     def start_app(self, app):
@@ -501,65 +601,66 @@ class Device(object):
         intent = Intent(suffix=package_name)
         self.send_intent(intent)
 
-    def get_top_activity_name(self):
+    def get_activity_dump(self):
         """
-        Get current activity
+        Get the top activity, the tasks and the current activity stack from one `dumpsys activity activities`
+        :return: a dict with keys "top_activity" (str or None), "task_activities" (dict mapping each task id
+                 to a list of activities, from top to down) and "activity_stack" (list of str or None)
         """
         r = self.adb.shell("dumpsys activity activities")
-        activity_line_re = re.compile('\* Hist #\d+: ActivityRecord{[^ ]+ [^ ]+ ([^ ]+) t(\d+)}')
-        m = activity_line_re.search(r)
-        if m:
-            return m.group(1)
-        # data = self.adb.shell("dumpsys activity top").splitlines()
-        # regex = re.compile("\s*ACTIVITY ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)")
-        # m = regex.search(data[1])
-        # if m:
-        #     return m.group(1) + "/" + m.group(2)
-        self.logger.warning("Unable to get top activity name.")
-        return None
-
-    def get_current_activity_stack(self):
-        """
-        Get current activity stack
-        :return: a list of str, each str is an activity name, the first is the top activity name
-        """
-        task_to_activities = self.get_task_activities()
-        top_activity = self.get_top_activity_name()
-        if top_activity:
-            for task_id in task_to_activities:
-                activities = task_to_activities[task_id]
-                if len(activities) > 0 and activities[0] == top_activity:
-                    return activities
-            self.logger.warning("Unable to get current activity stack.")
-            return [top_activity]
-        else:
-            return None
-
-    def get_task_activities(self):
-        """
-        Get current tasks and corresponding activities.
-        :return: a dict mapping each task id to a list of activities, from top to down.
-        """
+        top_activity = None
         task_to_activities = {}
-
-        lines = self.adb.shell("dumpsys activity activities").splitlines()
-        activity_line_re = re.compile('\* Hist #\d+: ActivityRecord{[^ ]+ [^ ]+ ([^ ]+) t(\d+)}')
-
-        for line in lines:
+        for line in r.splitlines():
             line = line.strip()
             if line.startswith("Task id #"):
                 task_id = line[9:]
                 task_to_activities[task_id] = []
             elif line.startswith("* Hist #"):
-                m = activity_line_re.match(line)
+                m = ACTIVITY_LINE_RE.match(line)
                 if m:
                     activity = m.group(1)
                     task_id = m.group(2)
+                    if top_activity is None:
+                        top_activity = activity
                     if task_id not in task_to_activities:
                         task_to_activities[task_id] = []
                     task_to_activities[task_id].append(activity)
 
-        return task_to_activities
+        activity_stack = None
+        if top_activity:
+            for task_id in task_to_activities:
+                activities = task_to_activities[task_id]
+                if len(activities) > 0 and activities[0] == top_activity:
+                    activity_stack = activities
+                    break
+            if activity_stack is None:
+                self.logger.warning("Unable to get current activity stack.")
+                activity_stack = [top_activity]
+        else:
+            self.logger.warning("Unable to get top activity name.")
+        return {"top_activity": top_activity,
+                "task_activities": task_to_activities,
+                "activity_stack": activity_stack}
+
+    def get_top_activity_name(self):
+        """
+        Get current activity
+        """
+        return self.get_activity_dump()["top_activity"]
+
+    def get_current_activity_stack(self):
+        """
+        Get current activity stack
+        :return: a list of str, each str is an activity name, the first is the top activity name
+        """
+        return self.get_activity_dump()["activity_stack"]
+
+    def get_task_activities(self):
+        """
+        Get current tasks and corresponding activities.
+        :return: a dict mapping each task id to a list of activities, from top to down.
+        """
+        return self.get_activity_dump()["task_activities"]
 
     def get_service_names(self):
         """
@@ -721,31 +822,7 @@ class Device(object):
         else:
             package = app
 
-        name2pid = {}
-        ps_out = self.adb.shell(["ps"])
-        ps_out_lines = ps_out.splitlines()
-        ps_out_head = ps_out_lines[0].split()
-        if ps_out_head[1] != "PID" or ps_out_head[-1] != "NAME":
-            self.logger.warning("ps command output format error: %s" % ps_out_head)
-        for ps_out_line in ps_out_lines[1:]:
-            segs = ps_out_line.split()
-            if len(segs) < 4:
-                continue
-            pid = int(segs[1])
-            name = segs[-1]
-            name2pid[name] = pid
-
-        if package in name2pid:
-            return name2pid[package]
-
-        possible_pids = []
-        for name in name2pid:
-            if name.startswith(package):
-                possible_pids.append(name2pid[name])
-        if len(possible_pids) > 0:
-            return min(possible_pids)
-
-        return None
+        return self.process_monitor.pid_of(package)
 
     def push_file(self, local_file, remote_dir="/sdcard/"):
         """
@@ -756,10 +833,10 @@ class Device(object):
         """
         if not os.path.exists(local_file):
             self.logger.warning("push_file file does not exist: %s" % local_file)
-        self.adb.run_cmd(["push", local_file, remote_dir])
+        self.adb.push(local_file, remote_dir)
 
     def pull_file(self, remote_file, local_file):
-        self.adb.run_cmd(["pull", remote_file, local_file])
+        self.adb.pull(remote_file, local_file)
 
     def take_screenshot(self):
         # image = None
@@ -783,31 +860,102 @@ class Device(object):
         if not os.path.exists(local_image_dir):
             os.makedirs(local_image_dir)
 
-        if self.adapters[self.minicap] and self.minicap.last_screen:
+        minicap_screen = self.minicap.last_screen if self.adapters[self.minicap] else None
+        if minicap_screen:
             # minicap use jpg format
             local_image_path = os.path.join(local_image_dir, "screen_%s.jpg" % tag)
-            with open(local_image_path, 'wb') as local_image_file:
-                local_image_file.write(self.minicap.last_screen)
-            return local_image_path
+            screenshot = Screenshot(encoded=minicap_screen)
         else:
             # screencap use png format
             local_image_path = os.path.join(local_image_dir, "screen_%s.png" % tag)
-            remote_image_path = "/sdcard/screen_%s.png" % tag
-            self.adb.shell("screencap -p %s" % remote_image_path)
-            self.pull_file(remote_image_path, local_image_path)
-            self.adb.shell("rm %s" % remote_image_path)
-
+            screenshot = self.capture_screenshot()
+            if screenshot is None:
+                remote_image_path = "/sdcard/screen_%s.png" % tag
+                self.adb.shell("screencap -p %s" % remote_image_path)
+                self.pull_file(remote_image_path, local_image_path)
+                self.adb.shell("rm %s" % remote_image_path)
+                self.last_screenshot = None
+                return local_image_path
+
+        # The file is written in the background, readers wait for it via screenshot_writer
+        self.last_screenshot = screenshot
+        self.screenshot_writer.write(screenshot, local_image_path)
         return local_image_path
 
-    def get_current_state(self):
+    def capture_screenshot(self):
+        """
+        stream the screen content from `screencap` into memory
+        :return: Screenshot, or None if it failed
+        """
+        try:
+            # Raw RGBA pixels need no PNG encoding on the device nor decoding here
+            screenshot = Screenshot.from_raw(self.adb.client.exec_out("screencap"))
+            if screenshot is None:
+                screenshot = Screenshot(encoded=self.adb.client.exec_out("screencap -p"))
+            return screenshot
+        except AdbClientException as e:
+            self.logger.warning("Failed to stream screenshot: %s" % e)
+            return None
+
+    def is_screen_changed_since_capture(self):
+        """
+        check whether the screen changed since the last state capture, according to the minicap frames
+        :return: True if it changed or if it cannot be told
+        """
+        if not (self.adapters[self.minicap] and self.minicap.connected):
+            return True
+        return self.minicap.change_detector.is_changed_since_capture()
+
+    def get_current_state(self, reuse_if_unchanged=False):
+        """
+        capture the current state
+        :param reuse_if_unchanged: return the last state if the screen did not change since it was captured and no
+                                   pop-up was reported since, the pending pop-ups need a new state to be checked on
+        """
+        if reuse_if_unchanged and self.last_know_state is not None and not self.popup_bus.has_pending() and \
+                not self.is_screen_changed_since_capture():
+            self.logger.debug("screen unchanged, reusing the last state")
+            return self.last_know_state
         self.logger.debug("getting current device state...")
         current_state = None
         try:
-            views = self.get_views()
-            foreground_activity = self.get_top_activity_name()
-            activity_stack = self.get_current_activity_stack()
-            background_services = self.get_service_names()
-            screenshot_path = self.take_screenshot()
+            capture_start_time = time.monotonic()
+            if self.adapters[self.minicap]:
+                # Any change from now on makes the screen differ from the captured state
+                self.minicap.change_detector.mark_captured()
+            # Each step is an independent round trip to the device, so they run at the same time
+            steps = {"views": self.get_views,
+                     "activities": self.get_activity_dump,
+                     "screenshot": self.take_screenshot}
+            if not self.lazy_service_names:
+                steps["services"] = self.get_service_names
+            if self.capture_executor is None:
+                self.capture_executor = ThreadPoolExecutor(max_workers=CAPTURE_WORKERS,
+                                                           thread_name_prefix="StateCapture")
+            futures = {}
+            for step_name in steps:
+                futures[step_name] = self.capture_executor.submit(self.__run_timed, steps[step_name])
+            results = {}
+            timings = {}
+            for step_name in futures:
+                results[step_name], timings[step_name] = futures[step_name].result()
+            capture_end_time = time.monotonic()
+            timings["total"] = capture_end_time - capture_start_time
+            self.last_capture_timings = timings
+            self.logger.info("state captured in %s" %
+                             ", ".join(["%s %.0f ms" % (step_name, timings[step_name] * 1000)
+                                        for step_name in timings]))
+
+            views = results["views"]
+            foreground_activity = results["activities"]["top_activity"]
+            activity_stack = results["activities"]["activity_stack"]
+            background_services = results.get("services")
+            screenshot_path = results["screenshot"]
+            screenshot = self.last_screenshot if screenshot_path is not None else None
+            # The pop-ups received since the previous capture, caused by the last event, belong to this state
+            popup_events = self.popup_bus.consume_until(capture_end_time)
+            if popup_events:
+                self.logger.info("%d pop-up event(s) received up to the state capture" % len(popup_events))
             self.logger.debug("finish getting current device state...")
             from .device_state import DeviceState
             current_state = DeviceState(self,
@@ -815,7 +963,11 @@ class Device(object):
                                         foreground_activity=foreground_activity,
                                         activity_stack=activity_stack,
                                         background_services=background_services,
-                                        screenshot_path=screenshot_path)
+                                        screenshot_path=screenshot_path,
+                                        screenshot=screenshot,
+                                        capture_start_time=capture_start_time,
+                                        capture_end_time=capture_end_time,
+                                        popup_events=popup_events)
         except Exception as e:
             self.logger.warning("exception in get_current_state: %s" % e)
             # import traceback
@@ -826,6 +978,20 @@ class Device(object):
             self.logger.warning("Failed to get current state!")
         return current_state
 
+    @staticmethod
+    def __run_timed(func):
+        start_time = time.monotonic()
+        result = func()
+        return result, time.monotonic() - start_time
+
+    def wait_for_ui_idle(self, max_wait, launch=False):
+        """
+        wait until the UI is idle, at most max_wait seconds
+        :param launch: whether the last event launched an app, see UIIdleWaiter.wait
+        :return: the time waited (seconds)
+        """
+        return self.ui_idle_waiter.wait(max_wait, launch)
+
     def get_last_known_state(self):
         return self.last_know_state
 
@@ -874,7 +1040,13 @@ class Device(object):
             else:
                 self.logger.warning("Failed to get views using OpenCV.")
         if self.droidbot_app and self.adapters[self.droidbot_app]:
-            views = self.droidbot_app.get_views()
+            min_seq = self.last_event_acc_seq
+            if min_seq is not None and self.ui_idle_waiter.ui_changed is False:
+                # Nothing changed on the screen after the event, no newer accessibility event is coming
+                min_seq = None
+            views = self.droidbot_app.get_views(min_seq=min_seq)
+            # Only the first capture after an event waits for a newer accessibility event
+            self.last_event_acc_seq = None
             if views:
                 return views
             else:
@@ -899,6 +1071,8 @@ class Device(object):
         return port
 
     def handle_rotation(self):
+        # display size and orientation change with rotation
+        self.invalidate_display_info()
         if not self.adapters[self.minicap]:
             return
         self.pause_sending_event = True
@@ -10,14 +10,22 @@ from PIL import Image
 from datetime import datetime
 
 from .utg import UTG
-from .utils import md5
+from .utils import md5, lazy_property
 from .input_event import TouchEvent, LongTouchEvent, ScrollEvent, SetTextEvent, KeyEvent
 # Baidu OCR
 from .utils import get_client
 from .new_input_policy import MIN_NUM_EXPLORE_EVENTS
 from .text_similarity import get_sim_score
+from .state_fingerprint import StateFingerprint
+from .popup_bus import POPUP_DIALOG, POPUP_WINDOW, POPUP_CUSTOM, POPUP_THIRD_PARTY, POPUP_IMAGE
+from .keywords import keyword_store, KEYWORDS_CONFIRM, KEYWORDS_RED_PACKET_BTN, KEYWORDS_RED_PACKET_EVENT
 from sentence_transformers import SentenceTransformer
 
+CHINESE_CHAR_RE = re.compile('[\u4e00-\u9fa5]')
+CHINESE_ENGLISH_WORD_RE = re.compile('[\u4e00-\u9fa5a-zA-Z]+', re.S)
+
+# View classes that may contain the bottom navigation tabs
+NAV_BAR_CLASSES = ['LinearLayout', 'TabWidget', 'ViewGroup', 'RadioGroup', 'RecyclerView', 'CustomItemLayout']
 
 class DeviceState(object):
     """
@@ -25,43 +33,80 @@ class DeviceState(object):
     """
 
     def __init__(self, device, views, foreground_activity, activity_stack, background_services,
-                 tag=None, screenshot_path=None):
+                 tag=None, screenshot_path=None, screenshot=None, capture_start_time=None, capture_end_time=None,
+                 popup_events=None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.device = device
         self.foreground_activity = foreground_activity
         self.activity_stack = activity_stack if isinstance(activity_stack, list) else []
-        self.background_services = background_services
+        # None if the services are not fetched yet, see background_services
+        self.__background_services = background_services
         if tag is None:
             tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
         self.tag = tag
         self.screenshot_path = screenshot_path
+        # the in-memory Screenshot, if any; the file at screenshot_path may still be being written
+        self.screenshot = screenshot
+        # time.monotonic() when the capture of this state started and ended
+        if capture_end_time is None:
+            capture_end_time = time.monotonic()
+        self.capture_start_time = capture_start_time if capture_start_time is not None else capture_end_time
+        self.capture_end_time = capture_end_time
+        # pop-up events received up to the capture of this state, see get_popup_events
+        self.popup_events = popup_events
+        # dhash of the screenshot, see get_screen_hash
+        self.__screen_hash = None
         self.views = self.__parse_views(views)
+        # Bounds of all views as an array of [x1, y1, x2, y2], indexed by temp_id
+        self.view_bounds = numpy.array([[view['bounds'][0][0], view['bounds'][0][1],
+                                         view['bounds'][1][0], view['bounds'][1][1]] for view in self.views],
+                                       dtype=numpy.int64).reshape(-1, 4)
         self.view_tree = {}
         # Add
         self.enabled_view_ids = self.get_enabled_view_ids()
         self.__assemble_view_tree(self.view_tree, self.views)
-        self.__generate_view_strs()
 
         # update state_str and add state_str_content
-        # self.state_str = self.__get_state_str()
-        self.state_str = self.__get_content_free_state_str()
-        self.state_str_content = self.__get_state_str()
+        # Subtree hashes of the previous state are reused for the unchanged parts of the view tree
+        last_state = device.get_last_known_state()
+        self.fingerprint = StateFingerprint(self.views, self.foreground_activity,
+                                            DeviceState.__get_content_free_view_signature,
+                                            DeviceState.__get_view_signature,
+                                            previous=last_state.fingerprint if last_state is not None else None,
+                                            abstraction=device.state_abstraction.get_level(self.foreground_activity))
+        # The states seen before the abstraction of the activity was raised keep their state_str
+        self.state_str, self.abstraction_level = device.state_abstraction.key_state(self)
+        self.state_str_content = self.fingerprint.state_str_content
+        self.structure_str = self.state_str
+
+        device.state_abstraction.observe(self)
 
-        self.structure_str = self.__get_content_free_state_str()
+        self.__generate_view_strs()
         self.search_content = self.__get_search_content()
         self.possible_events = None
-        self.width = device.get_width(refresh=True)
-        self.height = device.get_height(refresh=True)
+        self.search_events = None
+        self.red_packet_events = None
+        self.width = device.get_width()
+        self.height = device.get_height()
         # Add
         self.view_file_path = None
 
+    @property
+    def background_services(self):
+        """
+        the running services, fetched from the device on first access if not given when the state was captured
+        """
+        if self.__background_services is None:
+            self.__background_services = self.device.get_service_names()
+        return self.__background_services
+
     def to_dict(self):
         state = {'tag': self.tag,
                  'state_str': self.state_str_content,
                  'state_str_content_free': self.structure_str,
                  'foreground_activity': self.foreground_activity,
                  'activity_stack': self.activity_stack,
-                 'background_services': self.background_services,
+                 'background_services': self.__background_services,
                  'width': self.width,
                  'height': self.height,
                  'views': self.views}
@@ -116,32 +161,6 @@ class DeviceState(object):
         for view_id in DeviceState.__safe_dict_get(view_dict, 'children', []):
             DeviceState.__assign_depth(views, views[view_id], depth + 1)
 
-    def __get_state_str(self):
-        state_str_raw = self.__get_state_str_raw()
-        return md5(state_str_raw)
-
-    def __get_state_str_raw(self):
-        # view_signatures = set()
-        view_signatures = list()  # update
-        for view in self.views:
-            view_signature = DeviceState.__get_view_signature(view)
-            if view_signature:
-                view_signatures.append(view_signature)
-        # return "%s{%s}" % (self.foreground_activity, ",".join(sorted(view_signatures)))
-        return "%s{%s}" % (self.foreground_activity, ",".join(view_signatures))  # update
-
-    def __get_content_free_state_str(self):
-        # Update: set() to list()
-        view_signatures = list()
-        for view in self.views:
-            view_signature = DeviceState.__get_content_free_view_signature(view)
-            if view_signature:
-                view_signatures.append(view_signature)
-        # Update: Cancel sorted()
-        state_str = "%s{%s}" % (self.foreground_activity, ",".join(view_signatures))
-        import hashlib
-        return hashlib.md5(state_str.encode('utf-8')).hexdigest()
-
     def __get_search_content(self):
         """
         get a text for searching the state
@@ -180,13 +199,163 @@ class DeviceState(object):
             state_json_file = open(dest_state_json_path, "w")
             state_json_file.write(self.to_json())
             state_json_file.close()
-            shutil.copyfile(self.screenshot_path, dest_screenshot_path)
+            # The in-memory screenshot is written unless it was already written and released
+            if self.screenshot is None or \
+                    not self.device.screenshot_writer.write(self.screenshot, dest_screenshot_path):
+                shutil.copyfile(self.get_screenshot_path(), dest_screenshot_path)
             self.screenshot_path = dest_screenshot_path
             # if isinstance(self.screenshot_path, Image):
             #     self.screenshot_path.save(dest_screenshot_path)
         except Exception as e:
             self.device.logger.warning(e)
 
+    def get_screenshot_path(self):
+        """
+        get the screenshot file, waiting for it if it is still being written
+        """
+        if self.screenshot is not None:
+            self.device.screenshot_writer.wait(self.screenshot_path)
+        return self.screenshot_path
+
+    def get_screenshot_image(self):
+        """
+        get the screenshot as a PIL image, from memory if possible
+        """
+        if self.screenshot is not None and not self.screenshot.released:
+            try:
+                return self.screenshot.get_image()
+            except ValueError:
+                # Released meanwhile
+                pass
+        return Image.open(self.get_screenshot_path())
+
+    def get_screen_hash(self):
+        """
+        get the dhash of the screenshot, computed once
+        :return: int, or None if there is no screenshot or opencv-python is not installed
+        """
+        if self.__screen_hash is None:
+            try:
+                from .adapter import cv
+                if self.screenshot is not None:
+                    try:
+                        # Computed by the screenshot writer before the pixels are released
+                        self.__screen_hash = self.screenshot.get_dhash()
+                    except ValueError:
+                        self.__screen_hash = self.screenshot.dhash
+                if self.__screen_hash is None and self.screenshot_path is not None:
+                    screenshot_path = self.get_screenshot_path()
+                    if os.path.exists(screenshot_path):
+                        img = cv.load_image_from_path(screenshot_path)
+                        if img is not None:
+                            self.__screen_hash = cv.calculate_dhash(img)
+            except ImportError:
+                return None
+        return self.__screen_hash
+
+    def get_equivalent_screen(self):
+        """
+        find a screen equivalent to this one (same activity, close screenshot) in the device's screen index
+        :return: the screen index entry, or None
+        """
+        screen_hash = self.get_screen_hash()
+        if screen_hash is None:
+            return None
+        return self.device.screen_index.find(screen_hash, self.foreground_activity)
+
+    def is_explored(self, explored_states):
+        """
+        check whether this state, or an equivalent screen without red packet evidence, was explored
+        :param explored_states: set of explored state_str
+        """
+        if self.state_str in explored_states:
+            self.device.state_abstraction.on_explore_check(self, True)
+            return True
+        self.device.state_abstraction.on_explore_check(self, False)
+        # New pop-ups or a web view have to be checked even on a screen that looks explored
+        if self.red_packet_evidence:
+            return False
+        entry = self.get_equivalent_screen()
+        if entry is not None and entry["state_str"] in explored_states:
+            self.logger.info("State %s looks the same as the explored state %s" % (self.state_str, entry["state_str"]))
+            return True
+        return False
+
+    @lazy_property
+    def red_packet_evidence(self):
+        """
+        what identify_red_packet checks in this state: the texts and image positions of the pop-ups and the bounds
+        of the scrollable web views
+        :return: list of (kind, content), empty if there is nothing to check
+        """
+        evidence = []
+        for popup_event in self.get_popup_events():
+            if popup_event.kind == POPUP_IMAGE:
+                evidence.append((popup_event.kind, [list(pos) for pos in popup_event.image_positions]))
+            else:
+                evidence.append((popup_event.kind, popup_event.text))
+        for view_id in self.enabled_view_ids:
+            view = self.views[view_id]
+            if view['class'] == "android.webkit.WebView" and view['scrollable']:
+                evidence.append(("webview", view['bounds']))
+        return evidence
+
+    def classify_red_packet(self):
+        """
+        check whether this state shows a red packet, reusing the result of an equivalent screen classified before
+        (e.g. in an earlier run) from the same pop-ups and web views
+        :return: True if a red packet is found
+        """
+        evidence = self.red_packet_evidence
+        evidence_str = md5(str(evidence))
+        screen_hash = self.get_screen_hash()
+        entry = None
+        if screen_hash is not None:
+            entry = self.device.screen_index.find(screen_hash, self.foreground_activity, evidence_str)
+        if entry is not None and entry["red_packet"] is not None:
+            self.logger.info("Reusing the classification of an equivalent screen: red packet = %s" %
+                             entry["red_packet"])
+            # The candidates of this run are saved as if the state was classified
+            self.save_red_packet_candidates(evidence, entry["red_packet"])
+            return entry["red_packet"]
+        is_red_packet = self.identify_red_packet()
+        if screen_hash is not None:
+            self.device.screen_index.add(screen_hash, self.foreground_activity, self.state_str, is_red_packet,
+                                         evidence_str)
+        return is_red_packet
+
+    def save_red_packet_candidates(self, evidence, is_red_packet):
+        """
+        save the pop-ups and web views of this state in the candidates directory, as identify_red_packet does,
+        without checking their texts again
+        :param evidence: see red_packet_evidence
+        :param is_red_packet: the known classification of the state
+        """
+        if self.device.output_dir is None:
+            return
+        original_image_path = self.get_screenshot_path()
+        dst_reck_path = os.path.join(self.device.output_dir, "candidates/red_packets/")
+        for kind, content in evidence:
+            if kind == POPUP_IMAGE:
+                dst_popup_path = os.path.join(self.device.output_dir, "candidates/pop-ups/image-embedded/")
+                copy_file(original_image_path, dst_popup_path)
+                for elems in content:
+                    cropped_image_path = crop_sub_image(elems, original_image_path, dst_popup_path)
+                    if is_red_packet:
+                        copy_file(cropped_image_path, dst_reck_path)
+            elif kind == "webview":
+                dst_web_path = os.path.join(self.device.output_dir, "candidates/pop-ups/webview-embedded/")
+                copy_file(original_image_path, dst_web_path)
+                elems = [content[0][0], content[0][1], content[1][0], content[1][1]]
+                cropped_image_path = crop_sub_image(elems, original_image_path, dst_web_path)
+                if is_red_packet:
+                    copy_file(cropped_image_path, dst_reck_path)
+            else:
+                dst_popup_path = os.path.join(self.device.output_dir, "candidates/pop-ups/text-embedded/")
+                copy_file(original_image_path, dst_popup_path)
+                if is_red_packet:
+                    copy_file(original_image_path, dst_reck_path)
+
     def save_view_img(self, view_dict, output_dir=None):
         try:
             if output_dir is None:
@@ -207,7 +376,7 @@ class DeviceState(object):
                 return -1
             # Load the original image:
             view_bound = view_dict['bounds']
-            original_img = Image.open(self.screenshot_path)
+            original_img = self.get_screenshot_image()
             # view bound should be in original image bound
             view_img = original_img.crop((min(original_img.width - 1, max(0, view_bound[0][0])),
                                           min(original_img.height - 1, max(0, view_bound[0][1])),
@@ -274,23 +443,10 @@ class DeviceState(object):
         if 'view_str' in view_dict:
             return view_dict['view_str']
         view_signature = DeviceState.__get_view_signature(view_dict)
-        parent_strs = []
-        for parent_id in self.get_all_ancestors(view_dict):
-            parent_strs.append(DeviceState.__get_view_signature(self.views[parent_id]))
-        parent_strs.reverse()
-        child_strs = []
-        for child_id in self.get_all_children(view_dict):
-            child_strs.append(DeviceState.__get_view_signature(self.views[child_id]))
-        child_strs.sort()
-        # view_str = "State:%s\nActivity:%s\nSelf:%s\nParents:%s\nChildren:%s" % \ (
-        # self.__get_content_free_state_str(), self.foreground_activity, view_signature, "//".join(parent_strs),
-        # "||".join(child_strs))
-        # Update view_str
         view_str = "State:%s\nActivity:%s\nSelf:%s\nParents:%s\nChildren:%s" % \
-                   (self.__get_content_free_state_str(), self.foreground_activity, view_signature,
-                    self.get_all_ancestors(view_dict), self.get_all_children(view_dict))
-        import hashlib
-        view_str = hashlib.md5(view_str.encode('utf-8')).hexdigest()
+                   (self.structure_str, self.foreground_activity, view_signature,
+                    self.get_all_ancestors(view_dict), set(self.get_descendant_ids(view_dict['temp_id'])))
+        view_str = md5(view_str)
         view_dict['view_str'] = view_str
         return view_str
 
@@ -376,6 +532,26 @@ class DeviceState(object):
             result += self.get_all_ancestors(self.views[parent_id])
         return result
 
+    @lazy_property
+    def subtree_sizes(self):
+        """
+        The number of views in the subtree rooted at each view, indexed by temp_id
+        """
+        subtree_sizes = [1] * len(self.views)
+        # Views are listed in pre-order, so children always follow their parent
+        for view in reversed(self.views):
+            for child_id in self.__safe_dict_get(view, 'children') or []:
+                subtree_sizes[view['temp_id']] += subtree_sizes[child_id]
+        return subtree_sizes
+
+    def get_descendant_ids(self, view_id):
+        """
+        Get temp view ids of all descendants of the given view
+        :param view_id: temp_id of a view
+        :return: range of int, the descendants directly follow the view in pre-order
+        """
+        return range(view_id + 1, view_id + self.subtree_sizes[view_id])
+
     def get_all_children(self, view_dict):
         """
         Get temp view ids of the given view's children
@@ -411,74 +587,92 @@ class DeviceState(object):
         equal to 1
         """
         enabled_view_ids = []
+        view_w = self.view_bounds[:, 2] - self.view_bounds[:, 0]
+        view_h = self.view_bounds[:, 3] - self.view_bounds[:, 1]
         for view_dict in self.views:
-            view_size = self.__safe_dict_get(view_dict, 'size').split('*')
-            view_w = int(view_size[0])
-            view_h = int(view_size[1])
-            if self.__safe_dict_get(view_dict, 'enabled') and (view_w > 1 and view_h > 1) and \
+            view_id = view_dict['temp_id']
+            if self.__safe_dict_get(view_dict, 'enabled') and (view_w[view_id] > 1 and view_h[view_id] > 1) and \
                     self.__safe_dict_get(view_dict, 'resource_id') not in \
                     ['android:id/navigationBarBackground', 'android:id/statusBarBackground']:
-                enabled_view_ids.append(view_dict['temp_id'])
+                enabled_view_ids.append(view_id)
         return enabled_view_ids
 
-    def get_nav_ids(self):
+    @lazy_property
+    def nav_bar(self):
         """
-        Obtain all navigation button ids (if exists)
+        The bottom navigation bar of this state, detected once and shared by the state and the input policy
+        :return: dict with the container view id ("container") and its tab view ids ("tabs"), or None
+        """
+        return self.device.get_nav_bar(self)
+
+    @lazy_property
+    def nav_ids(self):
+        """
+        All view ids belonging to the bottom navigation bar (the container and its descendants)
         """
         nav_ids = set()
-        nav_parent_id = None
-        enabled_view_ids = self.enabled_view_ids[:]
-        enabled_view_ids.reverse()
-        device_height = self.device.get_height()
-        for view_id in enabled_view_ids:
-            view = self.views[view_id]
-            view_class = self.__safe_dict_get(view, 'class')
-            nav_class = 'LinearLayout' in view_class or 'TabWidget' in view_class or 'ViewGroup' in view_class \
-                        or 'RadioGroup' in view_class or 'RecyclerView' in view_class or 'android.view.View' == \
-                        view_class or 'CustomItemLayout' in view_class
-            child_count = view['child_count']
-            if self.__safe_dict_get(view, 'enabled') and nav_class and child_count >= 2:
-                children_id = view['children']
-                children_class = []
-                children_bound_y1 = set()
-                children_bound_y2 = set()
-                nav_type = set()
-                for child_id in children_id:
-                    child_view = self.views[child_id]
-                    view_size = child_view['size'].split("*")
-                    view_w = int(view_size[0])
-                    view_h = int(view_size[1])
-                    if view_w <= 1 or view_h <= 1:
-                        child_count -= 1
-                        continue
-                    children_class.append(child_view['class'])
-                    children_bound_y1.add(child_view['bounds'][0][1])
-                    children_bound_y2.add(child_view['bounds'][1][1])
-                    nav_type.add(child_view['class'])
-                if child_count == 2 and len(nav_type) == 1:
-                    if len(children_bound_y1) == 1 and len(children_bound_y2) == 1:  # Horizontal arrangement
-                        if 0 <= device_height - children_bound_y2.pop() <= 200 and \
-                                0 <= device_height - children_bound_y1.pop() <= 350:  # Near the bottom of the screen
-                            nav_parent_id = view_id
-                elif child_count > 2 and len(nav_type) <= 2:
-                    if len(children_bound_y1) <= 2 and len(children_bound_y2) <= 2:  # Horizontal arrangement
-                        min_len = min(len(children_bound_y1), len(children_bound_y2))
-                        for index in range(min_len):
-                            if 0 <= device_height - children_bound_y2.pop() <= 200 and 0 <= device_height - \
-                                    children_bound_y1.pop() <= 350:  # Near the bottom of the screen
-                                nav_parent_id = view_id
-                            else:
-                                nav_parent_id = None
-                                break
-            if nav_parent_id:
-                break
-        if nav_parent_id:
-            view_parent = self.views[nav_parent_id]
-            all_children_ids = self.get_all_children(view_parent)
-            nav_ids = all_children_ids
+        if self.nav_bar is not None:
+            nav_parent_id = self.nav_bar['container']
+            nav_ids = self.get_all_children(self.views[nav_parent_id])
             nav_ids.add(nav_parent_id)
         return nav_ids
 
+    def get_nav_ids(self):
+        """
+        Obtain all navigation button ids (if exists)
+        """
+        return self.nav_ids
+
+    @lazy_property
+    def event_candidates(self):
+        """
+        Candidate views for input events, extracted from the enabled views in a single pass and shared by
+        get_possible_input, get_search_input and get_red_packet_events
+        :return: dict of view id lists/sets and the aggregated text of each clickable view
+        """
+        views = self.views
+        scrollable_ids = []
+        clickable_ids = []
+        long_clickable_ids = []
+        leaf_ids = []
+        clickable_covered_ids = set()
+        long_clickable_covered_ids = set()
+        clickable_text = {}
+        for view_id in self.enabled_view_ids:
+            view = views[view_id]
+            descendant_ids = self.get_descendant_ids(view_id)
+            if self.__safe_dict_get(view, 'scrollable'):
+                scrollable_ids.append(view_id)
+            if self.__safe_dict_get(view, 'clickable'):
+                clickable_ids.append(view_id)
+                clickable_covered_ids.add(view_id)
+                clickable_covered_ids.update(descendant_ids)
+                text = self.__safe_dict_get(view, 'text') or self.__safe_dict_get(view, 'content_description')
+                if not text:
+                    child_text = ''
+                    for child_id in descendant_ids:
+                        child_view = views[child_id]
+                        child_text += self.__safe_dict_get(child_view, 'text') or \
+                            self.__safe_dict_get(child_view, 'content_description') or ''
+                    text = child_text
+                clickable_text[view_id] = text
+            if self.__safe_dict_get(view, 'long_clickable'):
+                long_clickable_ids.append(view_id)
+                long_clickable_covered_ids.add(view_id)
+                long_clickable_covered_ids.update(descendant_ids)
+            if not self.__safe_dict_get(view, 'children'):
+                leaf_ids.append(view_id)
+
+        return {
+            'scrollable': scrollable_ids,
+            'clickable': clickable_ids,
+            'long_clickable': long_clickable_ids,
+            'leaf': leaf_ids,
+            'clickable_covered': clickable_covered_ids,
+            'long_clickable_covered': long_clickable_covered_ids,
+            'clickable_text': clickable_text
+        }
+
     def get_possible_input(self, explored_states=None):
         """
         Get a list of possible input events for this state
@@ -488,8 +682,7 @@ class DeviceState(object):
             return [] + self.possible_events
 
         possible_events = []
-        enabled_view_ids = self.enabled_view_ids
-        touch_exclude_view_ids = set()
+        candidates = self.event_candidates
 
         # Search for confirmation, close, or red packet activation events
         if explored_states is not None:
@@ -498,34 +691,24 @@ class DeviceState(object):
                 return specific_events
 
         # Explore UI states of the app
-        for view_id in enabled_view_ids:
-            if self.__safe_dict_get(self.views[view_id], 'scrollable'):
-                view_class = self.__safe_dict_get(self.views[view_id], 'class')
-                if view_class and 'HorizontalScrollView' not in view_class:
-                    possible_events.append(ScrollEvent(view=self.views[view_id], direction="DOWN"))
-                    # possible_events.append(ScrollEvent(view=self.views[view_id], direction="UP"))
-                    # possible_events.append(ScrollEvent(view=self.views[view_id], direction="RIGHT"))
-                    # possible_events.append(ScrollEvent(view=self.views[view_id], direction="LEFT"))
-                    break
+        for view_id in candidates['scrollable']:
+            view_class = self.__safe_dict_get(self.views[view_id], 'class')
+            if view_class and 'HorizontalScrollView' not in view_class:
+                possible_events.append(ScrollEvent(view=self.views[view_id], direction="DOWN"))
+                # possible_events.append(ScrollEvent(view=self.views[view_id], direction="UP"))
+                # possible_events.append(ScrollEvent(view=self.views[view_id], direction="RIGHT"))
+                # possible_events.append(ScrollEvent(view=self.views[view_id], direction="LEFT"))
+                break
 
-        for view_id in enabled_view_ids:
-            if self.__safe_dict_get(self.views[view_id], 'clickable'):
-                possible_events.append(TouchEvent(view=self.views[view_id]))
-                touch_exclude_view_ids.add(view_id)
-                touch_exclude_view_ids = touch_exclude_view_ids.union(self.get_all_children(self.views[view_id]))
+        for view_id in candidates['clickable']:
+            possible_events.append(TouchEvent(view=self.views[view_id]))
 
-        for view_id in enabled_view_ids:
-            if self.__safe_dict_get(self.views[view_id], 'long_clickable'):
-                possible_events.append(LongTouchEvent(view=self.views[view_id]))
-                touch_exclude_view_ids.add(view_id)
-                touch_exclude_view_ids = touch_exclude_view_ids.union(self.get_all_children(self.views[view_id]))
+        for view_id in candidates['long_clickable']:
+            possible_events.append(LongTouchEvent(view=self.views[view_id]))
 
         # Search other children nodes that are not clickable
-        for view_id in enabled_view_ids:
-            if view_id in touch_exclude_view_ids:
-                continue
-            children = self.__safe_dict_get(self.views[view_id], 'children')
-            if children and len(children) > 0:
+        for view_id in candidates['leaf']:
+            if view_id in candidates['clickable_covered'] or view_id in candidates['long_clickable_covered']:
                 continue
             possible_events.append(TouchEvent(view=self.views[view_id]))
 
@@ -540,27 +723,23 @@ class DeviceState(object):
         Get a list of clickable events in this state for searching the navigation bar
         :return: list of InputEvent
         """
-        possible_events = []
-        enabled_view_ids = self.enabled_view_ids
-        touch_exclude_view_ids = set()
+        if self.search_events is not None:
+            return [] + self.search_events
 
-        for view_id in enabled_view_ids:
-            if self.__safe_dict_get(self.views[view_id], 'clickable'):
-                possible_events.append(TouchEvent(view=self.views[view_id]))
-                touch_exclude_view_ids.add(view_id)
-                touch_exclude_view_ids = touch_exclude_view_ids.union(self.get_all_children(self.views[view_id]))
+        search_events = []
+        candidates = self.event_candidates
+
+        for view_id in candidates['clickable']:
+            search_events.append(TouchEvent(view=self.views[view_id]))
 
         # Search other children nodes that are not clickable
-        for view_id in enabled_view_ids:
-            if view_id in touch_exclude_view_ids:
-                continue
-            children = self.__safe_dict_get(self.views[view_id], 'children')
-            if children and len(children) > 0:
+        for view_id in candidates['leaf']:
+            if view_id in candidates['clickable_covered']:
                 continue
-            possible_events.append(TouchEvent(view=self.views[view_id]))
+            search_events.append(TouchEvent(view=self.views[view_id]))
 
-        self.possible_events = possible_events
-        return possible_events
+        self.search_events = search_events
+        return [] + search_events
 
     def get_specific_input(self, explored_states):
         """
@@ -570,37 +749,25 @@ class DeviceState(object):
         specific_events = []
         enabled_view_ids = self.enabled_view_ids
 
+        # Attach the pop-ups received before this state was captured, so that each pop-up is checked once
+        self.get_popup_events()
+
         # 1 Search for red packet view in the current state.
-        if self.state_str not in explored_states:
-            if self.identify_red_packet():
+        if not self.is_explored(explored_states):
+            if self.classify_red_packet():
                 specific_events.append('red_packet')
                 return specific_events
 
-        # Restore to default
-        with open('DetectReck/output/dialog.txt', "w+") as f:
-            f.write('')
-        with open('DetectReck/output/custom_popup.txt', "w+") as f:
-            f.write('')
-        with open('DetectReck/output/popup_window.txt', "w+") as f:
-            f.write('')
-        with open('DetectReck/output/third-party_popup.txt', "w+") as f:
-            f.write('')
-        with open('DetectReck/output/popup_image_position.txt', "w+") as f:
-            f.write('')
-
         # 2 Check the confirmation page
-        with open('DetectReck/resources/keywords/confirm.txt', "r+", encoding='UTF-8') as f:
-            confirm_buttons = f.read().split('\n')
+        confirm_buttons = keyword_store.get(KEYWORDS_CONFIRM)
         for view_id in enabled_view_ids:
             view = self.views[view_id]
             view_text = view['text']
             if view_text:
-                import re
-                view_text = re.findall('[\u4e00-\u9fa5a-zA-Z]+', view_text, re.S)
-                view_text = ''.join(view_text)
+                view_text = ''.join(CHINESE_ENGLISH_WORD_RE.findall(view_text))
                 if len(view['children']) == 0 and (view['clickable'] or self.views[view['parent']]['clickable']):
                     if (view_text.find("同意") != -1 and view_text.find('不同意') == -1 or view_text.find("知道") != -1) \
-                            and len(view_text) < 8 or view_text in confirm_buttons:
+                            and len(view_text) < 8 or confirm_buttons.contains(view_text):
                         self.logger.info("Find the confirmation button (view = %s)." % view['view_str'])
                         specific_events.append('confirm')
                         specific_events.append(TouchEvent(view=view))
@@ -627,126 +794,77 @@ class DeviceState(object):
         Get a list of related input events that might trigger red packets according to text similarity analysis
         :return: list of InputEvent
         """
+        if self.red_packet_events is not None:
+            return [] + self.red_packet_events
+
         all_possible_events = []
         red_packet_events = []
         other_events = []
-        enabled_view_ids = self.enabled_view_ids
+        candidates = self.event_candidates
         nav_ids = self.get_nav_ids()
+        event_keywords = keyword_store.get(KEYWORDS_RED_PACKET_EVENT)
 
-        for view_id in enabled_view_ids:
-            if self.__safe_dict_get(self.views[view_id], 'clickable') and view_id not in nav_ids:
-                file_path = 'DetectReck/resources/keywords/red_packet_event.txt'
-                with open(file_path, "r+", encoding='UTF-8') as f:
-                    event_keywords = f.read().split('\n')
-                view_text = self.views[view_id]['text']
-                view_desc = self.views[view_id]['content_description']
-                if view_text or view_desc:
-                    if view_text:
-                        text = view_text
-                    else:
-                        text = view_desc
-                else:
-                    all_children_ids = self.get_all_children(self.views[view_id])
-                    child_text = ''
-                    for child_id in all_children_ids:
-                        view_text = self.views[child_id]['text']
-                        view_desc = self.views[child_id]['content_description']
-                        if view_text:
-                            child_text += view_text
-                        elif view_desc:
-                            child_text += view_desc
-                    text = child_text
-
-                strs = re.findall('[\u4e00-\u9fa5]', text)
-                text = ''.join(strs)
-                if text:
-                    # print('view %d text:' % view_id, text)
-                    match_status = False
-                    for word in event_keywords:
-                        if word in text:
-                            match_status = True
-                            red_packet_events.append(TouchEvent(view=self.views[view_id]))
-                            break
-                    if not match_status:
-                        other_events.append(TouchEvent(view=self.views[view_id]))
+        for view_id in candidates['clickable']:
+            if view_id in nav_ids:
+                continue
+            text = ''.join(CHINESE_CHAR_RE.findall(candidates['clickable_text'][view_id]))
+            if text:
+                # print('view %d text:' % view_id, text)
+                if event_keywords.search(text):
+                    red_packet_events.append(TouchEvent(view=self.views[view_id]))
                 else:
                     other_events.append(TouchEvent(view=self.views[view_id]))
+            else:
+                other_events.append(TouchEvent(view=self.views[view_id]))
 
         if len(red_packet_events) > MIN_NUM_EXPLORE_EVENTS:  # Return all possible red packet events
-            return red_packet_events
+            self.red_packet_events = red_packet_events
+            return [] + red_packet_events
         else:
             all_possible_events = red_packet_events + other_events
 
         if len(all_possible_events) == 0:
-            for view_id in enabled_view_ids:
+            for view_id in candidates['leaf']:
                 if view_id in nav_ids:
                     continue
-                children = self.__safe_dict_get(self.views[view_id], 'children')
-                if children and len(children) > 0:
-                    continue
                 all_possible_events.append(TouchEvent(view=self.views[view_id]))
 
         if len(all_possible_events) > MIN_NUM_EXPLORE_EVENTS:  # Return the first MIN_NUM_EXPLORE_EVENTS events
             all_possible_events = all_possible_events[:MIN_NUM_EXPLORE_EVENTS]
 
-        return all_possible_events
+        self.red_packet_events = all_possible_events
+        return [] + all_possible_events
+
+    def get_popup_events(self):
+        """
+        Get the pop-up events that occurred up to the capture of this state.
+        The events are taken from the device's pop-up bus once, the later ones are left for the next states.
+        :return: list of PopupEvent
+        """
+        if self.popup_events is None:
+            self.popup_events = self.device.popup_bus.consume_until(self.capture_end_time)
+        return self.popup_events
 
     # Identify red packet from all pop-ups
     def identify_red_packet(self):
         # Identify pop-up windows (dialog, popup window, custom popup, third-party popup) via an Android Xposed module.
-        with open('DetectReck/output/dialog.txt', 'r', encoding='UTF-8') as f:
-            dialog_text = f.read()
-        with open('DetectReck/output/custom_popup.txt', 'r', encoding='UTF-8') as f:
-            custom_popup_text = f.read()
-        with open('DetectReck/output/popup_window.txt', 'r', encoding='UTF-8') as f:
-            popup_window_text = f.read()
-        with open('DetectReck/output/third-party_popup.txt', 'r', encoding='UTF-8') as f:
-            third_popup_text = f.read()
-        with open('DetectReck/output/popup_image_position.txt', 'r', encoding='UTF-8') as f:
-            popup_image_positions = f.read()
-
-        # Restore to default
-        if dialog_text != '':
-            with open('DetectReck/output/dialog.txt', "w+") as f:
-                f.write('')
-        if custom_popup_text != '':
-            with open('DetectReck/output/custom_popup.txt', "w+") as f:
-                f.write('')
-        if popup_window_text != '':
-            with open('DetectReck/output/popup_window.txt', "w+") as f:
-                f.write('')
-        if third_popup_text != '':
-            with open('DetectReck/output/third-party_popup.txt', "w+") as f:
-                f.write('')
-        if popup_image_positions != '':
-            with open('DetectReck/output/popup_image_position.txt', "w+") as f:
-                f.write('')
+        popup_texts = {}
+        popup_image_positions = []
+        for popup_event in self.get_popup_events():
+            if popup_event.kind == POPUP_IMAGE:
+                popup_image_positions += popup_event.image_positions
+            else:
+                # The latest text of each kind of pop-up is checked
+                popup_texts[popup_event.kind] = popup_event.text
 
         # Identify whether a pop-up view exist in the current state
-        if dialog_text != '' and '#dialog#' in dialog_text:
-            text = dialog_text.replace('#dialog#\n', '')
-            if self.check_popup_view('dialog', text):
-                return True
-
-        if custom_popup_text != '' and '#custom popup#' in custom_popup_text:
-            text = custom_popup_text.replace('#custom popup#\n', '')
-            if self.check_popup_view('custom popup', text):
-                return True
-
-        if popup_window_text != '' and '#popup window#' in popup_window_text:
-            text = popup_window_text.replace('#popup window#\n', '')
-            if self.check_popup_view('popup window', text):
-                return True
-
-        if third_popup_text != '' and '#third-party popup#' in third_popup_text:
-            text = third_popup_text.replace('#third-party popup#\n', '')
-            if self.check_popup_view('third-party popup', text):
+        for kind in [POPUP_DIALOG, POPUP_CUSTOM, POPUP_WINDOW, POPUP_THIRD_PARTY]:
+            if kind in popup_texts and self.check_popup_view(kind, popup_texts[kind]):
                 return True
 
         # If the pop-up is an image
-        if popup_image_positions != '' and '#pop-up image#' in popup_image_positions:
-            pos_info = popup_image_positions.replace('#pop-up image#:', '').strip()
-            if self.check_popup_image('pop-up image', pos_info):
+        if popup_image_positions:
+            if self.check_popup_image(POPUP_IMAGE, popup_image_positions):
                 return True
 
         # If the current UI is embedded in the WebView
@@ -763,7 +881,7 @@ class DeviceState(object):
             if view['class'] == "android.webkit.WebView" and view['scrollable']:
                 # Save the web view locally
                 dst_web_path = os.path.join(self.device.output_dir, "candidates/pop-ups/webview-embedded/")
-                original_image_path = self.screenshot_path
+                original_image_path = self.get_screenshot_path()
                 # print("########## Screenshot path: ", original_image_path)
                 copy_file(original_image_path, dst_web_path)
                 # Crop a sub-image from the screenshot
@@ -806,7 +924,7 @@ class DeviceState(object):
         # Save the pop-up view locally
         dst_popup_path = os.path.join(self.device.output_dir, "candidates/pop-ups/text-embedded/")
         # print("########## screenshot_path: ", self.screenshot_path)
-        copy_file(self.screenshot_path, dst_popup_path)
+        copy_file(self.get_screenshot_path(), dst_popup_path)
 
         self.logger.info(f'Checking whether the {tag} is a red packet...')
         print(f'#Text in the {tag}: {text}')
@@ -817,25 +935,23 @@ class DeviceState(object):
 
             # Save the red packet view locally
             dst_reck_path = os.path.join(self.device.output_dir, "candidates/red_packets/")
-            copy_file(self.screenshot_path, dst_reck_path)
+            copy_file(self.get_screenshot_path(), dst_reck_path)
         else:
             self.logger.info(f'The {tag} is not a red packet.')
 
         return is_red_packet
 
     # Extract and analyze the text in the pop-up image.
-    def check_popup_image(self, tag, pos_info):
+    def check_popup_image(self, tag, positions):
         is_red_packet = False
 
         self.logger.info(f'Find a {tag}!')
-        positions = pos_info.split('\n')
         # print(positions)
-        for pos in positions:
-            elems = [int(x) for x in pos.split(',')]
+        for elems in positions:
             print("Image Coordinates: ", elems)
             # Save the pop-up image locally
             dst_popup_path = os.path.join(self.device.output_dir, "candidates/pop-ups/image-embedded/")
-            original_image_path = self.screenshot_path
+            original_image_path = self.get_screenshot_path()
             # print("########## screenshot_path: ", original_image_path)
             copy_file(original_image_path, dst_popup_path)
             # Crop a sub-image from the screenshot
@@ -876,6 +992,51 @@ class DeviceState(object):
         return all_text.strip()
 
 
+# Detect the bottom navigation bar among the enabled views.
+def detect_nav_bar(views, view_bounds, enabled_view_ids, device_height):
+    """
+    Find the bottom-most container whose visible children are arranged horizontally near the bottom of the screen
+    :param views: list of view dicts, indexed by temp_id
+    :param view_bounds: numpy array of [x1, y1, x2, y2] for each view
+    :param enabled_view_ids: ids of the enabled views, searched from the last one
+    :param device_height: height of the device screen
+    :return: dict with the container view id ("container") and its tab view ids ("tabs"), or None
+    """
+    for view_id in reversed(enabled_view_ids):
+        view = views[view_id]
+        view_class = view.get('class') or ''
+        nav_class = any(c in view_class for c in NAV_BAR_CLASSES) or view_class == 'android.view.View'
+        children_ids = view.get('children') or []
+        child_count = view.get('child_count', len(children_ids))
+        if not view.get('enabled') or not nav_class or child_count < 2 or len(children_ids) == 0:
+            continue
+        children_ids = numpy.array(children_ids)
+        children_bounds = view_bounds[children_ids]
+        # Excluding invalid views with width or height less than or equal to 1
+        valid = ((children_bounds[:, 2] - children_bounds[:, 0]) > 1) & \
+                ((children_bounds[:, 3] - children_bounds[:, 1]) > 1)
+        child_count -= int(numpy.count_nonzero(~valid))
+        tab_ids = children_ids[valid]
+        if len(tab_ids) == 0:
+            continue
+        nav_type = set(views[tab_id]['class'] for tab_id in tab_ids)
+        children_bound_y1 = numpy.unique(children_bounds[valid, 1])
+        children_bound_y2 = numpy.unique(children_bounds[valid, 3])
+        if child_count == 2 and len(nav_type) == 1:
+            horizontal = len(children_bound_y1) == 1 and len(children_bound_y2) == 1
+        elif child_count > 2 and len(nav_type) <= 2:
+            horizontal = len(children_bound_y1) <= 2 and len(children_bound_y2) <= 2
+        else:
+            continue
+        # Near the bottom of the screen
+        bottom_gap_y1 = device_height - children_bound_y1
+        bottom_gap_y2 = device_height - children_bound_y2
+        if horizontal and numpy.all((bottom_gap_y2 >= 0) & (bottom_gap_y2 <= 200)) and \
+                numpy.all((bottom_gap_y1 >= 0) & (bottom_gap_y1 <= 350)):
+            return {"container": view_id, "tabs": [int(tab_id) for tab_id in tab_ids]}
+    return None
+
+
 # Check whether the text is related to a red packet.
 def check_reck_text(text):
     token = text.replace('\n', '').replace(' ', '')
@@ -891,10 +1052,9 @@ def check_reck_text(text):
         else:
             # Match the open button of the red packet if no red packet text exists
             words = text.replace(' ', '').split('\n')
-            with open('DetectReck/resources/keywords/red_packet_btn.txt', "r", encoding='UTF-8') as f:
-                btn_keywords = f.read().split('\n')
+            btn_keywords = keyword_store.get(KEYWORDS_RED_PACKET_BTN)
             for word in words:
-                if word in btn_keywords:
+                if btn_keywords.contains(word):
                     print("The open button matching successful!")
                     return True
     return False
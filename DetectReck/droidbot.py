@@ -4,9 +4,7 @@
 # droidbot will start interacting with Android in AVD like a human
 import logging
 import os
-import socket
 import sys
-import traceback
 
 import pkg_resources
 import shutil
@@ -16,6 +14,8 @@ from .device import Device
 from .app import App
 from .env_manager import AppEnvManager
 from .input_manager import InputManager
+from .hook_server import HookServer, HOOK_SERVER_PORT
+from .ui_idle import UI_IDLE_FLOOR
 
 
 class DroidBot(object):
@@ -47,7 +47,11 @@ class DroidBot(object):
                  master=None,
                  humanoid=None,
                  ignore_ad=False,
-                 replay_output=None):
+                 replay_output=None,
+                 hook_port=HOOK_SERVER_PORT,
+                 min_event_interval=UI_IDLE_FLOOR,
+                 state_abstraction=None,
+                 monkey_injection=False):
         """
         initiate droidbot with configurations
         :return:
@@ -86,7 +90,9 @@ class DroidBot(object):
 
         self.enabled = True
 
-        self.server_sock = None
+        self.hook_port = hook_port
+        self.hook_server = None
+        self.hook_session = None
 
         try:
             # initialize Device
@@ -98,7 +104,15 @@ class DroidBot(object):
                 grant_perm=grant_perm,
                 enable_accessibility_hard=self.enable_accessibility_hard,
                 humanoid=self.humanoid,
-                ignore_ad=ignore_ad)
+                ignore_ad=ignore_ad,
+                monkey_injection=monkey_injection)
+            # min wait after each event, the wait ends as soon as the UI is idle but not before this
+            self.device.ui_idle_waiter.floor = min_event_interval
+            # a fixed abstraction level of the states (see state_fingerprint), by default adapted per activity
+            self.device.state_abstraction.fixed_level = state_abstraction
+            if debug_mode:
+                # mirror the pop-up events to files for debugging
+                self.device.popup_bus.mirror_dir = "DetectReck/output"
 
             # initialize App
             self.app = App(app_path, output_dir=self.output_dir)
@@ -152,10 +166,8 @@ class DroidBot(object):
             # Set connections on this device
             self.device.set_up()
 
-            # Add Socket Server
-            import threading
-            listen_thread = threading.Thread(target=self.start_socket_server)
-            listen_thread.start()
+            # Receive pop-up messages from the hook module
+            self.start_hook_server()
 
             if not self.enabled:
                 return
@@ -218,42 +230,19 @@ class DroidBot(object):
             proxy = xmlrpc.client.ServerProxy(self.input_manager.policy.master)
             proxy.stop_worker(self.device.serial)
 
-        self.server_sock.close()
+        if self.hook_server and self.hook_session:
+            self.hook_server.unregister_session(self.hook_session)
+            self.logger.info("Hook server stats: %s" % self.hook_session.get_stats())
+            self.hook_session = None
 
-    def start_socket_server(self):
-        print("Start Socket Server...")
-        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.server_sock.bind(("0.0.0.0", 9999))
-            self.server_sock.listen(5)
-            # while self.device.connected:
-            while self.enabled:
-                connection, address = self.server_sock.accept()
-                connection.settimeout(5)
-                message = connection.recv(2048)
-                if not isinstance(message, str):
-                    message = message.decode('utf-8', errors='ignore')
-                # print(message)
-
-                # Save message to files
-                if '#dialog#' in message:
-                    with open('DetectReck/output/dialog.txt', "w+", encoding="UTF-8") as f:
-                        f.write(message)
-                elif '#popup window#' in message:
-                    with open('DetectReck/output/popup_window.txt', "w+", encoding="UTF-8") as f:
-                        f.write(message)
-                elif '#custom popup#' in message:
-                    with open('DetectReck/output/custom_popup.txt', "w+", encoding="UTF-8") as f:
-                        f.write(message)
-                elif '#third-party popup#' in message:
-                    with open('DetectReck/output/third-party_popup.txt', "w+", encoding="UTF-8") as f:
-                        f.write(message)
-                elif '#pop-up image#' in message:
-                    with open('DetectReck/output/popup_image_position.txt', "a+", encoding="UTF-8") as f:
-                        f.write(message + '\n')
-        except socket.error:
-            if self.enabled:
-                traceback.print_exc()
+    def start_hook_server(self):
+        """
+        route the pop-up messages of the hook module for this device and app to the device's pop-up bus
+        """
+        self.hook_server = HookServer.get_instance(port=self.hook_port)
+        self.hook_session = self.hook_server.register_session(self.device.serial,
+                                                              self.app.get_package_name(),
+                                                              self.device.popup_bus)
 
 
 class DroidBotException(Exception):
@@ -0,0 +1,264 @@
+# Server receiving the pop-up messages of the hook module (an Xposed module running in the target apps).
+# Supported framings on one connection:
+#   - legacy: a raw "#<kind>#..." message, terminated by closing the connection
+#   - newline-delimited JSON: one JSON object per line
+#   - length-prefixed: a 4-byte big-endian payload length followed by the payload (JSON or a legacy message)
+# JSON messages may carry "serial" and "package" fields, which route them to the matching exploration session.
+import asyncio
+import json
+import logging
+import struct
+import threading
+import time
+
+from .popup_bus import PopupEvent
+
+HOOK_SERVER_HOST = "0.0.0.0"
+HOOK_SERVER_PORT = 9999
+# Max size of one message, larger frames are rejected
+MAX_MESSAGE_LEN = 16 * 1024 * 1024
+READ_TIMEOUT = 30
+# A legacy message is considered complete once the connection is idle for this long (seconds)
+LEGACY_IDLE_TIMEOUT = 1
+
+
+class HookServerException(Exception):
+    pass
+
+
+class HookSession(object):
+    """
+    an exploration session receiving pop-up events, identified by device serial and app package
+    """
+
+    def __init__(self, serial, package, popup_bus):
+        self.serial = serial
+        self.package = package
+        self.popup_bus = popup_bus
+        self.start_time = time.monotonic()
+        self.message_count = 0
+        self.byte_count = 0
+
+    def deliver(self, event, size):
+        self.message_count += 1
+        self.byte_count += size
+        self.popup_bus.publish(event)
+
+    def get_stats(self):
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        return {
+            "serial": self.serial,
+            "package": self.package,
+            "messages": self.message_count,
+            "bytes": self.byte_count,
+            "messages_per_second": self.message_count / elapsed
+        }
+
+
+class HookServer(object):
+    """
+    asyncio server accepting many concurrent hook connections, run in a background thread
+    """
+    # one server per port in this process, shared by all DroidBot instances
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, host=HOOK_SERVER_HOST, port=HOOK_SERVER_PORT):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.host = host
+        self.port = port
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.connection_count = 0
+        self.message_count = 0
+        self.unrouted_count = 0
+        self.__started = threading.Event()
+        self.__start_error = None
+
+    @staticmethod
+    def get_instance(port=HOOK_SERVER_PORT, host=HOOK_SERVER_HOST):
+        """
+        get the running server on the given port, starting it if needed
+        """
+        with HookServer.instances_lock:
+            server = HookServer.instances.get(port)
+            if server is None:
+                server = HookServer(host=host, port=port)
+                server.start()
+                HookServer.instances[port] = server
+            return server
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__run, name="HookServer-%d" % self.port)
+        self.thread.daemon = True
+        self.thread.start()
+        self.__started.wait()
+        if self.__start_error is not None:
+            raise HookServerException("Failed to start hook server on port %d: %s" % (self.port, self.__start_error))
+        print("Start Socket Server on port %d..." % self.port)
+
+    def stop(self):
+        """
+        stop the server and wait until its port is released, so that a new server can be started on it
+        """
+        with HookServer.instances_lock:
+            if HookServer.instances.get(self.port) is self:
+                HookServer.instances.pop(self.port)
+            if self.loop is not None and self.loop.is_running():
+                self.loop.call_soon_threadsafe(self.loop.stop)
+            if self.thread is not None and self.thread is not threading.current_thread():
+                self.thread.join()
+
+    def register_session(self, serial, package, popup_bus):
+        """
+        route the pop-up events of an app on a device to the given bus
+        :return: HookSession
+        """
+        session = HookSession(serial, package, popup_bus)
+        with self.lock:
+            self.sessions[(serial, package)] = session
+        return session
+
+    def unregister_session(self, session):
+        """
+        stop routing events to a session
+        the server keeps running when no session is left, it is shared by the DroidBot instances of the process
+        """
+        with self.lock:
+            if self.sessions.get((session.serial, session.package)) is session:
+                self.sessions.pop((session.serial, session.package))
+
+    def get_stats(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return {
+            "connections": self.connection_count,
+            "messages": self.message_count,
+            "unrouted": self.unrouted_count,
+            "sessions": [session.get_stats() for session in sessions]
+        }
+
+    def __run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.__handle_connection, self.host, self.port, limit=MAX_MESSAGE_LEN))
+        except Exception as e:
+            self.__start_error = e
+            self.__started.set()
+            self.loop.close()
+            return
+        self.__started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+            self.logger.debug("hook server stopped: %s" % self.get_stats())
+
+    async def __handle_connection(self, reader, writer):
+        self.connection_count += 1
+        try:
+            first = await asyncio.wait_for(reader.read(1), READ_TIMEOUT)
+            if not first:
+                return
+            if first == b"{":
+                # newline-delimited JSON
+                pending = first
+                while True:
+                    try:
+                        line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+                    except (asyncio.LimitOverrunError, ValueError):
+                        # readline raises ValueError once a line exceeds the stream limit
+                        self.logger.warning("hook message longer than %d bytes, closing connection" %
+                                            MAX_MESSAGE_LEN)
+                        break
+                    if not line and not pending:
+                        break
+                    if (pending + line).strip():
+                        self.__handle_payload(pending + line)
+                    pending = b""
+                    if not line.endswith(b"\n"):
+                        break
+            elif first == b"\x00":
+                # length-prefixed frames, the high byte of a valid length is always 0
+                header = first + await asyncio.wait_for(reader.readexactly(3), READ_TIMEOUT)
+                while True:
+                    (length,) = struct.unpack(">I", header)
+                    if length > MAX_MESSAGE_LEN:
+                        self.logger.warning("hook message too long (%d bytes), closing connection" % length)
+                        break
+                    payload = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT)
+                    self.__handle_payload(payload)
+                    header = await asyncio.wait_for(reader.read(4), READ_TIMEOUT)
+                    if len(header) == 0:
+                        break
+                    if len(header) < 4:
+                        header += await asyncio.wait_for(reader.readexactly(4 - len(header)), READ_TIMEOUT)
+            else:
+                # legacy: the whole connection is one message, complete when the hook closes it or goes idle
+                payload = first
+                while len(payload) < MAX_MESSAGE_LEN:
+                    try:
+                        chunk = await asyncio.wait_for(reader.read(MAX_MESSAGE_LEN - len(payload)),
+                                                       LEGACY_IDLE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        break
+                    if not chunk:
+                        break
+                    payload += chunk
+                self.__handle_payload(payload)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as e:
+            self.logger.debug("hook connection closed: %s" % e)
+        except Exception as e:
+            self.logger.warning("error handling hook connection: %s" % e)
+        finally:
+            writer.close()
+
+    def __handle_payload(self, payload):
+        receive_time = time.monotonic()
+        message = payload.decode('utf-8', errors='ignore')
+        serial = package = None
+        event = None
+        if message.lstrip().startswith("{"):
+            try:
+                body = json.loads(message)
+            except ValueError:
+                self.logger.warning("invalid hook message: %s" % message[:100])
+                return
+            serial = body.get("serial")
+            package = body.get("package")
+            if "message" in body:
+                event = PopupEvent.from_message(body["message"], receive_time=receive_time)
+            elif "kind" in body:
+                event = PopupEvent(body["kind"], text=body.get("text"),
+                                   image_positions=body.get("image_positions"), receive_time=receive_time)
+        else:
+            event = PopupEvent.from_message(message, receive_time=receive_time)
+        if event is None:
+            return
+        self.message_count += 1
+
+        session = self.__route(serial, package)
+        if session is None:
+            self.unrouted_count += 1
+            self.logger.warning("no session for hook message (serial=%s, package=%s)" % (serial, package))
+            return
+        session.deliver(event, len(payload))
+
+    def __route(self, serial, package):
+        with self.lock:
+            if (serial, package) in self.sessions:
+                return self.sessions[(serial, package)]
+            candidates = [session for session in self.sessions.values()
+                          if (serial is None or session.serial == serial)
+                          and (package is None or session.package == package)]
+        # messages without routing fields (legacy hook modules) go to the only session
+        if len(candidates) == 1:
+            return candidates[0]
+        return None
@@ -175,6 +175,8 @@ class EventLog(object):
         self.from_state = None
         self.to_state = None
         self.event_str = None
+        # time waited for the UI to settle after the event (seconds)
+        self.wait_time = 0
 
         self.profiling_method = profiling_method
         self.trace_remote_file = "/data/local/tmp/event.trace"
@@ -193,7 +195,8 @@ class EventLog(object):
             "event": self.event.to_dict(),
             "start_state": self.from_state.state_str,
             "stop_state": self.to_state.state_str,
-            "event_str": self.event_str
+            "event_str": self.event_str,
+            "wait_time": self.wait_time
         }
 
     def save2dir(self, output_dir=None):
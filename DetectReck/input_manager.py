@@ -3,7 +3,7 @@ import logging
 import subprocess
 import time
 
-from .input_event import EventLog
+from .input_event import EventLog, KEY_IntentEvent
 from .input_policy import UtgBasedInputPolicy, UtgNaiveSearchPolicy, UtgGreedySearchPolicy, ManualPolicy, \
     POLICY_NAIVE_DFS, POLICY_GREEDY_DFS, \
     POLICY_NAIVE_BFS, POLICY_GREEDY_BFS, \
@@ -48,6 +48,8 @@ class InputManager(object):
         self.script = None
         self.event_count = event_count
         self.event_interval = event_interval
+        # time waited for the UI to settle after each event (seconds)
+        self.event_wait_times = []
         self.replay_output = replay_output
 
         self.monkey = None
@@ -92,19 +94,28 @@ class InputManager(object):
         if event is None:
             return
         self.events.append(event)
+        cache_hits = self.device.property_cache_hits
 
         event_log = EventLog(self.device, self.app, event, self.profiling_method)
         event_log.start(sign)
+        # A started activity may take longer than the quiet period to show anything
+        launch = event.event_type == KEY_IntentEvent and "am start" in event.intent
         while True:
             # Add: Prolong launching time if tracking a start event.
             if event.event_type == 'intent' and 'am start --start-profiler' in event.intent:
                 interval = self.event_interval + 5
             else:
                 interval = self.event_interval
-            time.sleep(interval)
+            # event_interval is the max wait, the wait ends as soon as the UI is idle
+            event_log.wait_time += self.device.wait_for_ui_idle(interval, launch)
             if not self.device.pause_sending_event:
                 break
+        self.event_wait_times.append(event_log.wait_time)
+        self.logger.debug("Waited %.2fs for the UI to settle (event_interval: %ss)" %
+                          (event_log.wait_time, self.event_interval))
         event_log.stop(sign)
+        self.logger.debug("Device property cache saved %d adb lookups for this event (total: %s)" %
+                          (self.device.property_cache_hits - cache_hits, self.device.get_property_cache_stats()))
 
     def start(self):
         """
@@ -123,6 +134,8 @@ class InputManager(object):
                 while self.enabled:
                     time.sleep(1)
             elif self.policy_name == POLICY_MONKEY:
+                # only one monkey can run on the device
+                self.device.monkey_injector.disconnect()
                 throttle = self.event_interval * 1000
                 monkey_cmd = "adb -s %s shell monkey %s --ignore-crashes --ignore-security-exceptions" \
                              " --throttle %d -v %d" % \
@@ -167,3 +180,7 @@ class InputManager(object):
             if pid is not None:
                 self.device.adb.shell("kill -9 %d" % pid)
         self.enabled = False
+        # write the changes of the UTG since its last output
+        utg = getattr(self.policy, "utg", None)
+        if utg is not None:
+            utg.flush()
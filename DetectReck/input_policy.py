@@ -143,7 +143,8 @@ class UtgBasedInputPolicy(InputPolicy):
         generate an event
         @return:
         """
-        self.current_state = self.device.get_current_state()
+        # The state was just captured after the last event, unless the screen changed or a pop-up came since
+        self.current_state = self.device.get_current_state(reuse_if_unchanged=True)
         if self.current_state is None:
             import time
             time.sleep(5)
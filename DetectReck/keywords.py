@@ -0,0 +1,105 @@
+import logging
+import os
+import re
+import threading
+import time
+
+KEYWORD_DIR = 'DetectReck/resources/keywords'
+# Check the keyword files for modifications at most once per interval (seconds)
+RELOAD_CHECK_INTERVAL = 1
+
+KEYWORDS_CONFIRM = "confirm"
+KEYWORDS_RED_PACKET_BTN = "red_packet_btn"
+KEYWORDS_RED_PACKET_EVENT = "red_packet_event"
+
+
+class KeywordList(object):
+    """
+    an immutable, compiled snapshot of one keyword file
+    """
+
+    def __init__(self, words, mtime):
+        self.words = frozenset(words)
+        self.mtime = mtime
+        if words:
+            # Longer keywords first so that the reported match is the most specific one
+            pattern = "|".join(re.escape(word) for word in sorted(self.words, key=len, reverse=True))
+            self.regex = re.compile(pattern)
+        else:
+            self.regex = None
+
+    def contains(self, text):
+        return text in self.words
+
+    def search(self, text):
+        if self.regex is None or not text:
+            return None
+        m = self.regex.search(text)
+        return m.group(0) if m else None
+
+
+class KeywordStore(object):
+    """
+    Keyword lists under resources/keywords, loaded and compiled once.
+    A file is reloaded when its mtime changes, so edits apply without restarting.
+    Lookups only read immutable snapshots, which makes them safe to call from parallel workers.
+    """
+
+    def __init__(self, keyword_dir=KEYWORD_DIR):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.keyword_dir = keyword_dir
+        self.lock = threading.Lock()
+        self.__lists = {}
+        self.__last_check = {}
+
+    def __get_path(self, name):
+        return os.path.join(self.keyword_dir, "%s.txt" % name)
+
+    def __load(self, name, mtime):
+        words = []
+        try:
+            with open(self.__get_path(name), "r", encoding='UTF-8') as f:
+                words = [word.strip() for word in f.read().split('\n')]
+        except IOError as e:
+            self.logger.warning("Failed to load keywords %s: %s" % (name, e))
+        words = [word for word in words if word]
+        self.logger.debug("Loaded %d keywords from %s" % (len(words), name))
+        return KeywordList(words, mtime)
+
+    def get(self, name):
+        """
+        get the up-to-date keyword list
+        :param name: name of the keyword file without extension, e.g. KEYWORDS_CONFIRM
+        :return: KeywordList
+        """
+        keyword_list = self.__lists.get(name)
+        now = time.monotonic()
+        if keyword_list is not None and now - self.__last_check.get(name, 0) < RELOAD_CHECK_INTERVAL:
+            return keyword_list
+        with self.lock:
+            self.__last_check[name] = now
+            try:
+                mtime = os.stat(self.__get_path(name)).st_mtime_ns
+            except OSError:
+                mtime = None
+            keyword_list = self.__lists.get(name)
+            if keyword_list is None or keyword_list.mtime != mtime:
+                keyword_list = self.__load(name, mtime)
+                self.__lists[name] = keyword_list
+        return keyword_list
+
+    def contains(self, name, text):
+        """
+        check whether the text is exactly one of the keywords
+        """
+        return self.get(name).contains(text)
+
+    def search(self, name, text):
+        """
+        find a keyword occurring in the text
+        :return: the matched keyword, or None
+        """
+        return self.get(name).search(text)
+
+
+keyword_store = KeywordStore()
@@ -157,7 +157,8 @@ class UtgBasedInputPolicy(InputPolicy):
         generate an event
         @return:
         """
-        self.current_state = self.device.get_current_state()
+        # The state was just captured after the last event, unless the screen changed or a pop-up came since
+        self.current_state = self.device.get_current_state(reuse_if_unchanged=True)
         if self.current_state is None:
             time.sleep(5)
             return KeyEvent(name="BACK")
@@ -303,7 +304,7 @@ class UtgRecketSearchPolicy(UtgBasedInputPolicy):
         event_launcher = self.last_event.event_type == 'intent' and 'am start' in self.last_event.intent
         if event_launcher:
             self.app_restart = True
-            time.sleep(3)  # Wait for 3 seconds after the app is restarted
+            self.device.wait_for_ui_idle(3)  # Wait at most 3 seconds for the restarted app to settle
             # Update current state
             self.current_state = self.device.get_current_state()
 
@@ -477,57 +478,9 @@ class UtgRecketSearchPolicy(UtgBasedInputPolicy):
 
     # Get the bottom navigation bars of the app
     def __get_nav_bars(self, current_state):
-        device_height = self.device.get_height()
-        current_views = current_state.views
-        enabled_view_ids = current_state.enabled_view_ids[:]
-        enabled_view_ids.reverse()  # Reverse the order of view ids
-        for view_id in enabled_view_ids:
-            view = current_views[view_id]
-            view_class = self.safe_dict_get(view, 'class')
-            nav_class = 'LinearLayout' in view_class or 'TabWidget' in view_class or 'ViewGroup' in view_class \
-                        or 'RadioGroup' in view_class or 'RecyclerView' in view_class or 'android.view.View' == \
-                        view_class or 'CustomItemLayout' in view_class
-            child_count = view['child_count']
-            if self.safe_dict_get(view, 'enabled') and nav_class and child_count >= 2:
-                children_id = view['children']
-                children_view = []
-                children_class = []
-                children_bound_y1 = set()
-                children_bound_y2 = set()
-                nav_type = set()
-                for child_id in children_id:
-                    child_view = current_views[child_id]
-                    view_size = child_view['size'].split("*")
-                    view_w = int(view_size[0])
-                    view_h = int(view_size[1])
-                    # Excluding  invalid views with width or height less than or equal to 1
-                    if view_w <= 1 or view_h <= 1:
-                        child_count -= 1
-                        continue
-                    children_view.append(child_view)
-                    children_class.append(child_view['class'])
-                    children_bound_y1.add(child_view['bounds'][0][1])
-                    children_bound_y2.add(child_view['bounds'][1][1])
-                    nav_type.add(child_view['class'])
-                if child_count == 2 and len(nav_type) == 1:
-                    if len(children_bound_y1) == 1 and len(children_bound_y2) == 1:  # Horizontal arrangement
-                        if 0 <= device_height - children_bound_y2.pop() <= 200 and \
-                                0 <= device_height - children_bound_y1.pop() <= 350:  # Near the bottom of the screen
-                            self.nav_bars = children_view
-                            # Record the number of the navigation bars
-                            self.nav_bar_num = 2
-                elif child_count > 2 and len(nav_type) <= 2:
-                    if len(children_bound_y1) <= 2 and len(children_bound_y2) <= 2:  # Horizontal arrangement
-                        min_len = min(len(children_bound_y1), len(children_bound_y2))
-                        for index in range(min_len):
-                            if 0 <= device_height - children_bound_y2.pop() <= 200 and 0 <= device_height - \
-                                    children_bound_y1.pop() <= 350:  # Near the bottom of the screen
-                                self.nav_bars = children_view
-                            else:
-                                self.nav_bars = None
-                                break
-                            # Record the number of the navigation bars
-                            self.nav_bar_num = child_count
-            if self.nav_bars:
-                self.logger.info("Discover the app's navigation bar (%d)." % len(self.nav_bars))
-                break
+        nav_bar = current_state.nav_bar
+        if nav_bar is not None:
+            self.nav_bars = [current_state.views[tab_id] for tab_id in nav_bar['tabs']]
+            # Record the number of the navigation bars
+            self.nav_bar_num = len(self.nav_bars)
+            self.logger.info("Discover the app's navigation bar (%d)." % len(self.nav_bars))
@@ -0,0 +1,167 @@
+import logging
+import os
+import threading
+import time
+
+# Kinds of pop-ups reported by the hook module, each message starts with "#<kind>#"
+POPUP_DIALOG = "dialog"
+POPUP_WINDOW = "popup window"
+POPUP_CUSTOM = "custom popup"
+POPUP_THIRD_PARTY = "third-party popup"
+POPUP_IMAGE = "pop-up image"
+POPUP_KINDS = [POPUP_DIALOG, POPUP_WINDOW, POPUP_CUSTOM, POPUP_THIRD_PARTY, POPUP_IMAGE]
+
+# Files the pop-up messages used to be exchanged through, kept as an optional mirror for debugging
+POPUP_MIRROR_FILES = {
+    POPUP_DIALOG: "dialog.txt",
+    POPUP_WINDOW: "popup_window.txt",
+    POPUP_CUSTOM: "custom_popup.txt",
+    POPUP_THIRD_PARTY: "third-party_popup.txt",
+    POPUP_IMAGE: "popup_image_position.txt"
+}
+
+
+class PopupEvent(object):
+    """
+    a pop-up reported by the hook module
+    """
+
+    def __init__(self, kind, text=None, image_positions=None, receive_time=None):
+        """
+        :param kind: one of POPUP_KINDS
+        :param text: text embedded in the pop-up
+        :param image_positions: list of [x1, y1, x2, y2] of pop-up images
+        :param receive_time: time.monotonic() when the message was received
+        """
+        self.kind = kind
+        self.text = text
+        self.image_positions = image_positions if image_positions is not None else []
+        self.receive_time = receive_time if receive_time is not None else time.monotonic()
+
+    def to_dict(self):
+        return self.__dict__
+
+    def __str__(self):
+        return self.to_dict().__str__()
+
+    @staticmethod
+    def from_message(message, receive_time=None):
+        """
+        parse a hook message, e.g. "#dialog#\\n<text>" or "#pop-up image#:x1,y1,x2,y2"
+        :param message: str
+        :param receive_time: time.monotonic() when the message was received
+        :return: PopupEvent, or None if the message is not a pop-up
+        """
+        for kind in POPUP_KINDS:
+            tag = "#%s#" % kind
+            if tag not in message:
+                continue
+            if kind == POPUP_IMAGE:
+                image_positions = []
+                for pos in message.replace(tag + ":", "").replace(tag, "").strip().split('\n'):
+                    try:
+                        elems = [int(x) for x in pos.split(',')]
+                    except ValueError:
+                        continue
+                    if len(elems) == 4:
+                        image_positions.append(elems)
+                if not image_positions:
+                    return None
+                return PopupEvent(kind, image_positions=image_positions, receive_time=receive_time)
+            return PopupEvent(kind, text=message.replace(tag + "\n", ""), receive_time=receive_time)
+        return None
+
+    def to_message(self):
+        if self.kind == POPUP_IMAGE:
+            return "\n".join(["#%s#:%s" % (self.kind, ",".join([str(x) for x in pos]))
+                              for pos in self.image_positions])
+        return "#%s#\n%s" % (self.kind, self.text)
+
+
+class PopupEventBus(object):
+    """
+    in-memory, thread-safe queue of pop-up events published by the hook server and consumed by device states
+    """
+
+    def __init__(self, mirror_dir=None):
+        """
+        :param mirror_dir: if set, every published event is also written to the pop-up files in this directory
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.mirror_dir = mirror_dir
+        self.lock = threading.Lock()
+        self.__events = []
+        self.published_count = 0
+        # events received before the previous consumption, i.e. missed by the state captured then
+        self.stale_count = 0
+        # time.monotonic() up to which the events were consumed
+        self.last_consume_time = 0
+        # time.monotonic() of the last published event
+        self.last_publish_time = None
+
+    def publish(self, event):
+        """
+        publish a pop-up event
+        :param event: PopupEvent
+        """
+        if event is None:
+            return
+        with self.lock:
+            self.__events.append(event)
+            self.published_count += 1
+            self.last_publish_time = event.receive_time
+        self.logger.debug("pop-up event published: %s" % event)
+        if self.mirror_dir is not None:
+            self.__write_mirror(event)
+
+    def consume(self):
+        """
+        take all pending pop-up events
+        :return: list of PopupEvent, in receiving order
+        """
+        with self.lock:
+            events = self.__events
+            self.__events = []
+        return events
+
+    def has_pending(self):
+        """
+        :return: whether pop-up events are waiting to be attached to a state
+        """
+        with self.lock:
+            return len(self.__events) > 0
+
+    def consume_until(self, timestamp):
+        """
+        take the pending pop-up events received no later than the given time, i.e. since the previous capture
+        the pop-ups caused by an event arrive before the next capture starts, so none of them is dropped
+        :param timestamp: time.monotonic() value, e.g. the end of a state capture
+        :return: list of PopupEvent, in receiving order
+        """
+        with self.lock:
+            events = [event for event in self.__events if event.receive_time <= timestamp]
+            self.__events = [event for event in self.__events if event.receive_time > timestamp]
+            # Events left over from before the previous consumption were missed by the state captured then
+            stale_count = len([event for event in events if event.receive_time <= self.last_consume_time])
+            self.stale_count += stale_count
+            self.last_consume_time = max(self.last_consume_time, timestamp)
+        if stale_count:
+            self.logger.info("%d pop-up event(s) older than the previous state capture" % stale_count)
+        return events
+
+    def clear(self):
+        """
+        drop all pending pop-up events
+        """
+        with self.lock:
+            self.__events = []
+
+    def __write_mirror(self, event):
+        try:
+            if not os.path.exists(self.mirror_dir):
+                os.makedirs(self.mirror_dir)
+            mirror_path = os.path.join(self.mirror_dir, POPUP_MIRROR_FILES[event.kind])
+            with open(mirror_path, "a+", encoding="UTF-8") as f:
+                f.write(event.to_message() + '\n')
+        except Exception as e:
+            self.logger.warning("Failed to mirror pop-up event: %s" % e)
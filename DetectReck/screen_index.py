@@ -0,0 +1,168 @@
+# Near-duplicate screen lookup.
+# Screens are indexed by the dhash of their screenshot in a BK-tree, a tree over a metric where each child edge is
+# labelled with its distance to the parent, so that a search within distance k only visits the children whose
+# label is within k of the distance to the query (triangle inequality). Screens that only differ in a timer or a
+# marquee have close hashes, so a new state can reuse what was learnt on an equivalent screen.
+import json
+import logging
+import os
+import time
+
+from .adapter.cv import popcount
+
+# Max number of differing dhash bits (of 256) between two equivalent screens
+SCREEN_DUPLICATE_DISTANCE = 10
+SCREEN_INDEX_FILE = "screen_index.json"
+
+
+class BKTree(object):
+    """
+    a BK-tree of int hashes under the Hamming distance, each hash holding the list of values added with it
+    """
+
+    def __init__(self):
+        # node: [hash, [values], {distance: child node}]
+        self.root = None
+        # number of values
+        self.size = 0
+
+    def add(self, key, value):
+        """
+        add a value under a hash, next to the values already added with the same hash
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = [key, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = popcount(node[0] ^ key)
+            if distance == 0:
+                # Different screens (e.g. of different activities) may have the same hash
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        """
+        :return: list of (distance, hash, value) within max_distance of key, nearest first
+        """
+        results = []
+        if self.root is None:
+            return results
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            distance = popcount(node[0] ^ key)
+            if distance <= max_distance:
+                results.extend((distance, node[0], value) for value in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+    def items(self):
+        """
+        :return: list of (hash, value), in insertion order along each path
+        """
+        items = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            items.extend((node[0], value) for value in node[1])
+            nodes.extend(node[2].values())
+        return items
+
+
+class ScreenIndex(object):
+    """
+    an index of the screens seen in an app, persisted in its output directory
+    each entry is a dict with the activity and the state_str of the screen and, once classified, whether it shows
+    a red packet and a digest of the pop-ups and web views it was classified from
+    """
+
+    def __init__(self, path=None, max_distance=SCREEN_DUPLICATE_DISTANCE):
+        """
+        :param path: JSON file the index is loaded from and saved to, None for no persistence
+        :param max_distance: max Hamming distance between equivalent screens
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.lookup_count = 0
+        self.hit_count = 0
+        self.lookup_time = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def find(self, screen_hash, activity, evidence=None):
+        """
+        find an equivalent screen of the same activity
+        :param screen_hash: int, the dhash of the screenshot
+        :param activity: foreground activity
+        :param evidence: if set, only a screen classified from the same evidence (digest) is equivalent
+        :return: the entry of the nearest equivalent screen, or None
+        """
+        start_time = time.time()
+        entry = None
+        for distance, _, candidate in self.tree.search(screen_hash, self.max_distance):
+            if candidate["activity"] == activity and (evidence is None or candidate.get("evidence") == evidence):
+                entry = candidate
+                break
+        self.lookup_count += 1
+        self.lookup_time += time.time() - start_time
+        if entry is not None:
+            self.hit_count += 1
+        return entry
+
+    def add(self, screen_hash, activity, state_str, red_packet=None, evidence=None):
+        """
+        add a screen, unless an equivalent one with the same evidence is indexed
+        :return: the entry of the screen
+        """
+        entry = self.find(screen_hash, activity, evidence)
+        if entry is None:
+            entry = {"activity": activity, "state_str": state_str, "red_packet": red_packet, "evidence": evidence}
+            self.tree.add(screen_hash, entry)
+        elif red_packet is not None and entry["red_packet"] is None:
+            entry["red_packet"] = red_packet
+        return entry
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except (IOError, ValueError) as e:
+            self.logger.warning("Failed to load the screen index %s: %s" % (self.path, e))
+            return
+        for entry in entries:
+            screen_hash = int(entry.pop("hash"), 16)
+            self.tree.add(screen_hash, entry)
+        self.logger.info("%d screens loaded from %s" % (self.tree.size, self.path))
+
+    def save(self):
+        if self.path is None or self.tree.size == 0:
+            return
+        entries = []
+        for screen_hash, entry in self.tree.items():
+            entry = dict(entry)
+            entry["hash"] = "%x" % screen_hash
+            entries.append(entry)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def get_stats(self):
+        return {
+            "screens": self.tree.size,
+            "lookups": self.lookup_count,
+            "hits": self.hit_count,
+            "ms_per_lookup": self.lookup_time * 1000 / self.lookup_count if self.lookup_count else 0
+        }
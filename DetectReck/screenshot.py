@@ -0,0 +1,195 @@
+# In-memory screenshots.
+# A screenshot is kept in memory as captured (raw RGBA pixels or an encoded PNG/JPEG) and written to disk by a
+# background thread, so that the state capture does not wait for image encoding and file writes. Once written,
+# the pixels are released and only the file (and the dhash of the screen) is kept.
+import io
+import logging
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from PIL import Image
+
+# Pixel format of raw `screencap` output, see PixelFormat in the Android sources
+PIXEL_FORMAT_RGBA_8888 = 1
+PIXEL_FORMAT_RGBX_8888 = 2
+# zlib level of the PNG files written, lower is faster
+PNG_COMPRESS_LEVEL = 1
+
+
+class Screenshot(object):
+    """
+    a screenshot held in memory, either as an RGBA pixel array or as encoded image data
+    """
+
+    def __init__(self, pixels=None, encoded=None):
+        """
+        :param pixels: numpy array of shape (height, width, 4), RGBA
+        :param encoded: bytes of a PNG or JPEG image
+        """
+        self.pixels = pixels
+        self.encoded = encoded
+        self.__image = None
+        # dhash of the screen, see get_dhash
+        self.dhash = None
+        # number of pending writes, the pixels are released after the last one
+        self.pending_writes = 0
+        self.released = False
+
+    @staticmethod
+    def from_raw(data):
+        """
+        parse the raw output of `screencap`: width, height, pixel format (and, since Android 9, data space)
+        as 32-bit integers, followed by the pixels
+        :param data: bytes
+        :return: Screenshot, or None if the data is not RGBA
+        """
+        if len(data) < 12:
+            return None
+        width, height, pixel_format = struct.unpack_from("<III", data)
+        header_len = len(data) - width * height * 4
+        if pixel_format not in (PIXEL_FORMAT_RGBA_8888, PIXEL_FORMAT_RGBX_8888) or header_len not in (12, 16):
+            return None
+        # A view on the received buffer, the pixels are not copied
+        pixels = numpy.frombuffer(data, dtype=numpy.uint8, offset=header_len).reshape((height, width, 4))
+        return Screenshot(pixels=pixels)
+
+    @property
+    def width(self):
+        return self.get_image().width
+
+    @property
+    def height(self):
+        return self.get_image().height
+
+    def get_image(self):
+        """
+        :return: the screenshot as a PIL image, decoded once
+        """
+        # Local references, the writer thread may release the screenshot meanwhile
+        image = self.__image
+        if image is None:
+            pixels, encoded = self.pixels, self.encoded
+            if pixels is not None:
+                image = Image.fromarray(pixels, "RGBA")
+            elif encoded is not None:
+                image = Image.open(io.BytesIO(encoded))
+                image.load()
+            else:
+                raise ValueError("the screenshot was released")
+            if not self.released:
+                self.__image = image
+        return image
+
+    def get_pixels(self):
+        """
+        :return: the screenshot as a numpy array
+        """
+        pixels = self.pixels
+        if pixels is None:
+            pixels = numpy.asarray(self.get_image())
+            if not self.released:
+                self.pixels = pixels
+        return pixels
+
+    def get_dhash(self):
+        """
+        :return: the dhash of the screen (int), computed once, None if it cannot be computed
+        """
+        if self.dhash is None and not self.released:
+            from .adapter import cv
+            pixels = self.pixels
+            if pixels is None:
+                image = self.get_image()
+                # Palette and other modes have no RGB channels, a PIL array is RGB(A) or grayscale
+                if image.mode not in ("RGB", "RGBA", "L"):
+                    image = image.convert("RGB")
+                pixels = numpy.asarray(image)
+            # Same hash as the file loaded by opencv, whose channels are in BGR order
+            self.dhash = cv.calculate_dhash(pixels, rgb=True)
+        return self.dhash
+
+    def release(self):
+        """
+        drop the pixels, the screenshot is only available from its file afterwards
+        """
+        self.pixels = None
+        self.encoded = None
+        self.__image = None
+        self.released = True
+
+    def save(self, path):
+        if self.encoded is not None:
+            with open(path, "wb") as f:
+                f.write(self.encoded)
+        else:
+            self.get_image().save(path, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+
+
+class ScreenshotWriter(object):
+    """
+    writes screenshots to files in a background thread
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ScreenshotWriter")
+        self.lock = threading.Lock()
+        self.__pending = {}
+
+    def write(self, screenshot, path):
+        """
+        schedule writing a screenshot
+        :param screenshot: Screenshot
+        :param path: destination file path
+        :return: False if the screenshot was already released, the caller should copy its file instead
+        """
+        with self.lock:
+            if screenshot.released:
+                return False
+            screenshot.pending_writes += 1
+            future = self.executor.submit(self.__write, screenshot, path)
+            self.__pending[path] = future
+        future.add_done_callback(lambda f: self.__on_written(f, screenshot, path))
+        return True
+
+    def __write(self, screenshot, path):
+        try:
+            screenshot.save(path)
+        except Exception as e:
+            self.logger.warning("Failed to write screenshot %s: %s" % (path, e))
+
+    def __on_written(self, future, screenshot, path):
+        with self.lock:
+            # A later write to the same path replaced this one
+            if self.__pending.get(path) is future:
+                del self.__pending[path]
+            screenshot.pending_writes -= 1
+            if screenshot.pending_writes > 0:
+                return
+            # Kept for the near-duplicate screen lookup before the pixels are dropped
+            try:
+                screenshot.get_dhash()
+            except Exception as e:
+                self.logger.debug("Failed to hash screenshot %s: %s" % (path, e))
+            screenshot.release()
+
+    def wait(self, path):
+        """
+        wait until the screenshot file is written, if it is pending
+        :param path: file path passed to write()
+        """
+        with self.lock:
+            future = self.__pending.get(path)
+        if future is not None:
+            future.result()
+
+    def flush(self):
+        """
+        wait until all pending screenshots are written
+        """
+        with self.lock:
+            futures = list(self.__pending.values())
+        for future in futures:
+            future.result()
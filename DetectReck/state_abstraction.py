@@ -0,0 +1,128 @@
+# Adaptive state abstraction.
+# Feed pages and carousels give a new content-free state for every card loaded or rotated, and every new state is
+# classified and added to the UTG. The abstraction level of each activity is raised when its recent visits keep
+# producing new states, see state_fingerprint for the levels.
+# Raising the level changes the state_str of the screens already seen, which are in the UTG and the explored
+# states, so each state_str is kept with the level it was computed at, and a new state takes the state_str of a
+# known state that has the same fingerprint at that level.
+import logging
+
+from .state_fingerprint import ABSTRACTION_NONE, ABSTRACTION_COLLAPSE_LISTS
+
+# Number of recent visits of an activity its churn is measured on
+CHURN_WINDOW = 8
+# Number of new states in the window above which the abstraction of the activity is raised
+CHURN_THRESHOLD = 6
+
+
+class ActivityChurn(object):
+    """
+    the states seen in one activity
+    """
+
+    def __init__(self, level):
+        self.level = level
+        self.visit_count = 0
+        # concrete (not abstracted) and abstract state_str seen
+        self.concrete_states = set()
+        self.abstract_states = set()
+        # whether each recent visit gave a new abstract state
+        self.recent_new = []
+        # abstraction level -> state_str keyed at that level
+        self.keys = {}
+
+
+class StateAbstraction(object):
+    """
+    chooses the abstraction level of the states of each activity and counts what it saves
+    """
+
+    def __init__(self, level=None, max_level=ABSTRACTION_COLLAPSE_LISTS):
+        """
+        :param level: fixed abstraction level of all activities, None to adapt it per activity
+        :param max_level: max level reached by adaptation
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.fixed_level = level
+        self.max_level = max_level
+        self.activities = {}
+        # classifications skipped because the state was only new without abstraction
+        self.saved_classification_count = 0
+        self.checked_concrete_states = set()
+
+    def __get_churn(self, activity):
+        if activity not in self.activities:
+            level = self.fixed_level if self.fixed_level is not None else ABSTRACTION_NONE
+            self.activities[activity] = ActivityChurn(level)
+        return self.activities[activity]
+
+    def get_level(self, activity):
+        """
+        :return: the abstraction level of the states of an activity
+        """
+        return self.__get_churn(activity).level
+
+    def key_state(self, state):
+        """
+        choose the state_str of a new state: the state_str of a known state of its activity with the same
+        fingerprint at the level that state was keyed with, otherwise its fingerprint at the current level
+        :param state: DeviceState, fingerprinted at the current level of its activity
+        :return: (state_str, level it was keyed with)
+        """
+        churn = self.__get_churn(state.foreground_activity)
+        for level in sorted(churn.keys):
+            if level == churn.level:
+                continue
+            state_str = state.fingerprint.get_state_str(level)
+            if state_str in churn.keys[level]:
+                return state_str, level
+        churn.keys.setdefault(churn.level, set()).add(state.fingerprint.state_str)
+        return state.fingerprint.state_str, churn.level
+
+    def observe(self, state):
+        """
+        record a new state and raise the abstraction of its activity if the activity churns
+        :param state: DeviceState
+        """
+        churn = self.__get_churn(state.foreground_activity)
+        churn.visit_count += 1
+        churn.concrete_states.add(state.fingerprint.concrete_state_str)
+        is_new = state.state_str not in churn.abstract_states
+        churn.abstract_states.add(state.state_str)
+        churn.recent_new.append(is_new)
+        if len(churn.recent_new) > CHURN_WINDOW:
+            churn.recent_new.pop(0)
+
+        if self.fixed_level is None and churn.level < self.max_level and \
+                sum(churn.recent_new) >= CHURN_THRESHOLD:
+            churn.level += 1
+            churn.recent_new = []
+            self.logger.info("%d of the last %d states of %s were new, abstraction raised to level %d" %
+                             (CHURN_THRESHOLD, CHURN_WINDOW, state.foreground_activity, churn.level))
+
+    def on_explore_check(self, state, explored):
+        """
+        record whether a state was found explored, a classification is saved when only its abstraction was
+        :param state: DeviceState
+        :param explored: whether the state was found explored
+        """
+        concrete_state_str = state.fingerprint.concrete_state_str
+        if explored and concrete_state_str != state.state_str and \
+                concrete_state_str not in self.checked_concrete_states:
+            self.saved_classification_count += 1
+        self.checked_concrete_states.add(concrete_state_str)
+
+    def get_stats(self):
+        """
+        :return: dict of the states merged by abstraction and the classifications saved
+        """
+        concrete_count = sum(len(churn.concrete_states) for churn in self.activities.values())
+        abstract_count = sum(len(churn.abstract_states) for churn in self.activities.values())
+        return {
+            "concrete_states": concrete_count,
+            "abstract_states": abstract_count,
+            "saved_states": max(concrete_count - abstract_count, 0),
+            "saved_classifications": self.saved_classification_count,
+            "levels": dict((activity, churn.level) for activity, churn in self.activities.items()
+                           if churn.level != ABSTRACTION_NONE)
+        }
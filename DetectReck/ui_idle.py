@@ -0,0 +1,105 @@
+# Adaptive waiting for the UI to settle after an event.
+# The UI is considered idle once no activity was seen for a quiet period, where activity is an accessibility
+# event from the droidbot app, a visible screen change in the minicap frames or a pop-up reported by the hook
+# module. An app launch may show nothing for longer than the quiet period (process start, splash screen), so
+# after a launch the quiet period only counts once the UI changed or a longer launch floor passed.
+import logging
+import time
+
+# Min time to wait after an event (seconds), can be raised for flaky apps
+UI_IDLE_FLOOR = 0.5
+# Time without UI activity after which the UI is considered idle (seconds)
+UI_IDLE_QUIET_PERIOD = 0.8
+# Min time to wait after an app launch that did not change the UI yet (seconds)
+UI_IDLE_LAUNCH_FLOOR = 3
+UI_IDLE_POLL_INTERVAL = 0.05
+
+
+class UIIdleWaiter(object):
+    """
+    waits until the UI of a device is idle
+    """
+
+    def __init__(self, device, floor=UI_IDLE_FLOOR, quiet_period=UI_IDLE_QUIET_PERIOD,
+                 launch_floor=UI_IDLE_LAUNCH_FLOOR):
+        """
+        :param device: instance of Device
+        :param floor: min time to wait (seconds)
+        :param quiet_period: time without UI activity after which the UI is idle (seconds)
+        :param launch_floor: min time to wait after an app launch, unless the UI changed (seconds)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.device = device
+        self.floor = floor
+        self.quiet_period = quiet_period
+        self.launch_floor = launch_floor
+        # whether the screen changed during the last wait, None if it cannot be told
+        self.ui_changed = None
+
+    def get_last_screen_activity_time(self):
+        """
+        :return: time.monotonic() of the latest accessibility event or screen change, or None if no source of them
+                 is available
+        """
+        activity_times = []
+        device = self.device
+        if device.adapters.get(device.droidbot_app) and device.droidbot_app.connected:
+            activity_times.append(device.droidbot_app.last_acc_event_time or 0)
+        if device.adapters.get(device.minicap) and device.minicap.connected:
+            change_detector = device.minicap.change_detector
+            if change_detector.enabled:
+                # Frames that do not visibly change the screen are ignored
+                activity_times.append(change_detector.last_change_time or 0)
+            else:
+                activity_times.append(device.minicap.last_frame_time or 0)
+        if not activity_times:
+            return None
+        return max(activity_times)
+
+    def get_last_activity_time(self):
+        """
+        :return: time.monotonic() of the latest UI activity, including pop-ups, or None if no activity source is
+                 available
+        """
+        last_screen_activity_time = self.get_last_screen_activity_time()
+        if last_screen_activity_time is None:
+            return None
+        return max(last_screen_activity_time, self.device.popup_bus.last_publish_time or 0)
+
+    def wait(self, max_wait, launch=False):
+        """
+        wait until the UI is idle
+        :param max_wait: max time to wait (seconds)
+        :param launch: whether the event launches an app, then the UI is not idle before it changed at least once
+                       or launch_floor passed
+        :return: the time waited (seconds)
+        """
+        start_time = time.monotonic()
+        self.ui_changed = None
+        if self.get_last_activity_time() is None:
+            # Nothing tells whether the UI is idle
+            time.sleep(max_wait)
+            return time.monotonic() - start_time
+
+        min_wait = min(self.floor, max_wait)
+        while True:
+            now = time.monotonic()
+            waited = now - start_time
+            if waited >= max_wait:
+                break
+            last_activity_time = self.get_last_activity_time()
+            if last_activity_time is None:
+                # The activity sources were disconnected
+                time.sleep(max_wait - waited)
+                break
+            if launch and last_activity_time <= start_time and waited < self.launch_floor:
+                # The launched activity did not show up yet
+                time.sleep(UI_IDLE_POLL_INTERVAL)
+                continue
+            if waited >= min_wait and now - max(last_activity_time, start_time) >= self.quiet_period:
+                break
+            time.sleep(UI_IDLE_POLL_INTERVAL)
+        last_screen_activity_time = self.get_last_screen_activity_time()
+        if last_screen_activity_time is not None:
+            self.ui_changed = last_screen_activity_time > start_time
+        return time.monotonic() - start_time
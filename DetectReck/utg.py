@@ -3,10 +3,21 @@ import json
 import os
 import random
 import datetime
+import time
 import networkx as nx
 
 from .utils import list_to_html_table, lazy_property
 
+# Min interval between two rewrites of utg.js (seconds), the changes in between go to the delta log
+UTG_OUTPUT_INTERVAL = 10
+UTG_FILE_NAME = "utg.js"
+# Append-only log of the changes since the start, one JSON object per line:
+#   {"node": <utg.js node>}, a later node of the same id replaces it
+#   {"event": <utg.js edge event> + "from" and "to"}, an event added to the edge between two states
+#   {"removed_event": {"from", "to", "event_str"}}, an event removed from an edge
+# The full edges are only rebuilt when utg.js is written.
+UTG_DELTA_FILE_NAME = "utg_delta.jsonl"
+
 
 class UTG(object):
     """
@@ -37,6 +48,16 @@ class UTG(object):
 
         self.start_time = datetime.datetime.now()
 
+        # utg.js records of the nodes and edges, the edges whose events changed are rebuilt by __output_utg
+        self.__utg_nodes = {}
+        self.__utg_edges = {}
+        self.__dirty_edges = set()
+        self.__delta_file = None
+        # whether the delta log was started, it is appended to after being closed by flush
+        self.__delta_started = False
+        self.__output_dirty = False
+        self.__last_output_time = 0
+
     def add_transition(self, event, old_state, new_state):
         self.add_node(old_state)
         self.add_node(new_state)
@@ -55,6 +76,7 @@ class UTG(object):
             for new_state_str in self.G[old_state.state_str]:
                 if event_str in self.G[old_state.state_str][new_state_str]["events"]:
                     self.G[old_state.state_str][new_state_str]["events"].pop(event_str)
+                    self.__update_edge(old_state.state_str, new_state_str, event_str, removed=True)
             if event_str in self.effective_event_strs:
                 self.effective_event_strs.remove(event_str)
             return
@@ -71,6 +93,7 @@ class UTG(object):
         }
         self.last_state_str = new_state.state_str
         self.last_transition = (old_state.state_str, new_state.state_str)
+        self.__update_edge(old_state.state_str, new_state.state_str, event_str)
         self.__output_utg()
 
     def add_node(self, state):
@@ -79,99 +102,155 @@ class UTG(object):
         if state.state_str not in self.G.nodes():
             state.save2dir()
             self.G.add_node(state.state_str, state=state)
+            self.__add_utg_node(state)
             if self.first_state_str is None:
                 self.first_state_str = state.state_str
                 self.retart_state = state
         if state.foreground_activity.startswith(self.app.package_name):
             self.reached_activities.add(state.foreground_activity)
 
-    def __output_utg(self):
+    def __add_utg_node(self, state):
+        if not self.device.output_dir:
+            return
+        package_name = state.foreground_activity.split("/")[0]
+        activity_name = state.foreground_activity.split("/")[1]
+        short_activity_name = activity_name.split(".")[-1]
+
+        state_desc = list_to_html_table([
+            ("package", package_name),
+            ("activity", activity_name),
+            # Update
+            # ("state_str", state.state_str),
+            ("state_str", state.state_str_content),
+            ("structure_str", state.structure_str)
+        ])
+
+        utg_node = {
+            "id": state.state_str,
+            "shape": "image",
+            "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
+            "label": short_activity_name,
+            # "group": state.foreground_activity,
+            "package": package_name,
+            "activity": activity_name,
+            # Update
+            # "state_str": state_str,
+            "state_str": state.state_str_content,
+            "structure_str": state.structure_str,
+            "title": state_desc,
+            "content": "\n".join([package_name, activity_name, state.state_str, state.search_content])
+        }
+        self.__utg_nodes[state.state_str] = utg_node
+        self.__append_delta({"node": utg_node})
+
+    def __update_edge(self, from_state, to_state, event_str, removed=False):
         """
-        Output current UTG to a js file
+        log an event added to or removed from an edge, the edge is rebuilt when utg.js is written
         """
         if not self.device.output_dir:
             return
-        utg_file_path = os.path.join(self.device.output_dir, "utg.js")
-        utg_file = open(utg_file_path, "w")
+        self.__dirty_edges.add((from_state, to_state))
+        if removed:
+            self.__append_delta({"removed_event": {"from": from_state, "to": to_state, "event_str": event_str}})
+        else:
+            utg_event = self.__build_utg_event(event_str, self.G[from_state][to_state]["events"][event_str])
+            utg_event.update({"from": from_state, "to": to_state})
+            self.__append_delta({"event": utg_event})
+
+    def __build_utg_event(self, event_str, event_info):
+        if self.device.adapters[self.device.minicap]:
+            view_images = ["views/view_" + view["view_str"] + ".jpg"
+                           for view in event_info["event"].get_views()]
+        else:
+            view_images = ["views/view_" + view["view_str"] + ".png"
+                           for view in event_info["event"].get_views()]
+        return {
+            "event_str": event_str,
+            "event_id": event_info["id"],
+            "event_type": event_info["event"].event_type,
+            "view_images": view_images
+        }
+
+    def __build_utg_edge(self, from_state, to_state):
+        events = self.G[from_state][to_state]["events"]
+        event_short_descs = []
+        event_list = []
+
+        for event_str, event_info in sorted(iter(events.items()), key=lambda x: x[1]["id"]):
+            event_short_descs.append((event_info["id"], event_str))
+            event_list.append(self.__build_utg_event(event_str, event_info))
+
+        utg_edge = {
+            "from": from_state,
+            "to": to_state,
+            "id": from_state + "-->" + to_state,
+            "title": list_to_html_table(event_short_descs),
+            "label": ", ".join([str(x["event_id"]) for x in event_list]),
+            "events": event_list
+        }
+
+        # # Highlight last transition
+        # if state_transition == self.last_transition:
+        #     utg_edge["color"] = "red"
+
+        self.__utg_edges[(from_state, to_state)] = utg_edge
+        return utg_edge
+
+    def __append_delta(self, record):
+        """
+        append a record to the delta log
+        """
+        if self.__delta_file is None:
+            delta_file_path = os.path.join(self.device.output_dir, UTG_DELTA_FILE_NAME)
+            self.__delta_file = open(delta_file_path, "a" if self.__delta_started else "w")
+            self.__delta_started = True
+        self.__delta_file.write(json.dumps(record) + "\n")
+        self.__delta_file.flush()
+        self.__output_dirty = True
+
+    @lazy_property
+    def metadata(self):
+        """
+        the device and app information of utg.js, fetched once
+        """
+        return {
+            "device_serial": self.device.serial,
+            "device_model_number": self.device.get_model_number(),
+            "device_sdk_version": self.device.get_sdk_version(),
+
+            "app_sha256": self.app.hashes[2],
+            "app_package": self.app.package_name,
+            "app_main_activity": self.app.main_activity,
+            "app_num_total_activities": len(self.app.activities),
+        }
+
+    def __output_utg(self, force=False):
+        """
+        Output current UTG to a js file, at most every UTG_OUTPUT_INTERVAL seconds unless forced
+        """
+        if not self.device.output_dir or not self.__output_dirty:
+            return
+        if not force and time.time() - self.__last_output_time < UTG_OUTPUT_INTERVAL:
+            return
+
+        for from_state, to_state in self.__dirty_edges:
+            self.__build_utg_edge(from_state, to_state)
+        self.__dirty_edges.clear()
+
         utg_nodes = []
-        utg_edges = []
         for state_str in self.G.nodes():
-            state = self.G.nodes[state_str]["state"]
-            package_name = state.foreground_activity.split("/")[0]
-            activity_name = state.foreground_activity.split("/")[1]
-            short_activity_name = activity_name.split(".")[-1]
-
-            state_desc = list_to_html_table([
-                ("package", package_name),
-                ("activity", activity_name),
-                # Update
-                # ("state_str", state.state_str),
-                ("state_str", state.state_str_content),
-                ("structure_str", state.structure_str)
-            ])
-
-            utg_node = {
-                "id": state_str,
-                "shape": "image",
-                "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
-                "label": short_activity_name,
-                # "group": state.foreground_activity,
-                "package": package_name,
-                "activity": activity_name,
-                # Update
-                # "state_str": state_str,
-                "state_str": state.state_str_content,
-                "structure_str": state.structure_str,
-                "title": state_desc,
-                "content": "\n".join([package_name, activity_name, state.state_str, state.search_content])
-            }
-
-            if state.state_str == self.first_state_str:
+            utg_node = self.__utg_nodes[state_str]
+            if state_str == self.first_state_str or state_str == self.last_state_str:
+                utg_node = dict(utg_node)
+            if state_str == self.first_state_str:
                 utg_node["label"] += "\n<FIRST>"
                 utg_node["font"] = "14px Arial red"
-            if state.state_str == self.last_state_str:
+            if state_str == self.last_state_str:
                 utg_node["label"] += "\n<LAST>"
                 utg_node["font"] = "14px Arial red"
-
             utg_nodes.append(utg_node)
 
-        for state_transition in self.G.edges():
-            from_state = state_transition[0]
-            to_state = state_transition[1]
-
-            events = self.G[from_state][to_state]["events"]
-            event_short_descs = []
-            event_list = []
-
-            for event_str, event_info in sorted(iter(events.items()), key=lambda x: x[1]["id"]):
-                event_short_descs.append((event_info["id"], event_str))
-                if self.device.adapters[self.device.minicap]:
-                    view_images = ["views/view_" + view["view_str"] + ".jpg"
-                                   for view in event_info["event"].get_views()]
-                else:
-                    view_images = ["views/view_" + view["view_str"] + ".png"
-                                   for view in event_info["event"].get_views()]
-                event_list.append({
-                    "event_str": event_str,
-                    "event_id": event_info["id"],
-                    "event_type": event_info["event"].event_type,
-                    "view_images": view_images
-                })
-
-            utg_edge = {
-                "from": from_state,
-                "to": to_state,
-                "id": from_state + "-->" + to_state,
-                "title": list_to_html_table(event_short_descs),
-                "label": ", ".join([str(x["event_id"]) for x in event_list]),
-                "events": event_list
-            }
-
-            # # Highlight last transition
-            # if state_transition == self.last_transition:
-            #     utg_edge["color"] = "red"
-
-            utg_edges.append(utg_edge)
+        utg_edges = [self.__utg_edges[state_transition] for state_transition in self.G.edges()]
 
         utg = {
             "nodes": utg_nodes,
@@ -184,21 +263,28 @@ class UTG(object):
             "test_date": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
             "time_spent": (datetime.datetime.now() - self.start_time).total_seconds(),
             "num_input_events": self.input_event_count,
-
-            "device_serial": self.device.serial,
-            "device_model_number": self.device.get_model_number(),
-            "device_sdk_version": self.device.get_sdk_version(),
-
-            "app_sha256": self.app.hashes[2],
-            "app_package": self.app.package_name,
-            "app_main_activity": self.app.main_activity,
-            "app_num_total_activities": len(self.app.activities),
         }
-
-        utg_json = json.dumps(utg, indent=2)
-        utg_file.write("var utg = \n")
-        utg_file.write(utg_json)
-        utg_file.close()
+        utg.update(self.metadata)
+
+        utg_file_path = os.path.join(self.device.output_dir, UTG_FILE_NAME)
+        # Written aside and renamed, so that utg.js is never seen half written
+        with open(utg_file_path + ".tmp", "w") as utg_file:
+            utg_json = json.dumps(utg, indent=2)
+            utg_file.write("var utg = \n")
+            utg_file.write(utg_json)
+        os.replace(utg_file_path + ".tmp", utg_file_path)
+        self.__output_dirty = False
+        self.__last_output_time = time.time()
+
+    def flush(self):
+        """
+        write utg.js with the latest changes and close the delta log, e.g. at the end of a run
+        the delta log is reopened if the UTG changes afterwards
+        """
+        self.__output_utg(force=True)
+        if self.__delta_file is not None:
+            self.__delta_file.close()
+            self.__delta_file = None
 
     def is_event_explored(self, event, state):
         event_str = event.get_event_str(state)
@@ -22,28 +22,44 @@ def lazy_property(func):
     return wrapper
 
 
+class LogDict(dict):
+    """
+    a parsed logcat line, its 'datetime' is only parsed when accessed
+    """
+
+    def __missing__(self, key):
+        if key != 'datetime':
+            raise KeyError(key)
+        value = parse_log_datetime(self['date'], self['time'])
+        self['datetime'] = value
+        return value
+
+
+def parse_log_datetime(date, time):
+    """
+    parse the date and time of a threadtime logcat line, e.g. "03-15" and "14:02:45.123"
+    (much faster than datetime.strptime)
+    @return: datetime
+    """
+    month, day = date.split('-')
+    hms, _, fraction = time.partition('.')
+    hour, minute, second = hms.split(':')
+    microsecond = int(fraction.ljust(6, '0')[:6]) if fraction else 0
+    return datetime(datetime.today().year, int(month), int(day), int(hour), int(minute), int(second), microsecond)
+
+
 def parse_log(log_msg):
     """
     parse a logcat message
     the log should be in threadtime format
+    the datetime is parsed on first access to log_dict['datetime']
     @param log_msg:
     @return:
     """
     m = LOGCAT_THREADTIME_RE.match(log_msg)
     if not m:
         return None
-    log_dict = {}
-    date = m.group('date')
-    time = m.group('time')
-    log_dict['pid'] = m.group('pid')
-    log_dict['tid'] = m.group('tid')
-    log_dict['level'] = m.group('level')
-    log_dict['tag'] = m.group('tag')
-    log_dict['content'] = m.group('content')
-    datetime_str = "%s-%s %s" % (datetime.today().year, date, time)
-    log_dict['datetime'] = datetime.strptime(datetime_str, "%Y-%m-%d %H:%M:%S.%f")
-
-    return log_dict
+    return LogDict(m.groupdict())
 
 
 def get_available_devices():